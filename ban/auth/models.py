@@ -3,6 +3,7 @@ from datetime import timedelta
 
 from ban import db
 from ban.core.resource import ResourceModel
+from ban.db import prefetch
 
 from ban.utils import utcnow
 from .utils import generate_secret
@@ -146,6 +147,12 @@ class Session(db.Model):
             'contributor_type': self.contributor_type if self.contributor_type else None
         }
 
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        # serialize always follows client and user, whatever the mask.
+        prefetch.foreign_key(instances, cls.client)
+        prefetch.foreign_key(instances, cls.user)
+
     def save(self, **kwargs):
         if not self.user and not self.client:
             raise ValueError('Session must have either a client or a user')
@@ -1,7 +1,14 @@
+from datetime import timedelta
+
+import peewee
+from playhouse.migrate import PostgresqlMigrator, migrate as run_migrations
+
+from ban import db
 from ban.auth import models as amodels
 from ban.commands import command, reporter
-from ban.core import models as cmodels
+from ban.core import config, models as cmodels
 from ban.core.versioning import Diff, Version, Redirect, Flag, Anomaly
+from ban.utils import apply_delta, utcnow
 
 from . import helpers
 
@@ -23,6 +30,39 @@ def create(fail_silently=False, **kwargs):
         reporter.notice('Created', model.__name__)
 
 
+@command
+def migrate(**kwargs):
+    """Upgrade the tables of an existing database: add the columns (and
+    their indexes) they miss, then the indexes that are not declared on the
+    fields. Idempotent.
+
+    Run it first when upgrading, then db:normalize (name searches),
+    db:extents (groups extent and centroid) and db:encode_versions (to store
+    versions as deltas), which fill the columns added.
+    """
+    migrator = PostgresqlMigrator(db.database)
+    for model in models:
+        table = model._meta.db_table
+        if not model.table_exists():
+            model.create_table()
+            reporter.notice('Created', model.__name__)
+            continue
+        columns = {c.name for c in db.database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.db_column in columns:
+                continue
+            # Not null columns are filled with their default.
+            run_migrations(migrator.add_column(table, field.db_column,
+                                               field))
+            if field.index or field.unique:
+                db.database.create_index(model, [field], field.unique)
+            reporter.notice('Added column', '{}.{}'.format(table,
+                                                           field.db_column))
+    for model in (cmodels.Municipality, cmodels.PostCode, cmodels.Group):
+        model.create_trigram_indexes()
+    Version.create_period_index()
+
+
 @command
 def truncate(*names, force=False, **kwargs):
     """Truncate database tables.
@@ -44,4 +84,246 @@ def truncate(*names, force=False, **kwargs):
         if name not in names:
             continue
         model.delete().execute()
+        db.cache.invalidate(model.__name__)
         reporter.notice('Truncated', name)
+
+
+@command
+def normalize(*names, **kwargs):
+    """Compute the searchable forms of the names (used by name searches),
+    then create their trigram indexes if missing.
+
+    names   List of model names to process (municipality, postcode, group).
+    """
+    for model in (cmodels.Municipality, cmodels.PostCode, cmodels.Group):
+        name = model.__name__.lower()
+        if names and name not in names:
+            continue
+        query = (model.select(model.pk, model.name, model.alias)
+                      .order_by(model.pk))
+        count = len(list(helpers.batch(process_normalize, query,
+                                       total=query.count())))
+        db.cache.invalidate(model.__name__)
+        # Cheaper to build once the columns are filled.
+        model.create_trigram_indexes()
+        reporter.notice('Normalized {}'.format(name), count)
+
+
+def process_normalize(*rows):
+    # Update the columns only: this is not a new version of the resources.
+    with db.database.execution_context():
+        with db.database.atomic():
+            for row in rows:
+                row.normalize()
+                model = row.__class__
+                (model.update(name_normalized=row.name_normalized,
+                              alias_normalized=row.alias_normalized)
+                      .where(model.pk == row.pk)
+                      .execute())
+        return [row.pk for row in rows]
+
+
+@command
+def extents(**kwargs):
+    """Compute again the extent and centroid of every group from its
+    positions."""
+    cmodels.Group.refresh_extents()
+    reporter.notice('Refreshed', 'group extents')
+
+
+@command
+def encode_versions(*names, interval=None, **kwargs):
+    """Store again the versions history, as a full snapshot every `interval`
+    versions and deltas in between.
+
+    interval    Snapshot interval (default: VERSION_SNAPSHOT_INTERVAL), 1 to
+                store every version in full.
+    names       List of model names to process (default: all).
+    """
+    table = Version._meta.db_table
+    if Version.snapshot.db_column not in {
+            c.name for c in db.database.get_columns(table)}:
+        helpers.abort('Missing {}.{} column, run db:migrate first'.format(
+            table, Version.snapshot.db_column))
+    if interval:
+        # Set before the workers are forked.
+        config.set('VERSION_SNAPSHOT_INTERVAL', interval)
+    query = (Version.select(Version.model_name, Version.model_pk)
+                    .distinct()
+                    .order_by(Version.model_name, Version.model_pk)
+                    .tuples())
+    if names:
+        query = query.where(Version.model_name << names)
+    count = len(list(helpers.batch(process_encode_versions, query,
+                                   total=query.count())))
+    reporter.notice('Encoded versions', count)
+
+
+def process_encode_versions(*resources):
+    by_model = {}
+    for model_name, model_pk in resources:
+        by_model.setdefault(model_name, []).append(model_pk)
+    encoded = []
+    with db.database.execution_context():
+        with db.database.atomic():
+            for model_name, pks in by_model.items():
+                versions = (Version.select()
+                                   .where(Version.model_name == model_name,
+                                          Version.model_pk << pks)
+                                   .order_by(Version.model_pk,
+                                             Version.sequential))
+                model_pk = document = None
+                for version in versions:
+                    if version.model_pk != model_pk:
+                        model_pk, document = version.model_pk, None
+                    stored = (version.stored, version.snapshot)
+                    previous = document
+                    if version.snapshot:
+                        document = version.stored
+                    else:
+                        document = apply_delta(document, version.stored)
+                    version.encode(document, previous)
+                    if (version.stored, version.snapshot) != stored:
+                        (Version.update(stored=version.stored,
+                                        snapshot=version.snapshot)
+                                .where(Version.pk == version.pk)
+                                .execute())
+                    encoded.append(version.pk)
+    return encoded
+
+
+COMPACT_SQL = """SELECT v.pk, v.model_pk, v.sequential, v.data, v.snapshot,
+       lower(v.period),
+       coalesce(upper(v.period) <= %(cutoff)s, false)
+       AND NOT EXISTS (SELECT 1 FROM {flag} WHERE {flag}.{flag_version} = v.pk)
+       AND NOT EXISTS (SELECT 1 FROM {anomaly} WHERE
+                       {anomaly}.{anomaly_version} = v.pk)
+       AND NOT EXISTS (SELECT 1 FROM {diff} WHERE {diff}.{old} = v.pk
+                                               OR {diff}.{new} = v.pk),
+       date_trunc(%(period)s, lower(v.period))
+FROM {version} AS v
+WHERE v.model_name = %(model_name)s
+AND v.model_pk BETWEEN %(start)s AND %(end)s
+ORDER BY v.model_pk, v.sequential"""
+COMPACT_PERIODS = ['hour', 'day', 'week', 'month']
+
+
+@command
+def compact_versions(*names, days=30, period='day', size=1000,
+                     diffs_days=None, **kwargs):
+    """Merge the runs of consecutive versions closed more than `days` ago
+    into their last one, one per resource and per `period`. Flagged
+    versions and versions linked to a Diff or an Anomaly are kept.
+
+    In each run, the last version is kept (over the period of the whole
+    run) and the versions before it are deleted: their sequential numbers
+    are gone from the resource history, e.g. 2 and 3 of a run 2, 3, 4.
+
+    Every save records a Diff: unless older Diffs are deleted with
+    `diffs_days`, only the versions saved with Diffs disabled (imports) can
+    be merged, and the command compacts almost nothing. Deleted Diffs are
+    gone for good: /diff consumers which did not read them yet miss them.
+
+    days        Only merge versions closed before this number of days.
+    period      Merge the versions started within the same hour, day, week
+                or month.
+    size        Number of resources (by pk range) processed by each task.
+    diffs_days  First delete the Diffs older than this number of days
+                (default: keep them all).
+    names       List of model names to process (default: all).
+    """
+    if period not in COMPACT_PERIODS:
+        helpers.abort('Invalid period: {}'.format(period))
+    # The command line parser types the values from their default (None
+    # for diffs_days), callers may also pass strings.
+    days, size = int(days), int(size)
+    cutoff = utcnow() - timedelta(days=days)
+    if diffs_days is not None:
+        limit = utcnow() - timedelta(days=int(diffs_days))
+        count = Diff.delete().where(Diff.created_at < limit).execute()
+        reporter.notice('Deleted diffs', count)
+    query = (Version.select(Version.model_name,
+                            peewee.fn.MIN(Version.model_pk),
+                            peewee.fn.MAX(Version.model_pk))
+                    .group_by(Version.model_name)
+                    .order_by(Version.model_name)
+                    .tuples())
+    if names:
+        query = query.where(Version.model_name << names)
+    # By model and by pk range, so every resource is in only one task.
+    tasks = [(model_name, start, min(start + size - 1, last), cutoff, period)
+             for model_name, first, last in query
+             for start in range(first, last + 1, size)]
+    deleted = reclaimed = 0
+    for count, length in helpers.batch(process_compact_versions, tasks,
+                                       chunksize=1, total=len(tasks)):
+        deleted += count
+        reclaimed += length
+    reporter.notice('Deleted versions', deleted)
+    reporter.notice('Reclaimed bytes', reclaimed)
+
+
+def process_compact_versions(*tasks):
+    through = Anomaly.versions.get_through_model()
+    sql = COMPACT_SQL.format(
+        flag=Flag._meta.db_table, flag_version=Flag.version.db_column,
+        anomaly=through._meta.db_table,
+        anomaly_version=through._meta.fields['version'].db_column,
+        diff=Diff._meta.db_table, old=Diff.old.db_column,
+        new=Diff.new.db_column, version=Version._meta.db_table)
+    results = []
+    with db.database.execution_context():
+        with db.database.atomic():
+            for model_name, start, end, cutoff, period in tasks:
+                params = dict(model_name=model_name, start=start, end=end,
+                              cutoff=cutoff, period=period)
+                rows = db.database.execute_sql(sql, params).fetchall()
+                results.append(compact_rows(rows))
+    return results
+
+
+def compact_rows(rows):
+    """Merge the runs of removable versions in `rows` (ordered by resource
+    and sequential), and return the number and size of deleted rows."""
+    deleted = []
+    run = []
+    model_pk = base = document = None
+    for (pk, resource, sequential, stored, snapshot, lower, removable,
+         bucket) in rows:
+        if resource != model_pk:
+            deleted.extend(merge_run(run, base))
+            run, model_pk, base, document = [], resource, None, None
+        document = stored if snapshot else apply_delta(document, stored)
+        if run and (not removable or run[-1][3] != bucket):
+            deleted.extend(merge_run(run, base))
+            base = run[-1][4]
+            run = []
+        if removable:
+            run.append((pk, sequential, lower, bucket, document))
+        else:
+            base = document
+    deleted.extend(merge_run(run, base))
+    if not deleted:
+        return 0, 0
+    cursor = db.database.execute_sql(
+        'DELETE FROM {0} WHERE pk = ANY(%s) '
+        'RETURNING pg_column_size({0}.*)'.format(Version._meta.db_table),
+        [deleted])
+    return len(deleted), sum(size for size, in cursor.fetchall())
+
+
+def merge_run(run, base):
+    """Keep the last version of `run` over the whole run period, stored from
+    `base` (the document before the run), and return the pks of the
+    others."""
+    if len(run) < 2:
+        return []
+    pk, sequential, _, _, document = run[-1]
+    version = Version(sequential=sequential)
+    version.encode(document, base)
+    (Version.update(period=peewee.fn.tstzrange(run[0][2],
+                                               peewee.fn.upper(Version.period)),
+                    stored=version.stored, snapshot=version.snapshot)
+            .where(Version.pk == pk)
+            .execute())
+    return [item[0] for item in run[:-1]]
@@ -9,12 +9,15 @@ from importlib import import_module
 from pathlib import Path
 
 import decorator
+import peewee
 from progressist import ProgressBar
 
 from ban.auth.models import Session, Client, User
+from ban.db import database
 from ban.db.model import SelectQuery
 from ban.core import context, config
-from ban.core.versioning import Diff
+from ban.core.validators import ResourceValidator
+from ban.core.versioning import Diff, ForcedVersionError
 
 
 def load_commands():
@@ -63,6 +66,11 @@ class Bar(ProgressBar):
                 '| ETA: {eta} | {elapsed}')
 
 
+def init_worker():
+    # Connections inherited from the main process must not be shared.
+    database.after_fork()
+
+
 def collect_report(func, chunk):
     # This is a process reporter instance.
     reporter = context.get('reporter')
@@ -109,7 +117,7 @@ def batch(func, iterable, chunksize=1000, total=None, progress=True):
     bar = Bar(total=total, throttle=timedelta(seconds=1))
     workers = int(config.get('WORKERS', os.cpu_count()))
 
-    with ChunkedPool(processes=workers) as pool:
+    with ChunkedPool(processes=workers, initializer=init_worker) as pool:
         try:
             for results, reports in pool.imap_unordered(func, iterable, chunksize):
                 reporter.merge(reports)
@@ -121,6 +129,73 @@ def batch(func, iterable, chunksize=1000, total=None, progress=True):
             pool.terminate()
 
 
+class BulkSaver:
+    """Save the validators of a batch of rows with a few
+    ResourceValidator.bulk_save calls.
+
+    The pending validators are saved before a row of another kind, or
+    claiming a key of a pending row, is processed: the lookups of a row see
+    the resources of the previous ones. If a bulk save fails, its validators
+    are saved again one by one, for each error to be reported on its row.
+    """
+
+    def __init__(self):
+        self.kind = None
+        self.keys = set()
+        self.pending = []
+
+    def claim(self, kind, keys):
+        keys = set(keys)
+        if kind != self.kind or keys & self.keys:
+            self.flush()
+        self.kind = kind
+        self.keys |= keys
+
+    def add(self, validator, save, saved):
+        """`save` saves `validator` alone and reports the outcome, `saved`
+        reports its bulk save."""
+        self.pending.append((validator, save, saved))
+
+    def flush(self):
+        pending, self.pending, self.keys = self.pending, [], set()
+        if not pending:
+            return
+        validators = [validator for validator, save, saved in pending]
+        # The bulk save patches the instances (fields, version, pk…): keep
+        # their state, for the retry to start from the same one.
+        states = [self.snapshot(v.instance) for v in validators]
+        try:
+            with database.atomic():
+                ResourceValidator.bulk_save(validators)
+        except (peewee.IntegrityError, ForcedVersionError):
+            for validator, state in zip(validators, states):
+                self.restore(validator, state)
+            for validator, save, saved in pending:
+                save()
+        else:
+            for validator, save, saved in pending:
+                saved()
+
+    @staticmethod
+    def snapshot(instance):
+        if instance is None:
+            return None
+        state = dict(instance.__dict__)
+        for name in ('_data', '_dirty', '_obj_cache'):
+            state[name] = state[name].copy()
+        return instance, state
+
+    @staticmethod
+    def restore(validator, snapshot):
+        if snapshot is None:
+            validator.instance = None
+            return
+        instance, state = snapshot
+        instance.__dict__.clear()
+        instance.__dict__.update(state)
+        validator.instance = instance
+
+
 def prompt(text, default=..., confirmation=False, coerce=None, hidden=False):
     """Prompts a user for input.  This is a convenience function that can
     be used to prompt a user for input later.
@@ -7,6 +7,7 @@ from ban.core.models import (Group, HouseNumber, Municipality, Position,
                              PostCode)
 from ban.db import database
 from ban.core import context
+from ban.core.versioning import ForcedVersionError
 from ban.http.auth import auth
 
 from . import helpers
@@ -42,39 +43,72 @@ def init(clientname, contributor_type, *paths, limit=0, **kwargs):
         all(helpers.batch(process_rows, rows, chunksize=100, total=total))
 
 
+# Row values a row is looked up by, for each kind.
+KEYS = {
+    'municipality': [('insee', )],
+    'group': [('fantoir', ), ('ign', ), ('laposte', )],
+    'postcode': [('postcode', 'complement', 'municipality:insee')],
+    'housenumber': [('cia', ), ('ign', ), ('laposte', ),
+                    ('group:fantoir', 'group:ign', 'group:laposte', 'numero',
+                     'ordinal')],
+    'position': [('ign', )],
+}
+
+
 @helpers.session_client
 def process_rows(*rows):
+    saver = helpers.BulkSaver()
     with database.atomic():
         for row in rows:
-            process_row(row)
+            kind = row.get('type')
+            keys = [(names, tuple(row.get(name) for name in names))
+                    for names in KEYS.get(kind, [])]
+            saver.claim(kind, [key for key in keys if any(key[1])])
+            process_row(row, saver)
+        saver.flush()
     return rows
 
 
-def process_row(row):
+def process_row(row, saver=None):
     kind = row.pop('type')
     if kind == "municipality":
-        return process_municipality(row)
+        return process_municipality(row, saver)
     elif kind == "group":
-        return process_group(row)
+        return process_group(row, saver)
     elif kind == "postcode":
-        return process_postcode(row)
+        return process_postcode(row, saver)
     elif kind == "housenumber":
-        return process_housenumber(row)
+        return process_housenumber(row, saver)
     elif kind == "position":
-        return process_position(row)
+        return process_position(row, saver)
     else:
         return reporter.error('Missing "type" key', row)
 
 
-def process_municipality(row):
+def commit(saver, validator, save, saved):
+    """Save `validator` now, or with the other rows of `saver` if any."""
+    if saver is None:
+        save()
+    else:
+        saver.add(validator, save, saved)
+
+
+def process_municipality(row, saver=None):
     source = row.get('source')
     if source:
         row['attributes'] = {'source': row.pop('source')}
     validator = Municipality.validator(**row)
     if validator.errors:
         return reporter.error('Municipality errors', validator.errors)
-    validator.save()
-    reporter.notice('Imported Municipality', row['insee'])
+
+    def save():
+        validator.save()
+        saved()
+
+    def saved():
+        reporter.notice('Imported Municipality', row['insee'])
+
+    commit(saver, validator, save, saved)
 
 
 def populate(keys, source, dest):
@@ -88,7 +122,7 @@ def populate(keys, source, dest):
             dest[dest_key] = source[key]
 
 
-def process_group(row):
+def process_group(row, saver=None):
     data = dict(version=1)
     keys = ['name', ('group', 'kind'), 'laposte', 'ign', 'fantoir', 'alias']
     populate(keys, row, data)
@@ -129,18 +163,24 @@ def process_group(row):
         update = True
     validator = Group.validator(instance=instance, update=update, **data)
     if validator.errors:
-        reporter.error('Invalid group data', (validator.errors, row))
-    else:
+        return reporter.error('Invalid group data', (validator.errors, row))
+
+    def save():
         try:
             validator.save()
-        except peewee.IntegrityError:
+        except (peewee.IntegrityError, ForcedVersionError):
             reporter.error('Integrity Error', fantoir)
         else:
-            msg = 'Group updated' if instance else 'Group created'
-            reporter.notice(msg, fantoir)
+            saved()
 
+    def saved():
+        msg = 'Group updated' if instance else 'Group created'
+        reporter.notice(msg, fantoir)
 
-def process_postcode(row):
+    commit(saver, validator, save, saved)
+
+
+def process_postcode(row, saver=None):
     insee = row['municipality:insee']
     municipality = 'insee:{}'.format(insee)
     source = row.get('source')
@@ -162,11 +202,18 @@ def process_postcode(row):
     if validator.errors:
         return reporter.error('PostCode errors', (validator.errors,
                                                   code, insee))
-    validator.save()
-    reporter.notice('Imported PostCode', code)
 
+    def save():
+        validator.save()
+        saved()
+
+    def saved():
+        reporter.notice('Imported PostCode', code)
 
-def process_housenumber(row):
+    commit(saver, validator, save, saved)
+
+
+def process_housenumber(row, saver=None):
     data = dict(version=1)
     keys = [('numero', 'number'), 'ordinal', 'ign', 'laposte', 'cia']
     populate(keys, row, data)
@@ -246,17 +293,24 @@ def process_housenumber(row):
     if validator.errors:
         reporter.error('HouseNumber errors', (validator.errors, data))
         return
-    with HouseNumber._meta.database.atomic():
-        try:
-            validator.save()
-        except peewee.IntegrityError as e:
-            reporter.warning('HouseNumber DB error', (data, str(e)))
-        else:
-            msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
-            reporter.notice(msg, data)
 
+    def save():
+        with HouseNumber._meta.database.atomic():
+            try:
+                validator.save()
+            except (peewee.IntegrityError, ForcedVersionError) as e:
+                reporter.warning('HouseNumber DB error', (data, str(e)))
+            else:
+                saved()
+
+    def saved():
+        msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
+        reporter.notice(msg, data)
+
+    commit(saver, validator, save, saved)
 
-def process_position(row):
+
+def process_position(row, saver=None):
     positioning = row.get('positioning')  
     if not positioning or not hasattr(Position, positioning.upper()):
         positioning = Position.OTHER
@@ -293,12 +347,18 @@ def process_position(row):
     validator = Position.validator(instance=instance, update=bool(instance),
                                    **data)
     if validator.errors:
-        reporter.error('Position error', validator.errors)
-    else:
+        return reporter.error('Position error', validator.errors)
+
+    def save():
         try:
-            position = validator.save()
-        except peewee.IntegrityError as e:
+            validator.save()
+        except (peewee.IntegrityError, ForcedVersionError) as e:
             reporter.error('Integrity error', (str(e), data))
         else:
-            msg = 'Position updated' if instance else 'Position created'
-            reporter.notice(msg, position.id)
+            saved()
+
+    def saved():
+        msg = 'Position updated' if instance else 'Position created'
+        reporter.notice(msg, validator.instance.id)
+
+    commit(saver, validator, save, saved)
@@ -1,6 +1,7 @@
 from ban.commands import command, reporter
 from ban.core import models
 from ban.core import versioning
+from ban.core.validators import ResourceValidator
 from . import helpers
 
 
@@ -96,6 +97,7 @@ def group_to_municipality(destination, source, areas, label):
             # Check the Group is not one created by the validator above
             if group not in areas:
                 move_group(destination, group)
+                validators = []
                 for housenumber in group.housenumber_set:
                     validator = models.HouseNumber.validator(
                         instance=housenumber,
@@ -105,11 +107,13 @@ def group_to_municipality(destination, source, areas, label):
                     if validator.errors:
                         reporter.error('Errors', housenumber)
                     else:
-                        validator.save()
-                        reporter.notice('Ancestor redirected', housenumber)
+                        validators.append(validator)
+                for housenumber in ResourceValidator.bulk_save(validators):
+                    reporter.notice('Ancestor redirected', housenumber)
 
 
 def process_postcode(destination, source, label):
+    validators = []
     for postcode in source.postcodes:
         if postcode.complement is None:
             validator = models.PostCode.validator(
@@ -130,8 +134,9 @@ def process_postcode(destination, source, label):
         if validator.errors:
             reporter.error('Errors', validator)
         else:
-            validator.save()
-            reporter.notice('Label and municipality modified', postcode)
+            validators.append(validator)
+    for postcode in ResourceValidator.bulk_save(validators):
+        reporter.notice('Label and municipality modified', postcode)
 
 
 def move_group(destination, group):
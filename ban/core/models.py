@@ -5,6 +5,7 @@ from unidecode import unidecode
 from werkzeug.utils import cached_property
 
 from ban import db
+from ban.db import names, prefetch
 from ban.utils import compute_cia
 from .versioning import Versioned, BaseVersioned, Version
 from .resource import ResourceModel, BaseResource
@@ -38,12 +39,62 @@ class Model(ResourceModel, Versioned, metaclass=BaseModel):
 
 
 class NamedModel(Model):
+    readonly_fields = Model.readonly_fields + ['name_normalized',
+                                               'alias_normalized']
+
     name = db.NameField(max_length=200)
     alias = db.ArrayField(db.CharField, default=[], null=True)
+    # Searchable forms of name and alias (see db.names.simplify), indexed by
+    # trigrams.
+    name_normalized = db.TextField(null=True)
+    alias_normalized = db.TextField(null=True)
 
     def __str__(self):
         return self.name
 
+    @property
+    def score(self):
+        """Relevance for a ranked name search, if selected."""
+        return getattr(self, '_score', None)
+
+    @score.setter
+    def score(self, value):
+        self._score = value
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def _bulk_save(cls, instances):
+        for instance in instances:
+            instance.normalize()
+        return super()._bulk_save(instances)
+
+    def normalize(self):
+        self.name_normalized = names.simplify(self.name)
+        self.alias_normalized = names.ALIAS_SEPARATOR.join(
+            names.simplify(alias) for alias in self.alias or [])
+
+    @classmethod
+    def _create_indexes(cls):
+        super()._create_indexes()
+        cls.create_trigram_indexes()
+
+    @classmethod
+    def create_trigram_indexes(cls):
+        """Idempotent, so existing databases can get them too. The rows not
+        normalized yet, searched apart, get their own (partial) index."""
+        for column in ('name_normalized', 'alias_normalized'):
+            cls._meta.database.execute_sql(
+                'CREATE INDEX IF NOT EXISTS "{table}_{column}_trgm" '
+                'ON "{table}" USING gin ({column} gin_trgm_ops)'.format(
+                    table=cls._meta.db_table, column=column))
+            cls._meta.database.execute_sql(
+                'CREATE INDEX IF NOT EXISTS "{table}_{column}_null" '
+                'ON "{table}" (pk) WHERE {column} IS NULL'.format(
+                    table=cls._meta.db_table, column=column))
+
 
 class Municipality(NamedModel):
     INSEE_FORMAT = '(2[AB]|\d{2})\d{3}'
@@ -100,7 +151,22 @@ class Group(NamedModel):
     )
     identifiers = ['fantoir', 'laposte', 'ign']
     resource_fields = ['name', 'alias', 'fantoir', 'municipality', 'kind',
-                       'laposte', 'ign', 'addressing']
+                       'laposte', 'ign', 'addressing', 'extent', 'centroid']
+    readonly_fields = NamedModel.readonly_fields + ['extent', 'centroid']
+    # Computed from the positions, see refresh_extents.
+    exclude_for_version = ['extent', 'centroid']
+    EXTENT_SQL = """UPDATE "group" SET extent = e.extent,
+                                       centroid = e.centroid
+        FROM (SELECT g.pk, ST_Envelope(ST_Collect(p.center)) AS extent,
+                     ST_Centroid(ST_Collect(p.center)) AS centroid
+              FROM "group" AS g
+              LEFT JOIN housenumber AS h
+                ON (h.parent_id = g.pk AND h.deleted_at IS NULL)
+              LEFT JOIN position AS p
+                ON (p.housenumber_id = h.pk AND p.deleted_at IS NULL)
+              WHERE {where}
+              GROUP BY g.pk) AS e
+        WHERE "group".pk = e.pk"""
 
     kind = db.CharField(max_length=64, choices=KIND)
     addressing = db.CharField(max_length=16, choices=ADDRESSING, null=True)
@@ -109,7 +175,26 @@ class Group(NamedModel):
     ign = db.CharField(max_length=24, null=True, unique=True)
     municipality = db.CachedForeignKeyField(Municipality,
                                             related_name='groups')
+    extent = db.ExtentField(null=True, index=True)
+    centroid = db.PointField(null=True, index=True)
 
+    @classmethod
+    def refresh_extents(cls, groups=None):
+        """Compute again extent and centroid from the positions of `groups`
+        (pks, or a query selecting them), or of all groups if None."""
+        if groups is None:
+            where, params = 'TRUE', []
+        elif isinstance(groups, peewee.SelectQuery):
+            sql, params = groups.sql()
+            where = 'g.pk IN ({})'.format(sql)
+        else:
+            groups = [pk for pk in set(groups) if pk is not None]
+            if not groups:
+                return
+            where = 'g.pk IN ({})'.format(', '.join(['%s'] * len(groups)))
+            params = groups
+        cls._meta.database.execute_sql(cls.EXTENT_SQL.format(where=where),
+                                       params)
 
     @property
     def housenumbers(self):
@@ -146,11 +231,56 @@ class HouseNumber(Model):
     def __str__(self):
         return ' '.join([self.number or '', self.ordinal or ''])
 
+    # Changes that move the positions of a housenumber in or out a group.
+    EXTENT_FIELDS = {'parent', 'deleted_at'}
+
     def save(self, *args, **kwargs):
         self.cia = self.compute_cia()
-        super().save(*args, **kwargs)
+        groups = []
+        # A new housenumber has no position yet.
+        if self.pk is not None and self.EXTENT_FIELDS & self._dirty:
+            groups.append(self._data.get('parent'))
+        if self.pk is not None and 'parent' in self._dirty:
+            # The former parent loses this housenumber positions.
+            groups.append(HouseNumber.select(HouseNumber.parent)
+                                     .where(HouseNumber.pk == self.pk)
+                                     .scalar())
+        with self._meta.database.atomic():
+            super().save(*args, **kwargs)
+            Group.refresh_extents(groups)
         self._clean_called = False
 
+    def delete_instance(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            rows = super().delete_instance(*args, **kwargs)
+            Group.refresh_extents([self._data.get('parent')])
+        return rows
+
+    @classmethod
+    def _bulk_save(cls, instances):
+        instances = list(instances)
+        groups = []
+        moved = []
+        cls.prefetch_insee(instances)
+        for instance in instances:
+            instance.cia = instance.compute_cia()
+            if instance.pk is None:
+                continue
+            if cls.EXTENT_FIELDS & instance._dirty:
+                groups.append(instance._data.get('parent'))
+            if 'parent' in instance._dirty:
+                moved.append(instance.pk)
+        if moved:
+            # The former parents lose these housenumbers positions.
+            query = cls.select(cls.parent).where(cls.pk << moved).tuples()
+            groups.extend(parent for parent, in query)
+        with cls._meta.database.atomic():
+            super()._bulk_save(instances)
+            Group.refresh_extents(groups)
+        for instance in instances:
+            instance._clean_called = False
+        return instances
+
     def compute_cia(self):
         return compute_cia(self.parent.fantoir[:5],
                            self.parent.fantoir[5:],
@@ -161,6 +291,15 @@ class HouseNumber(Model):
         return Municipality.select().where(
            Municipality.pk == self.parent.municipality.pk).first()
 
+    def get_insee(self):
+        # The group municipality comes from the cache, no need to query it.
+        return self.parent.municipality.insee
+
+    @classmethod
+    def prefetch_insee(cls, instances):
+        # Also what compute_cia needs.
+        Group.prefetch_insee(prefetch.foreign_key(instances, cls.parent))
+
     @property
     def as_export(self):
         """Resources plus relation references without metadata."""
@@ -243,6 +382,59 @@ class Position(Model):
     def municipality(self):
         return Municipality.select().where(Municipality.pk == self.housenumber.parent.municipality.pk).first()
 
+    def get_insee(self):
+        return self.housenumber.get_insee()
+
+    @classmethod
+    def prefetch_insee(cls, instances):
+        HouseNumber.prefetch_insee(
+            prefetch.foreign_key(instances, cls.housenumber))
+
+    # Changes that alter the extent of the group of a position.
+    EXTENT_FIELDS = {'center', 'housenumber', 'deleted_at'}
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        housenumbers = []
+        if self.pk is None or self.EXTENT_FIELDS & self._dirty:
+            housenumbers.append(self._data.get('housenumber'))
+        if self.pk is not None and 'housenumber' in self._dirty:
+            housenumbers.append(Position.select(Position.housenumber)
+                                        .where(Position.pk == self.pk)
+                                        .scalar())
+        with self._meta.database.atomic():
+            super().save(*args, **kwargs)
+            self.refresh_extents(housenumbers)
         self._clean_called = False
+
+    def delete_instance(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            rows = super().delete_instance(*args, **kwargs)
+            self.refresh_extents([self._data.get('housenumber')])
+        return rows
+
+    @staticmethod
+    def refresh_extents(housenumbers):
+        """Refresh the extent of the groups of `housenumbers` (pks)."""
+        housenumbers = [pk for pk in set(housenumbers) if pk is not None]
+        if housenumbers:
+            Group.refresh_extents(
+                HouseNumber.select(HouseNumber.parent)
+                           .where(HouseNumber.pk << housenumbers))
+
+    @classmethod
+    def _bulk_save(cls, instances):
+        instances = list(instances)
+        housenumbers = [i._data.get('housenumber') for i in instances
+                        if i.pk is None or cls.EXTENT_FIELDS & i._dirty]
+        moved = [i.pk for i in instances
+                 if i.pk is not None and 'housenumber' in i._dirty]
+        if moved:
+            query = (cls.select(cls.housenumber).where(cls.pk << moved)
+                        .tuples())
+            housenumbers.extend(housenumber for housenumber, in query)
+        with cls._meta.database.atomic():
+            super()._bulk_save(instances)
+            cls.refresh_extents(housenumbers)
+        for instance in instances:
+            instance._clean_called = False
+        return instances
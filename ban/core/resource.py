@@ -1,10 +1,12 @@
 from datetime import datetime
+from functools import lru_cache
 import uuid
 
 import peewee
 from postgis import Point
 
 from ban import db
+from ban.db import prefetch
 from ban.utils import utcnow
 
 
@@ -14,6 +16,33 @@ from .exceptions import (IsDeletedError, MultipleRedirectsError, RedirectError,
 from .validators import ResourceValidator
 
 
+# Masks come from the clients: only keep the last used serializers.
+SERIALIZERS_SIZE = 256
+
+
+def freeze_mask(mask):
+    """Hashable version of a serialization mask."""
+    return tuple(sorted((k, freeze_mask(v)) for k, v in mask.items()))
+
+
+def thaw_mask(frozen):
+    return {k: thaw_mask(v) for k, v in frozen}
+
+
+@lru_cache(maxsize=SERIALIZERS_SIZE)
+def compiled_serializer(model, frozen):
+    return model.compile_serializer(thaw_mask(frozen))
+
+
+def convert(value):
+    """Generic conversion, for attributes whose type is not known upfront."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, Point):
+        return value.geojson
+    return value
+
+
 class BaseResource(peewee.BaseModel):
 
     def include_field_for_collection(cls, name):
@@ -52,6 +81,86 @@ class BaseResource(peewee.BaseModel):
             if n not in cls.exclude_for_version]
         return cls
 
+    def serializer(cls, mask):
+        """Return the function serializing `cls` instances with `mask`,
+        compiled once per mask (among the SERIALIZERS_SIZE last used)."""
+        return compiled_serializer(cls, freeze_mask(mask))
+
+    def mask_versions(cls, instance, mask):
+        """Version of `instance`, then one entry per relation loaded with
+        the versions of the rows `serialize(mask)` embeds, which its
+        representation only changes with. None if it outputs fields
+        changing without a new version."""
+        if '*' in mask:
+            mask = {k: mask['*'] for k in cls.resource_fields}
+        versions = [(instance.id, getattr(instance, 'version', None))]
+        for name, subfields in sorted(mask.items()):
+            field = getattr(cls, name, None)
+            if isinstance(field, (peewee.ReverseRelationDescriptor,
+                                  db.ManyToManyField)):
+                related = getattr(instance, name)
+            elif isinstance(field, db.ForeignKeyField) and subfields:
+                # References only hold the id, which is versioned.
+                target = cls.select(field).where(cls.pk == instance.pk)
+                related = field.rel_model.select().where(
+                    field.to_field << target)
+            elif name in cls.versioned_fields:
+                continue
+            else:
+                return None
+            model = related.model_class
+            if not hasattr(model, 'version'):
+                return None
+            rows = []
+            for obj in related:
+                nested = model.mask_versions(obj, subfields)
+                if nested is None:
+                    return None
+                rows.append(nested)
+            versions.append((name, sorted(rows, key=str)))
+        return versions
+
+    def compile_serializer(cls, mask):
+        if '*' in mask:
+            mask = {k: mask['*'] for k in cls.resource_fields}
+        # Resolve each field converter once. Keys are sorted when encoding
+        # the response, with the envelope and nested plain dicts.
+        converters = []
+        for name in mask:
+            field = getattr(cls, name, None)
+            if not field:
+                raise ValueError('Unknown field {}'.format(name))
+            converters.append((name, cls.converter(field, mask[name])))
+
+        def serialize(instance):
+            prefetched = getattr(instance, '_prefetched', {})
+            dest = {}
+            for name, converter in converters:
+                value = prefetched.get(name)
+                if value is None:
+                    value = getattr(instance, name)
+                if value is not None and converter is not None:
+                    value = converter(value)
+                dest[name] = value
+            return dest
+
+        return serialize
+
+    def converter(cls, field, subfields):
+        if isinstance(field, (db.ManyToManyField,
+                              peewee.ReverseRelationDescriptor)):
+            return lambda value: [v.serialize(subfields) for v in value]
+        elif isinstance(field, db.ForeignKeyField):
+            return lambda value: value.serialize(subfields)
+        elif isinstance(field, (db.PointField, db.ExtentField)):
+            return lambda value: value.geojson
+        elif isinstance(field, db.DateTimeField):
+            return lambda value: value.isoformat()
+        elif isinstance(field, peewee.Field):
+            return None  # Already JSON compliant.
+        # Properties and such.
+        return convert
+
 
 class ResourceModel(db.Model, metaclass=BaseResource):
     resource_fields = ['id', 'status']
@@ -75,6 +184,13 @@ class ResourceModel(db.Model, metaclass=BaseResource):
             self.id = self.make_id()
         return super().save(*args, **kwargs)
 
+    @classmethod
+    def _bulk_save(cls, instances):
+        for instance in instances:
+            if not instance.id:
+                instance.id = instance.make_id()
+        return super()._bulk_save(instances)
+
     @classmethod
     def validator(cls, instance=None, update=False, **data):
         validator = cls._meta.validator(cls, update=update)
@@ -92,27 +208,29 @@ class ResourceModel(db.Model, metaclass=BaseResource):
     def serialize(self, mask=None):
         if not mask:
             return self.serialized
-        dest = {}
+        return self.__class__.serializer(mask)(self)
+
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        """Load the relations needed by `serialize(mask)` level by level,
+        with one query per relation for the whole `instances` batch."""
+        if not instances or not mask:
+            return
+        if '*' in mask:
+            # Same as in serialize.
+            mask = {k: mask['*'] for k in cls.resource_fields}
         for name, subfields in mask.items():
-            if name == '*':
-                return self.serialize({k: subfields
-                                       for k in self.resource_fields})
-            field = getattr(self.__class__, name, None)
-            if not field:
-                raise ValueError('Unknown field {}'.format(name))
-            value = getattr(self, name)
-            if value is not None:
-                if isinstance(field, (db.ManyToManyField,
-                                      peewee.ReverseRelationDescriptor)):
-                    value = [v.serialize(subfields) for v in value]
-                elif isinstance(field, db.ForeignKeyField):
-                    value = value.serialize(subfields)
-                elif isinstance(value, datetime):
-                    value = value.isoformat()
-                elif isinstance(value, Point):
-                    value = value.geojson
-            dest[name] = value
-        return dest
+            field = getattr(cls, name, None)
+            if isinstance(field, db.ManyToManyField):
+                related = prefetch.many_to_many(instances, field, name)
+            elif isinstance(field, peewee.ReverseRelationDescriptor):
+                related = prefetch.reverse_relation(instances, field, name)
+            elif isinstance(field, db.ForeignKeyField):
+                related = prefetch.foreign_key(instances, field)
+            else:
+                continue
+            if related:
+                related[0].prefetch_related(related, subfields)
 
     @property
     def as_resource(self):
@@ -160,7 +278,7 @@ class ResourceModel(db.Model, metaclass=BaseResource):
                     'Resource still linked by `{}`'.format(name))
 
     @classmethod
-    def coerce(cls, id, identifier=None, level1=0):
+    def coerce(cls, id, identifier=None, level1=0, selection=None):
 
         if isinstance(id, db.Model):
             instance = id
@@ -182,7 +300,7 @@ class ResourceModel(db.Model, metaclass=BaseResource):
                     instance = cls.raw_select(cls._meta.model_class.pk).where(
                         getattr(cls, identifier) == id).get()
                 else:
-                    instance = cls.raw_select().where(
+                    instance = cls.raw_select(*(selection or [])).where(
                         getattr(cls, identifier) == id).get()
 
             except cls.DoesNotExist:
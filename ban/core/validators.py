@@ -149,8 +149,17 @@ class ResourceValidator:
                 for name in names:
                     self.error(name, msg)
 
-    def patch(self):
+    def patch(self, m2m=None):
         for key, value in self.data.items():
+            self.set(key, value, m2m)
+
+    def set(self, key, value, m2m=None):
+        # Setting a m2m on a saved instance writes it at once: collect them
+        # in `m2m` when given, for the caller to set them after the save.
+        if m2m is not None and isinstance(getattr(self.model, key),
+                                          db.ManyToManyField):
+            m2m[key] = value
+        else:
             setattr(self.instance, key, value)
 
     def save(self):
@@ -163,20 +172,64 @@ class ResourceValidator:
                 self.instance.save()
         else:
             with database.atomic():
-                m2m = {}
-                data = {}
-                for key, value in self.data.items():
-                    field = getattr(self.model, key)
-                    if isinstance(field, db.ManyToManyField):
-                        m2m[key] = value
-                    else:
-                        data[key] = value
+                data, m2m = self.split_many_to_many()
                 self.instance = self.model.create(**data)
                 # m2m need the instance to be saved.
                 for key, value in m2m.items():
                     setattr(self.instance, key, value)
         return self.instance
 
+    def split_many_to_many(self):
+        m2m = {}
+        data = {}
+        for key, value in self.data.items():
+            field = getattr(self.model, key)
+            if isinstance(field, db.ManyToManyField):
+                m2m[key] = value
+            else:
+                data[key] = value
+        return data, m2m
+
+    @staticmethod
+    def bulk_save(validators):
+        """Save many validated documents at once, with one model
+        bulk_save by model (in order of first appearance): a document cannot
+        reference a resource created in the same call."""
+        if any(validator.errors for validator in validators):
+            raise ValueError('Invalid document')
+        if not validators:
+            return []
+        models = []
+        instances = []
+        updated = []
+        created = []
+        with validators[0].model._meta.database.atomic():
+            for validator in validators:
+                if validator.instance:
+                    relations = {}
+                    validator.patch(relations)
+                    updated.append((validator.instance, relations))
+                else:
+                    data, relations = validator.split_many_to_many()
+                    validator.instance = validator.model(**data)
+                    created.append((validator.instance, relations))
+                if validator.model not in models:
+                    models.append(validator.model)
+                instances.append(validator.instance)
+            # Written once every document is patched and before the versions
+            # are stored, rolled back with the rest if the save fails.
+            for instance, relations in updated:
+                for key, value in relations.items():
+                    setattr(instance, key, value)
+            for model in models:
+                model.bulk_save([i for i in instances
+                                 if i.__class__ is model])
+            # m2m need the instances to be saved.
+            for instance, relations in created:
+                for key, value in relations.items():
+                    setattr(instance, key, value)
+        return instances
+
 
 class VersionedResourceValidator(ResourceValidator):
 
@@ -186,7 +239,7 @@ class VersionedResourceValidator(ResourceValidator):
             data['version'] = 1
         return super().validate(data, instance)
 
-    def patch(self):
+    def patch(self, m2m=None):
         # Let's try to be smart and patch object if claimed version does not
         # match with expected but not conflict is detected.
         claimed_version = max(1, self.data.get('version', 1))
@@ -203,7 +256,7 @@ class VersionedResourceValidator(ResourceValidator):
             conflict = any(k in protected for k in diff.keys())
             if not conflict:
                 for key in diff.keys():
-                    setattr(self.instance, key, self.data.get(key))
+                    self.set(key, self.data.get(key), m2m)
                 self.instance.increment_version()
                 return
-        super().patch()
+        super().patch(m2m)
@@ -5,9 +5,10 @@ import peewee
 
 from ban import db
 from ban.auth.models import Client, Session
-from ban.utils import make_diff, utcnow
+from ban.db import prefetch
+from ban.utils import apply_delta, make_delta, make_diff, utcnow
 
-from . import context, resource
+from . import config, context, resource
 from .exceptions import (IsDeletedError, MultipleRedirectsError, RedirectError)
 
 
@@ -34,6 +35,10 @@ class ForcedVersionError(Exception):
     pass
 
 
+class MissingSnapshotError(Exception):
+    pass
+
+
 class BaseVersioned(peewee.BaseModel):
 
     registry = {}
@@ -67,20 +72,33 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         self.prepared()
 
     def store_version(self):
-        new = Version.create(
+        """Record the current state as a new version, and as a Diff from
+        the previous one."""
+        old = None
+        if self.version > 1:
+            old = Version.close(self.resource, self.pk, self.version - 1,
+                                self.modified_at)
+        new = Version(
             model_name=self.resource,
             model_pk=self.pk,
             sequential=self.version,
-            data=self.as_version,
             period=[self.modified_at, None]
         )
-        old = None
-        if self.version > 1:
-            old = self.load_version(self.version - 1)
-            old.close_period(new.period.lower)
+        new.encode(self.as_version, old.data if old else None)
+        new.save(force_insert=True)
         if Diff.ACTIVE:
             Diff.create(old=old, new=new, created_at=self.modified_at,
-                        insee=self.municipality.insee)
+                        insee=self.get_insee())
+
+    def get_insee(self):
+        return self.municipality.insee
+
+    @classmethod
+    def prefetch_insee(cls, instances):
+        """Load at once what `get_insee` needs for all `instances`."""
+        field = cls._meta.fields.get('municipality')
+        if isinstance(field, peewee.ForeignKeyField):
+            prefetch.foreign_key(instances, field)
 
     @property
     def versions(self):
@@ -120,13 +138,13 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         if self.version != self.locked_version + 1:
             raise ForcedVersionError('wrong version number: {}'.format(self.version))  # noqa
 
-    def update_meta(self):
+    def update_meta(self, now=None):
         session = context.get('session')
         if session:
             if not self.created_by:
                 self.created_by = session
             self.modified_by = session
-        now = utcnow()
+        now = now or utcnow()
         if not self.created_at:
             self.created_at = now
         self.modified_at = now
@@ -143,12 +161,81 @@ class Versioned(db.Model, metaclass=BaseVersioned):
             self.store_version()
             self.lock_version()
 
+    @classmethod
+    def _bulk_save(cls, instances):
+        """Save many instances of this model with a few multi-row
+        statements, whatever their number: same checks, versions, diffs and
+        redirects as `save`."""
+        instances = list(instances)
+        if not instances:
+            return instances
+        now = utcnow()
+        # Not to load them one instance at a time below.
+        prefetch.foreign_key(instances, cls.created_by)
+        cls.prefetch_insee(instances)
+        with cls._meta.database.atomic():
+            for instance in instances:
+                instance.check_version()
+                instance.update_meta(now)
+                try:
+                    instance.source_kind = (instance.created_by
+                                                    .contributor_type)
+                except Exception:
+                    pass
+            super()._bulk_save(instances)
+            cls.bulk_store_versions(instances, now)
+            for instance in instances:
+                instance.lock_version()
+        return instances
+
+    @classmethod
+    def bulk_store_versions(cls, instances, now):
+        olds = Version.close_many(
+            cls.__name__.lower(),
+            [(i.pk, i.version - 1) for i in instances if i.version > 1], now)
+        Version.rebuild(list(olds.values()))
+        news = []
+        for instance in instances:
+            new = Version(
+                model_name=instance.resource,
+                model_pk=instance.pk,
+                sequential=instance.version,
+                period=[now, None]
+            )
+            old = olds.get(instance.pk)
+            new.encode(instance.as_version, old.data if old else None)
+            news.append(new)
+        Version.bulk_save(news)
+        if Diff.ACTIVE:
+            Diff.bulk_save([Diff(old=olds.get(instance.pk), new=new,
+                                 created_at=now, insee=instance.get_insee())
+                            for instance, new in zip(instances, news)])
+
     def delete_instance(self, *args, **kwargs):
         with self._meta.database.atomic():
             Redirect.clear(self)
             return super().delete_instance(*args, **kwargs)
 
 
+# Documents of the versions [first, last] of each resource, from the last
+# snapshot up to them.
+REBUILD_SQL = """
+    SELECT v.model_pk, v.sequential, v.data, v.snapshot
+    FROM "{table}" AS v
+    JOIN unnest(%s::integer[], %s::integer[], %s::integer[])
+        AS t(pk, first, last) ON v.model_pk = t.pk
+    WHERE v.model_name = %s
+      AND v.sequential <= t.last
+      AND v.sequential >= COALESCE((
+        SELECT MAX(s.sequential) FROM "{table}" AS s
+        WHERE s.model_name = v.model_name AND s.model_pk = t.pk
+          AND s.snapshot AND s.sequential <= t.first), (
+        SELECT MIN(s.sequential) FROM "{table}" AS s
+        WHERE s.model_name = v.model_name AND s.model_pk = t.pk
+          AND s.snapshot AND s.sequential <= t.last))
+    ORDER BY v.model_pk, v.sequential"""
+
+
 class Version(db.Model):
 
     __openapi__ = """
@@ -165,7 +252,9 @@ class Version(db.Model):
     model_name = db.CharField(max_length=64)
     model_pk = db.IntegerField()
     sequential = db.IntegerField()
-    data = db.BinaryJSONField()
+    # The full document for a snapshot, only the changed keys otherwise.
+    stored = db.BinaryJSONField(db_column='data')
+    snapshot = db.BooleanField(default=True)
     period = db.DateRangeField()
 
     class Meta:
@@ -173,16 +262,136 @@ class Version(db.Model):
             (('model_name', 'model_pk', 'sequential'), True),
         )
 
+    @classmethod
+    def _create_indexes(cls):
+        super()._create_indexes()
+        cls.create_period_index()
+
+    @classmethod
+    def create_period_index(cls):
+        """For the collections as of a given date (needs btree_gist).
+        Idempotent, so existing databases can get it too."""
+        cls._meta.database.execute_sql(
+            'CREATE INDEX IF NOT EXISTS "{table}_model_name_period" '
+            'ON "{table}" USING gist (model_name, period)'.format(
+                table=cls._meta.db_table))
+
     def __repr__(self):
         return '<Version {} of {}({})>'.format(self.sequential,
                                                self.model_name, self.model_pk)
 
+    @staticmethod
+    def is_snapshot(sequential):
+        """Whether version `sequential` is stored in full: always, unless
+        VERSION_SNAPSHOT_INTERVAL is set, in which case one version every
+        VERSION_SNAPSHOT_INTERVAL is, and the others are stored as a delta
+        from the version before."""
+        interval = int(config.get('VERSION_SNAPSHOT_INTERVAL', 1))
+        return interval <= 1 or (sequential - 1) % interval == 0
+
+    def encode(self, document, previous=None):
+        """Store `document`, as a delta from `previous` (the document of the
+        version before) when this version is not a snapshot."""
+        if previous is None or self.is_snapshot(self.sequential):
+            self.stored, self.snapshot = document, True
+        else:
+            self.stored, self.snapshot = make_delta(previous, document), False
+        self._document = document
+
+    @property
+    def data(self):
+        if self.snapshot:
+            return self.stored
+        if getattr(self, '_document', None) is None:
+            Version.rebuild([self])
+        return self._document
+
+    @data.setter
+    def data(self, value):
+        self.encode(value)
+
+    @classmethod
+    def rebuild(cls, versions):
+        """Compute the documents of the delta `versions`, with one query by
+        model reading each resource from its closest snapshot. Raise
+        MissingSnapshotError for the versions without any snapshot before
+        them (their snapshot was deleted by hand)."""
+        pending = {}
+        for version in versions:
+            if (not version.snapshot
+                    and getattr(version, '_document', None) is None):
+                pending.setdefault(version.model_name, {}).setdefault(
+                    version.model_pk, []).append(version)
+        for model_name, resources in pending.items():
+            pks = list(resources)
+            firsts = [min(v.sequential for v in resources[pk]) for pk in pks]
+            lasts = [max(v.sequential for v in resources[pk]) for pk in pks]
+            cursor = cls._meta.database.execute_sql(
+                REBUILD_SQL.format(table=cls._meta.db_table),
+                (pks, firsts, lasts, model_name))
+            documents = {}
+            document = {}
+            for model_pk, sequential, stored, snapshot in cursor.fetchall():
+                document = stored if snapshot else apply_delta(document,
+                                                               stored)
+                documents[(model_pk, sequential)] = document
+            for model_pk, group in resources.items():
+                for version in group:
+                    try:
+                        version._document = documents[(model_pk,
+                                                       version.sequential)]
+                    except KeyError:
+                        raise MissingSnapshotError(
+                            'no snapshot to rebuild version {} of {}({})'
+                            .format(version.sequential, model_name,
+                                    model_pk))
+
+    @classmethod
+    def at(cls, model_name, moment, pks):
+        """Versions of the `model_name` resources whose pk is in `pks` (a
+        list or a subquery) that were current at `moment`, but of the
+        resources deleted by then."""
+        # Deltas only hold the status when it changes: look for it in the
+        # versions before.
+        status = peewee.fn.COALESCE(cls.stored['status'], peewee.Clause(
+            peewee.SQL('(SELECT v.data->>\'status\' FROM "{}" AS v '
+                       'WHERE v.model_name ='.format(cls._meta.db_table)),
+            cls.model_name,
+            peewee.SQL('AND v.model_pk ='), cls.model_pk,
+            peewee.SQL('AND v.sequential <'), cls.sequential,
+            peewee.SQL('AND v.data ? \'status\' '
+                       'ORDER BY v.sequential DESC LIMIT 1)')))
+        return (cls.select()
+                   .where(cls.model_name == model_name,
+                          cls.period.contains(moment),
+                          cls.model_pk << pks,
+                          status != 'deleted')
+                   .order_by(cls.model_pk))
+
+    def as_document(self, mask=None):
+        """The resource as it was in this version, restricted to the first
+        level keys of `mask`."""
+        if not mask or '*' in mask:
+            return self.data
+        return {key: value for key, value in self.data.items()
+                if key in mask}
+
     def serialize(self, *args):
+        flags = prefetch.get_prefetched(self, 'flags')
+        if flags is None:
+            flags = self.flags
         return {
             'data': self.data,
-            'flags': list(self.flags.serialize())
+            'flags': [flag.serialize() for flag in flags]
         }
 
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        cls.rebuild(instances)
+        flags = prefetch.reverse_relation(instances, cls.flags, 'flags')
+        if flags:
+            Flag.prefetch_related(flags)
+
     @property
     def model(self):
         return BaseVersioned.registry[self.model_name]
@@ -208,10 +417,29 @@ class Version(db.Model):
         Flag.delete().where(Flag.version == self,
                             Flag.client == session.client).execute()
 
-    def close_period(self, bound):
-        # DateTimeRange is immutable, so create new one.
-        self.period = [self.period.lower, bound]
-        self.save()
+    @classmethod
+    def close_many(cls, model_name, refs, bound):
+        """Close at `bound` the periods of the (model_pk, sequential)
+        versions in `refs`, and return them by model_pk."""
+        if not refs:
+            return {}
+        query = (cls.update(period=peewee.fn.tstzrange(
+                                peewee.fn.lower(cls.period), bound))
+                    .where(cls.model_name == model_name,
+                           peewee.Tuple(cls.model_pk, cls.sequential) << refs)
+                    .returning())
+        return {version.model_pk: version for version in query}
+
+    @classmethod
+    def close(cls, model_name, model_pk, sequential, bound):
+        """Close the period of a version at `bound`, and return it."""
+        query = (cls.update(period=peewee.fn.tstzrange(
+                                peewee.fn.lower(cls.period), bound))
+                    .where(cls.model_name == model_name,
+                           cls.model_pk == model_pk,
+                           cls.sequential == sequential)
+                    .returning())
+        return next(iter(query), None)
 
     @classmethod
     def raw_select(cls, *selection):
@@ -299,6 +527,24 @@ class Diff(db.Model):
         super().save(*args, **kwargs)
         Redirect.from_diff(self)
 
+    @classmethod
+    def _bulk_save(cls, instances):
+        for diff in instances:
+            if not diff.diff:
+                old = diff.old.data if diff.old else {}
+                new = diff.new.data if diff.new else {}
+                diff.diff = make_diff(old, new)
+        super()._bulk_save(instances)
+        for diff in instances:
+            Redirect.from_diff(diff)
+        return instances
+
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        versions = (prefetch.foreign_key(instances, cls.old)
+                    + prefetch.foreign_key(instances, cls.new))
+        Version.rebuild(versions)
+
     def serialize(self, *args):
         version = self.new or self.old
         return {
@@ -432,6 +678,10 @@ class Flag(db.Model):
             'by': self.session.contributor_type
         }
 
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        prefetch.foreign_key(instances, cls.session)
+
 
 class Anomaly(resource.ResourceModel):
 
@@ -1,3 +1,3 @@
 from .fields import *  # noqa
-from .model import Model, SelectQuery  # noqa
+from .model import Model, SelectQuery, serialize  # noqa
 from .connections import database  # noqa
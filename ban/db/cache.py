@@ -5,16 +5,138 @@ while we need peewee.Expression to be memoized.
 On the other hand, we want to select which SQL queries will be cached (i.e. not
 a goal to cache every get on housenumbers or positions), so we cannot just
 cache every SelectQuery.get neither every Model.get.
+
+Entries are evicted in LRU order once CACHE_SIZE is reached, and after
+CACHE_TTL seconds. Keys are namespaced by their first item (the model name for
+the relations cache), so invalidation can target one model or one row.
 """
+from collections import OrderedDict
+import threading
+import time
+
+from ban.core import config
 
-STORE = {}
 UNSET = ...
+SEPARATOR = '|'
+# Namespaces whose invalidations must be broadcast to the other processes.
+SHARED = set()
+
+
+class Store:
+
+    def __init__(self, maxsize=None, ttl=None, size_key='CACHE_SIZE',
+                 default_size=10000):
+        # Without maxsize, read from the `size_key` setting at each use, so
+        # it can be set after the store is created.
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self.size_key = size_key
+        self.default_size = default_size
+        self.data = OrderedDict()  # key: (expires, value)
+        self.namespaces = {}  # namespace: set of keys
+        self.lock = threading.RLock()
+        self.reset_stats()
+
+    @property
+    def maxsize(self):
+        return self._maxsize or int(config.get(self.size_key,
+                                               self.default_size))
+
+    @property
+    def ttl(self):
+        return self._ttl or float(config.get('CACHE_TTL', 3600))
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self)}
+
+    def get(self, key, default=UNSET):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                self._delete(key)
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is UNSET:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            namespace = key.split(SEPARATOR, 1)[0]
+            self.namespaces.setdefault(namespace, set()).add(key)
+            while len(self.data) > self.maxsize:
+                oldest = next(iter(self.data))
+                self._delete(oldest)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.data:
+                self._delete(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not UNSET
+
+    def __len__(self):
+        return len(self.data)
+
+    def _delete(self, key):
+        del self.data[key]
+        namespace = key.split(SEPARATOR, 1)[0]
+        keys = self.namespaces.get(namespace)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.namespaces[namespace]
+
+    def invalidate(self, namespace, *keys):
+        """Drop the `keys` of `namespace`, or the whole namespace if no key
+        is given."""
+        with self.lock:
+            if keys:
+                targets = [SEPARATOR.join(map(str, (namespace, ) + keys))]
+            else:
+                targets = list(self.namespaces.get(namespace, []))
+            for key in targets:
+                if key in self.data:
+                    self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.namespaces.clear()
+
+
+STORE = Store()
 
 
 def key(func):
     def wrapper(keys, *args, **kwargs):
         if isinstance(keys, (list, tuple)):
-            keys = '|'.join(map(str, keys))
+            keys = SEPARATOR.join(map(str, keys))
         return func(keys, *args, **kwargs)
     return wrapper
 
@@ -32,11 +154,19 @@ def set(key, value):
 @key
 def cache(key, func, *args, **kwargs):
     cached = get(key)
-    if cached == UNSET:
+    if cached is UNSET:
         cached = func(*args, **kwargs)
         set(key, cached)
     return cached
 
 
+def invalidate(namespace, *keys):
+    STORE.invalidate(namespace, *keys)
+
+
 def clear():
     STORE.clear()
+
+
+def stats():
+    return STORE.stats
@@ -1,34 +1,182 @@
-from playhouse.postgres_ext import PostgresqlExtDatabase
+import heapq
+import time
+
+from playhouse.pool import PooledDatabase, PooledPostgresqlExtDatabase
+from psycopg2 import extensions as pg_extensions
 from ban.core import config
 import postgis
 
 
-class DB(PostgresqlExtDatabase):
+class DB(PooledPostgresqlExtDatabase):
+    """Connections are kept in a per process pool, and handed to one thread
+    at a time by connect/close.
+
+    Configured by:
+    POOL_MIN_SIZE         connections opened upfront
+    POOL_MAX_SIZE         connections open at the same time
+    POOL_MAX_AGE          seconds before a connection is recycled
+    POOL_TIMEOUT          seconds to wait for a free connection
+    POOL_CHECK_INTERVAL   idle seconds after which a connection is pinged
+                          before being handed out
+    """
 
     prefix = ''
     postgis_registered = False
 
     def __init__(self):
         super().__init__(None, autorollback=True)
+        self._params = None
+        self._idle_since = {}
+        self.reset_stats()
 
     def connect(self):
         # Deal with connection kwargs at connect time only, because we want
         # to be able to instantiate the db object bedore patching the
         # connection kwargs: peewee instanciate it at python parse time, while
         # we want to set connection kwargs after parsing command line.
-        self.init(
-            self.prefix + config.DB_NAME,
+        params = (self.prefix + config.DB_NAME, self.connection_kwargs())
+        if params != self._params:
+            self.close_all()
+            name, kwargs = params
+            self.init(name,
+                      max_connections=config.get('POOL_MAX_SIZE', 20),
+                      stale_timeout=config.get('POOL_MAX_AGE', 3600),
+                      timeout=config.get('POOL_TIMEOUT', 10), **kwargs)
+            self._params = params
+        elif not self.is_closed():
+            conn = self.get_conn()
+            if self.is_healthy(self.conn_key(conn), conn):
+                # Keep it, and the transaction it may be in.
+                return
+            # Back to the pool, which discards it on checkout.
+            self.close()
+        super().connect()
+        self.fill()
+
+    def connection_kwargs(self):
+        return dict(
             user=config.get('DB_USER'),
             password=config.get('DB_PASSWORD'),
             host=config.get('DB_HOST'),
             port=config.get('DB_PORT')
         )
-        super().connect()
+
+    def iter_batches(self, sql, params=None, size=1000):
+        """Yield the rows of `sql` by batches of `size`, fetched from a
+        server-side cursor so only one batch is held in memory."""
+        # Named cursors only live inside a transaction.
+        with self.atomic():
+            cursor = self.execute_sql(sql, params, named_cursor=True)
+            try:
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+    def estimate_count(self, sql, params=None):
+        """Number of rows of `sql` as estimated by the PostgreSQL planner.
+
+        Costs a query planning instead of a full scan, but is only as
+        accurate as the table statistics."""
+        cursor = self.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        return int(plan[0]['Plan']['Plan Rows'])
 
     def initialize_connection(self, conn):
         if not self.postgis_registered:
             postgis.register(conn.cursor())
             self.postgis_registered = True
 
+    def reset_stats(self):
+        self.created = self.reused = self.recycled = self.broken = 0
+
+    @property
+    def stats(self):
+        return {'idle': len(self._connections), 'in_use': len(self._in_use),
+                'created': self.created, 'reused': self.reused,
+                'recycled': self.recycled, 'broken': self.broken}
+
+    def fill(self):
+        """Make sure at least POOL_MIN_SIZE connections are open."""
+        minsize = int(config.get('POOL_MIN_SIZE', 1))
+        with self._conn_lock:
+            missing = minsize - len(self._connections) - len(self._in_use)
+            for _ in range(missing):
+                # Bypass the pool checkout.
+                with self.exception_wrapper:
+                    conn = super(PooledDatabase, self)._connect(
+                        self.database, **self.connect_kwargs)
+                self.created += 1
+                now = time.time()
+                heapq.heappush(self._connections, (now, conn))
+                self._idle_since[self.conn_key(conn)] = now
+
+    def _connect(self, *args, **kwargs):
+        conn = super()._connect(*args, **kwargs)
+        # Only connections coming from the pool have an idle timestamp.
+        if self._idle_since.pop(self.conn_key(conn), None) is None:
+            self.created += 1
+        else:
+            self.reused += 1
+        return conn
+
+    def _is_stale(self, timestamp):
+        stale = super()._is_stale(timestamp)
+        if stale:
+            self.recycled += 1
+        return stale
+
+    def _is_closed(self, key, conn):
+        # Health check on checkout.
+        closed = super()._is_closed(key, conn)
+        if not closed and not self.is_healthy(key, conn):
+            self.broken += 1
+            self._idle_since.pop(key, None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            closed = True
+        return closed
+
+    def is_healthy(self, key, conn):
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == pg_extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        idle_since = self._idle_since.get(key)
+        interval = float(config.get('POOL_CHECK_INTERVAL', 30))
+        if idle_since is None or time.time() - idle_since < interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()  # Do not hand out a connection in transaction.
+        except Exception:
+            return False
+        return True
+
+    def _close(self, conn, close_conn=False):
+        super()._close(conn, close_conn)
+        key = self.conn_key(conn)
+        if close_conn or conn.closed:
+            self._idle_since.pop(key, None)
+        else:
+            self._idle_since[key] = time.time()
+
+    def after_fork(self):
+        """Forget the connections inherited from the parent process: they
+        are still used by the parent, so they must not be closed here."""
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._idle_since = {}
+        self._local = type(self._local)()
+        self.reset_stats()
+
 
 database = DB()
@@ -5,17 +5,17 @@ import re
 import peewee
 
 from playhouse import postgres_ext, fields
-from postgis import Point
+from postgis import Geometry, Point
 from psycopg2.extras import DateTimeTZRange
 
 from ban.core.exceptions import ValidationError, IsDeletedError
-from . import cache
+from . import cache, names
 
 __all__ = ['PointField', 'ForeignKeyField', 'CharField', 'IntegerField',
            'HStoreField', 'UUIDField', 'ArrayField', 'DateTimeField',
            'BooleanField', 'BinaryJSONField', 'FantoirField',
            'ManyToManyField', 'DateRangeField', 'TextField',
-           'CachedForeignKeyField', 'NameField']
+           'CachedForeignKeyField', 'NameField', 'ExtentField']
 
 
 lonlat_pattern = re.compile('^[\[\(]{1}(?P<lon>-?\d{,3}(:?\.\d*)?), ?(?P<lat>-?\d{,3}(\.\d*)?)[\]\)]{1}$')  # noqa
@@ -25,11 +25,16 @@ peewee.OP.update(
     BBOX2D='&&',
     BBOXCONTAINS='~',
     BBOXCONTAINED='@',
+    KNN='<->',
+    # pg_trgm similarity, escaped for psycopg2.
+    TRGM_MATCH='%%',
 )
 postgres_ext.PostgresqlExtDatabase.register_ops({
     peewee.OP.BBOX2D: peewee.OP.BBOX2D,
     peewee.OP.BBOXCONTAINS: peewee.OP.BBOXCONTAINS,
     peewee.OP.BBOXCONTAINED: peewee.OP.BBOXCONTAINED,
+    peewee.OP.KNN: peewee.OP.KNN,
+    peewee.OP.TRGM_MATCH: peewee.OP.TRGM_MATCH,
 })
 
 
@@ -73,6 +78,10 @@ class PointField(peewee.Field, postgres_ext.IndexedFieldMixin):
     def contains(self, geom):
         return peewee.Expression(self, peewee.OP.BBOXCONTAINS, geom)
 
+    def distance(self, geom):
+        """KNN distance, index assisted when used in ORDER BY."""
+        return peewee.Expression(self, peewee.OP.KNN, geom)
+
     def in_bbox(self, south, north, east, west):
         return self.contained(
             peewee.fn.ST_MakeBox2D(Point(west, south, srid=self.srid),
@@ -84,6 +93,27 @@ postgres_ext.PostgresqlExtDatabase.register_fields({'point':
                                                     'geometry(Point)'})
 
 
+class ExtentField(peewee.Field, postgres_ext.IndexedFieldMixin):
+    """Bounding box of a set of points, computed by the database (it is a
+    Point, or a LineString, when the box is flat)."""
+    db_field = 'extent'
+    __data_type__ = Geometry
+    __schema_type__ = 'object'
+    __schema_format__ = 'geojson'
+    srid = 4326
+    index_type = 'GiST'
+
+    def overlaps(self, south, north, east, west):
+        return peewee.Expression(
+            self, peewee.OP.BBOX2D,
+            peewee.fn.ST_MakeBox2D(Point(west, south, srid=self.srid),
+                                   Point(east, north, srid=self.srid)))
+
+
+postgres_ext.PostgresqlExtDatabase.register_fields({'extent':
+                                                    'geometry(Geometry)'})
+
+
 class DateRangeField(peewee.Field):
     db_field = 'tstzrange'
     __data_type__ = datetime
@@ -146,6 +176,8 @@ class ForeignKeyField(peewee.ForeignKeyField):
 class CachedForeignKeyField(ForeignKeyField):
 
     def _get_descriptor(self):
+        # Other processes may hold this model rows in cache.
+        cache.SHARED.add(self.rel_model.__name__)
         return CachedRelationDescriptor(self, self.rel_model)
 
 
@@ -294,6 +326,8 @@ class ManyToManyField(fields.ManyToManyField):
 
 
 class NameField(CharField):
+    NORMALIZED_SEARCHES = ('case', 'ponctuation', 'libelle', 'direct')
+
     def coerce(self, value):
         if not value:
             return None
@@ -306,10 +340,25 @@ class NameField(CharField):
 
 
     def search(self, **kwargs):
-        ponctuation = '[\.\(\)\[\]\"\'\-,;:\/]'
-        articles = '(^| )((LA|L|LE|LES|DU|DE|DES|D|ET|A|AU) )*'
         if kwargs['type'] is None or kwargs['search'] is None:
             raise ValueError('None value for search.')
+        expression = self.search_expression(**kwargs)
+        normalized = self.normalized
+        if (normalized and kwargs['type'] in self.NORMALIZED_SEARCHES
+                and not names.is_pattern(kwargs['search'])):
+            simplified = names.simplify(kwargs['search'])
+            if simplified:
+                # Names matching for those searches share the same simplified
+                # form: narrow down with the trigram index first. Rows not
+                # normalized yet (see db:normalize) are only rechecked.
+                expression = ((peewee.Expression(normalized, peewee.OP.LIKE,
+                                                 simplified)
+                               | normalized.is_null()) & expression)
+        return expression
+
+    def search_expression(self, **kwargs):
+        ponctuation = names.PONCTUATION
+        abbrev = names.ABBREVIATIONS_PATTERN
         if kwargs['type'] == 'strict':
             return peewee.Expression(self, peewee.OP.EQ, kwargs['search'])
         elif kwargs['type'] == 'case':
@@ -320,104 +369,87 @@ class NameField(CharField):
                 peewee.OP.ILIKE,
                 peewee.fn.regexp_replace(peewee.fn.unaccent(kwargs['search']), ponctuation, ' ', 'g'))
         elif kwargs['type'] == 'abbrev':
-            import csv
-            abbrev = []
-            with open('../../abbrev_type_voie.csv', newline='') as csvfile:
-                csv = csv.reader(csvfile, delimiter=';')
-                for row in csv:
-                    if re.match(r"^{} ".format(row[1]),
-                                re.sub(ponctuation, ' ', kwargs['search'].upper())) is not None \
-                            or re.match(r"^{} ".format(row[0]),
-                                        re.sub(ponctuation, ' ', kwargs['search'].upper())) is not None:
-                        abbrev = row
-                        break
-                if not abbrev:
-                    return peewee.Expression(
-                        peewee.fn.regexp_replace(peewee.fn.unaccent(self), ponctuation, ' ', 'g'),
-                        peewee.OP.ILIKE,
-                        peewee.fn.regexp_replace(peewee.fn.unaccent(kwargs['search']), ponctuation, ' ', 'g'))
+            row = names.find_abbreviation(kwargs['search'])
+            if not row:
                 return peewee.Expression(
+                    peewee.fn.regexp_replace(peewee.fn.unaccent(self), ponctuation, ' ', 'g'),
+                    peewee.OP.ILIKE,
+                    peewee.fn.regexp_replace(peewee.fn.unaccent(kwargs['search']), ponctuation, ' ', 'g'))
+            return peewee.Expression(
+                peewee.fn.regexp_replace(
                     peewee.fn.regexp_replace(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.unaccent(peewee.fn.upper(self)), ponctuation, ' ', 'g'),
-                        "^{} ".format(abbrev[1]), "{} ".format(abbrev[0]), 'g'),
-                    peewee.OP.REGEXP,
+                        peewee.fn.unaccent(peewee.fn.upper(self)), ponctuation, ' ', 'g'),
+                    "^{} ".format(row[1]), "{} ".format(row[0]), 'g'),
+                peewee.OP.REGEXP,
+                peewee.fn.regexp_replace(
                     peewee.fn.regexp_replace(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])), ponctuation, ' ', 'g'),
-                        "^{} ".format(abbrev[1]), "{} ".format(abbrev[0]), 'g'))
+                        peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])), ponctuation, ' ', 'g'),
+                    "^{} ".format(row[1]), "{} ".format(row[0]), 'g'))
         elif kwargs['type'] == 'libelle':
-            import csv
-            abbrev = '^('
-            with open('../../abbrev_type_voie.csv', newline='') as csvfile:
-                csv = csv.reader(csvfile, delimiter=';')
-                for row in csv:
-                    abbrev = '{}|{}|{}'.format(abbrev, row[0], row[1])
-                abbrev = '{})( |$)'.format(abbrev)
-                return peewee.Expression(
+            return peewee.Expression(
+                peewee.fn.regexp_replace(
                     peewee.fn.regexp_replace(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.unaccent(peewee.fn.upper(self)), ponctuation, ' ', 'g'),
-                        abbrev, "", 'g'),
-                    peewee.OP.ILIKE,
+                        peewee.fn.unaccent(peewee.fn.upper(self)), ponctuation, ' ', 'g'),
+                    abbrev, "", 'g'),
+                peewee.OP.ILIKE,
+                peewee.fn.regexp_replace(
                     peewee.fn.regexp_replace(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])), ponctuation, ' ', 'g'),
-                        abbrev, "", 'g'))
+                        peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])), ponctuation, ' ', 'g'),
+                    abbrev, "", 'g'))
         elif kwargs['type'] == 'direct':
-            import csv
-            abbrev = '^('
-            with open('../../abbrev_type_voie.csv', newline='') as csvfile:
-                csv = csv.reader(csvfile, delimiter=';')
-                for row in csv:
-                    abbrev = '{}|{}|{}'.format(abbrev, row[0], row[1])
-                abbrev = '{})( |$)'.format(abbrev)
-                return peewee.Expression(
-                    peewee.fn.trim(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.regexp_replace(
-                                peewee.fn.regexp_replace(
-                                    peewee.fn.unaccent(peewee.fn.upper(self)),
-                                    ponctuation, ' ', 'g'),
-                                abbrev, "", 'g'),
-                            articles, ' ', 'g')),
-                    peewee.OP.ILIKE,
-                    peewee.fn.trim(
-                        peewee.fn.regexp_replace(
-                            peewee.fn.regexp_replace(
-                                peewee.fn.regexp_replace(
-                                    peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])),
-                                    ponctuation, ' ', 'g'),
-                                abbrev, "", 'g'),
-                            articles, ' ', 'g')))
+            return peewee.Expression(
+                self.simplify(self),
+                peewee.OP.ILIKE,
+                self.simplify(kwargs['search']))
         elif kwargs['type'] == 'approx':
-            import csv
-            abbrev = '^('
-            with open('../../abbrev_type_voie.csv', newline='') as csvfile:
-                csv = csv.reader(csvfile, delimiter=';')
-                for row in csv:
-                    abbrev = '{}|{}|{}'.format(abbrev, row[0], row[1])
-                abbrev = '{})( |$)'.format(abbrev)
-                return peewee.Expression(
-                    peewee.fn.levenshtein(
-                        peewee.fn.trim(
-                            peewee.fn.regexp_replace(
-                                peewee.fn.regexp_replace(
-                                    peewee.fn.regexp_replace(
-                                        peewee.fn.unaccent(peewee.fn.upper(self)),
-                                    ponctuation, ' ', 'g'),
-                                abbrev, "", 'g'),
-                            articles, ' ', 'g')),
-                        peewee.fn.trim(
-                            peewee.fn.regexp_replace(
-                                peewee.fn.regexp_replace(
-                                    peewee.fn.regexp_replace(
-                                        peewee.fn.unaccent(peewee.fn.upper(kwargs['search'])),
-                                        ponctuation, ' ', 'g'),
-                                    abbrev, "", 'g'),
-                                articles, ' ', 'g'))
-                    ),
-                    peewee.OP.LTE,
-                    2)
+            if self.normalized:
+                # Trigram index candidates, then at most two edits away.
+                simplified = names.simplify(kwargs['search'])
+                return ((peewee.Expression(self.normalized,
+                                           peewee.OP.TRGM_MATCH, simplified) &
+                         (peewee.fn.levenshtein(self.normalized,
+                                                simplified) <= 2)) |
+                        # Not normalized yet.
+                        (self.normalized.is_null() &
+                         (peewee.fn.levenshtein(
+                             self.simplify(self),
+                             self.simplify(kwargs['search'])) <= 2)))
+            return peewee.Expression(
+                peewee.fn.levenshtein(
+                    self.simplify(self),
+                    self.simplify(kwargs['search'])),
+                peewee.OP.LTE,
+                2)
         else:
             raise ValueError('Search type {} is unknown'.format(kwargs['type']))
+
+    @property
+    def normalized(self):
+        """The column storing the searchable form of this one, if any."""
+        return self.model_class._meta.fields.get(
+            '{}_normalized'.format(self.name))
+
+    def ranking(self, search):
+        """Score and ordering of the `approx` search results: the fewer edits
+        relative to the name length, the better, then the more trigrams in
+        common."""
+        normalized = peewee.fn.COALESCE(self.normalized, self.simplify(self))
+        simplified = names.simplify(search)
+        score = 1 - (peewee.fn.levenshtein(normalized, simplified) * 1.0 /
+                     peewee.fn.greatest(peewee.fn.length(normalized),
+                                        len(simplified), 1))
+        similarity = peewee.fn.similarity(normalized, simplified)
+        return score, [score.desc(), similarity.desc()]
+
+    @staticmethod
+    def simplify(value):
+        """SQL expression of `value` without accents, ponctuation, way type
+        and articles."""
+        return peewee.fn.trim(
+            peewee.fn.regexp_replace(
+                peewee.fn.regexp_replace(
+                    peewee.fn.regexp_replace(
+                        peewee.fn.unaccent(peewee.fn.upper(value)),
+                        names.PONCTUATION, ' ', 'g'),
+                    names.ABBREVIATIONS_PATTERN, "", 'g'),
+                names.ARTICLES, ' ', 'g'))
@@ -1,16 +1,37 @@
+from collections import deque
+
 import peewee
 
 from .connections import database
-from . import cache
+from . import cache, notifications
+
+
+def serialize(instances, mask=None, method='serialize', prefetch=None):
+    """Serialize instances of the same model, loading the relations needed
+    by `mask` once for all of them (with `prefetch` if given, else with the
+    model prefetch_related)."""
+    if instances:
+        (prefetch or instances[0].prefetch_related)(instances, mask)
+    return [getattr(instance, method)(mask) for instance in instances]
 
 
 class SerializerQueryResultWrapper(peewee.ModelQueryResultWrapper):
 
-    def process_row(self, row):
-        instance = super().process_row(row)
-        if hasattr(self, '_serializer'):
-            instance = self._serializer(instance)
-        return instance
+    # Rows are serialized by batches, so relations can be prefetched for the
+    # whole batch instead of row by row.
+    batch_size = 1000
+
+    def iterate(self):
+        if not getattr(self, '_batch', None):
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                return super().iterate()  # Close the cursor and stop.
+            if not self._initialized:
+                self.initialize(self.cursor.description)
+                self._initialized = True
+            instances = [self.process_row(row) for row in rows]
+            self._batch = deque(self._serializer(instances))
+        return self._batch.popleft()
 
 
 class SelectQuery(peewee.SelectQuery):
@@ -22,14 +43,72 @@ class SelectQuery(peewee.SelectQuery):
         return wrapper
 
     @peewee.returns_clone
-    def serialize(self, mask=None):
-        self._serializer = lambda inst: inst.serialize(mask)
+    def serialize(self, mask=None, method='serialize', prefetch=None):
+        self._serializer = lambda instances: serialize(instances, mask,
+                                                       method, prefetch)
         self._result_wrapper = SerializerQueryResultWrapper
 
     def _get_result_wrapper(self):
         wrapper = getattr(self, '_result_wrapper', None)
         return wrapper or super()._get_result_wrapper()
 
+    def keyset(self, keys, after=None, limit=None):
+        """Keyset (aka "seek") pagination.
+
+        Return the rows ordered by `keys` strictly after the `after` values,
+        and the keys values of the last returned row if there are more rows
+        to fetch (None otherwise). Unlike LIMIT/OFFSET, the cost of a page
+        does not depend on how deep it is.
+        """
+        query = self.clone()  # Does not inherit from the serializer.
+        if after:
+            query = query.where(peewee.Tuple(*keys) > peewee.Tuple(*after))
+        aliases = ['_keyset_{}'.format(i) for i in range(len(keys))]
+        selection = list(query._select) + [key.alias(alias)
+                                           for key, alias in zip(keys, aliases)]
+        query = query.select(*selection).order_by(*keys)
+        if limit is not None:
+            # Fetch one more row to know if there is a next page.
+            query = query.limit(limit + 1)
+        rows = list(query)
+        last = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            last = [getattr(rows[-1], alias) for alias in aliases]
+        serializer = getattr(self, '_serializer', None)
+        if serializer:
+            rows = serializer(rows)
+        return rows, last
+
+    def stream(self):
+        """Iterate over all the rows through a PostgreSQL server-side cursor,
+        so only one batch of rows is held in memory at a time."""
+        with self.database.atomic():
+            sql, params = self.sql()
+            # Named cursors only live inside a transaction.
+            cursor = self.database.execute_sql(sql, params,
+                                               require_commit=False,
+                                               named_cursor=True)
+            wrapper = self._get_result_wrapper()(self.model_class, cursor,
+                                                 self.get_query_meta())
+            if hasattr(self, '_serializer'):
+                wrapper._serializer = self._serializer
+            try:
+                while True:
+                    try:
+                        row = wrapper.iterate()
+                    except StopIteration:
+                        break
+                    yield row
+            finally:
+                cursor.close()
+
+    def estimate_count(self):
+        """Number of rows as estimated by the PostgreSQL planner."""
+        clone = self.order_by()
+        clone._limit = clone._offset = None
+        return self.database.estimate_count(*clone.sql())
+
     def __len__(self):
         return self.count()
 
@@ -54,8 +133,98 @@ class Model(peewee.Model):
         manager = SelectQuery
 
     def save(self, *args, **kwargs):
-        cache.clear()
+        self.invalidate_cache()
         super().save(*args, **kwargs)
+        self.invalidate_cache(publish=True)
+
+    @classmethod
+    def bulk_save(cls, instances):
+        """Insert the new `instances` and update the others, with one
+        multi-row statement for each. Updates write every column: the ones
+        not loaded on the instances (select(<subset>), only()) are loaded
+        first, not to null them."""
+        instances = list(instances)
+        cls._bulk_load_missing([i for i in instances
+                                if i._get_pk_value() is not None])
+        return cls._bulk_save(instances)
+
+    @classmethod
+    def _bulk_save(cls, instances):
+        for instance in instances:
+            instance.invalidate_cache()
+        created = [i for i in instances if i._get_pk_value() is None]
+        updated = [i for i in instances if i._get_pk_value() is not None]
+        if created:
+            query = cls.insert_many(cls._bulk_rows(created, exclude=['pk']))
+            for instance, pk in zip(created, query.return_id_list().execute()):
+                instance._set_pk_value(pk)
+        if updated:
+            rows = cls._bulk_rows(updated)
+            sql, params = cls.insert_many(rows).sql()
+            columns = [cls._meta.fields[name].db_column for name in rows[0]
+                       if name != 'pk']
+            sql += ' ON CONFLICT ("{}") DO UPDATE SET {}'.format(
+                cls._meta.primary_key.db_column,
+                ', '.join('"{0}" = EXCLUDED."{0}"'.format(c) for c in columns))
+            cls._meta.database.execute_sql(sql, params)
+        for instance in instances:
+            instance._dirty.clear()
+            instance.invalidate_cache()
+        # One notification statement, whatever the number of instances.
+        name = cls.__name__
+        if name in cache.SHARED:
+            notifications.publish_many(cls._meta.database, name,
+                                       [i.pk for i in instances])
+        return instances
+
+    @classmethod
+    def _bulk_load_missing(cls, instances):
+        # Instances loaded with select(<subset>) or only() lack columns, one
+        # query by set of missing columns.
+        missing = {}
+        for instance in instances:
+            names = tuple(f.name for f in cls._meta.sorted_fields
+                          if f.name not in instance._data)
+            if names:
+                missing.setdefault(names, []).append(instance)
+        for names, group in missing.items():
+            fields = [cls._meta.fields[name] for name in names]
+            query = (cls.select(cls._meta.primary_key, *fields)
+                        .where(cls._meta.primary_key
+                               << [i._get_pk_value() for i in group]))
+            rows = {row._get_pk_value(): row for row in query}
+            for instance in group:
+                row = rows.get(instance._get_pk_value())
+                for name in names:
+                    instance._data[name] = row._data.get(name) if row else None
+
+    @staticmethod
+    def _bulk_rows(instances, exclude=()):
+        # A multi-row INSERT needs the same columns on every row.
+        names = set()
+        for instance in instances:
+            names.update(instance._data)
+        names.difference_update(exclude)
+        return [{name: instance._data.get(name) for name in names}
+                for instance in instances]
+
+    def delete_instance(self, *args, **kwargs):
+        rows = super().delete_instance(*args, **kwargs)
+        self.invalidate_cache(publish=True)
+        return rows
+
+    def invalidate_cache(self, publish=False):
+        if self.pk is None:
+            return
+        name = self.__class__.__name__
+        cache.invalidate(name, self.pk)
+        if publish and name in cache.SHARED:
+            notifications.publish(self._meta.database, name, self.pk)
+
+    @classmethod
+    def prefetch_related(cls, instances, mask=None):
+        """Load at once, for all `instances`, the relations that
+        `serialize(mask)` will follow. Nothing to load by default."""
 
     # TODO find a way not to override the peewee.Model select classmethod.
     @classmethod
@@ -0,0 +1,84 @@
+"""
+Normalization of the street names used by NameField.search.
+The way types abbreviations table (eg. "R;RUE") is read once at import, and
+compiled both as a PostgreSQL regexp and as a python one.
+"""
+import csv
+import re
+from functools import lru_cache
+from os import path
+
+from unidecode import unidecode
+
+ABBREVIATIONS_PATH = path.join(path.dirname(__file__), 'abbrev_type_voie.csv')
+PONCTUATION = '[\.\(\)\[\]\"\'\-,;:\/]'
+ARTICLES = '(^| )((LA|L|LE|LES|DU|DE|DES|D|ET|A|AU) )*'
+ALIAS_SEPARATOR = '\n'
+
+
+def load_abbreviations(filepath=ABBREVIATIONS_PATH):
+    """Return the (short, long) way types, in file order."""
+    with open(filepath, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile, delimiter=';')
+        next(reader)  # Header.
+        return [(row[0], row[1]) for row in reader if row]
+
+
+ABBREVIATIONS = load_abbreviations()
+# Any short or long way type at the start of a name (PostgreSQL flavour).
+ABBREVIATIONS_PATTERN = '^({})( |$)'.format(
+    '|'.join(name for row in ABBREVIATIONS for name in row))
+
+# First row of the table matching a given short or long way type.
+_rows = {}
+for row in ABBREVIATIONS:
+    for name in (row[1], row[0]):
+        _rows.setdefault(name, row)
+# Python alternation is ordered: the first row of the table wins.
+_prefix = re.compile('^({}) '.format(
+    '|'.join(re.escape(name) for row in ABBREVIATIONS
+             for name in (row[1], row[0]))))
+_ponctuation = re.compile(PONCTUATION)
+# PostgreSQL alternations match the longest branch, python ones the first.
+_abbreviations = re.compile('^({})( |$)'.format(
+    '|'.join(sorted({re.escape(name) for row in ABBREVIATIONS
+                     for name in row}, key=lambda n: (-len(n), n)))))
+_articles = re.compile(ARTICLES)
+
+
+@lru_cache(maxsize=1024)
+def normalize(value):
+    """Upper case `value` and replace its ponctuation by spaces."""
+    return _ponctuation.sub(' ', value.upper())
+
+
+@lru_cache(maxsize=1024)
+def find_abbreviation(value):
+    """Return the (short, long) way type `value` starts with, if any."""
+    match = _prefix.match(normalize(value))
+    if match:
+        return _rows[match.group(1)]
+
+
+@lru_cache(maxsize=1024)
+def fold(value):
+    """No accent and no ponctuation, upper cased, whitespaces collapsed."""
+    if not value:
+        return ''
+    return ' '.join(_ponctuation.sub(' ', unidecode(value).upper()).split())
+
+
+@lru_cache(maxsize=1024)
+def simplify(value):
+    """Python counterpart of the `direct` search normalization: no accent,
+    no ponctuation, no way type and no article, upper cased. This is what is
+    stored in the `name_normalized` columns."""
+    value = fold(value)
+    value = _abbreviations.sub('', value)
+    value = _articles.sub(' ', value)
+    return ' '.join(value.split())
+
+
+def is_pattern(value):
+    """Whether `value` holds LIKE special characters."""
+    return any(char in value for char in '%_\\')
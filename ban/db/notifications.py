@@ -0,0 +1,91 @@
+"""
+Cross process cache invalidation.
+Writers publish the `(model, pk)` they changed on a PostgreSQL NOTIFY channel,
+and each process runs a listener thread evicting the matching keys from its
+own cache. NOTIFY is transactional: listeners only get the message once the
+change is committed, so they cannot reload a stale row.
+"""
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from ban.core import config
+
+from . import cache
+
+CHANNEL = 'ban_cache'
+
+logger = logging.getLogger(__name__)
+
+
+def publish(database, *keys):
+    payload = cache.SEPARATOR.join(map(str, keys))
+    database.execute_sql('SELECT pg_notify(%s, %s)', (CHANNEL, payload))
+
+
+def publish_many(database, namespace, keys):
+    """Publish `(namespace, key)` for each of `keys` in one statement."""
+    payloads = [cache.SEPARATOR.join(map(str, (namespace, key)))
+                for key in keys]
+    database.execute_sql('SELECT pg_notify(%s, payload) '
+                         'FROM unnest(%s::text[]) AS payload',
+                         (CHANNEL, payloads))
+
+
+class Listener(threading.Thread):
+
+    daemon = True
+    timeout = 5  # Seconds between connection liveness checks.
+    retry_delay = 1
+
+    def __init__(self, database):
+        super().__init__(name='ban-cache-listener')
+        self.database = database
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                # Whatever the error, a dead listener would leave the cache
+                # stale for good: reconnect, which clears the cache.
+                logger.exception('Cache listener failed, reconnecting')
+                time.sleep(self.retry_delay)
+
+    def listen(self):
+        database = self.database
+        conn = psycopg2.connect(database=database.prefix + config.DB_NAME,
+                                **database.connection_kwargs())
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(CHANNEL))
+            # Notifications sent while we were not listening are lost.
+            cache.clear()
+            while True:
+                if select.select([conn], [], [], self.timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    cache.invalidate(*notify.payload.split(cache.SEPARATOR))
+        finally:
+            conn.close()
+
+
+LISTENER = None
+LOCK = threading.Lock()
+
+
+def listen(database):
+    """Start the listener thread of this process, if not yet running."""
+    global LISTENER
+    with LOCK:
+        if LISTENER is None or not LISTENER.is_alive():
+            LISTENER = Listener(database)
+            LISTENER.start()
+    return LISTENER
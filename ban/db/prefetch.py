@@ -0,0 +1,83 @@
+"""
+Batch loading of relations.
+Each helper loads one relation level for a list of instances of the same
+model with a single `IN (…)` query, and attaches the result to the instances
+so that accessing the relation later does not hit the database again.
+They return the loaded related instances, so the caller can go down one
+level more.
+"""
+
+
+def get_prefetched(instance, name):
+    return getattr(instance, '_prefetched', {}).get(name)
+
+
+def set_prefetched(instance, name, value):
+    if not hasattr(instance, '_prefetched'):
+        instance._prefetched = {}
+    instance._prefetched[name] = value
+
+
+def foreign_key(instances, field):
+    """Load `field` target for all instances."""
+    name = field.name
+    ids = set(i._data.get(name) for i in instances
+              if name not in i._obj_cache) - {None}
+    if ids:
+        to_field = field.to_field
+        query = field.rel_model.select().where(to_field << list(ids))
+        related = {getattr(obj, to_field.name): obj for obj in query}
+        for instance in instances:
+            obj = related.get(instance._data.get(name))
+            if obj is not None:
+                instance._obj_cache[name] = obj
+    # Also return the targets that were already loaded, so the caller can
+    # prefetch their own relations.
+    targets = {}
+    for instance in instances:
+        obj = instance._obj_cache.get(name)
+        if obj is not None:
+            targets[id(obj)] = obj
+    return list(targets.values())
+
+
+def reverse_relation(instances, descriptor, name):
+    """Load the rows pointing to the instances through `descriptor`."""
+    field = descriptor.field
+    to_field = field.to_field.name
+    by_id = {}
+    for instance in instances:
+        by_id[getattr(instance, to_field)] = []
+        set_prefetched(instance, name, by_id[getattr(instance, to_field)])
+    if not by_id:
+        return []
+    query = (descriptor.rel_model.select()
+                                 .where(field << list(by_id))
+                                 .order_by(descriptor.rel_model.pk))
+    related = list(query)
+    for obj in related:
+        by_id[obj._data.get(field.name)].append(obj)
+    return related
+
+
+def many_to_many(instances, field, name):
+    """Load the targets of the many to many `field` for all instances."""
+    through = field.get_through_model()
+    src = through._meta.rel_for_model(field.model_class)
+    dest = through._meta.rel_for_model(field.rel_model)
+    rel_model = field.rel_model
+    by_pk = {}
+    for instance in instances:
+        by_pk[instance.pk] = []
+        set_prefetched(instance, name, by_pk[instance.pk])
+    if not by_pk:
+        return []
+    query = (rel_model.select(rel_model, src.alias('_prefetch_src'))
+                      .join(through, on=(dest == rel_model.pk))
+                      .where(src << list(by_pk))
+                      .order_by(rel_model.pk)
+                      .naive())
+    related = list(query)
+    for obj in related:
+        by_pk[obj._prefetch_src].append(obj)
+    return related
@@ -1,21 +1,28 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha1
 from io import StringIO
+import json
 from urllib.parse import urlencode
 
 import peewee
-from flask import request, url_for
-import psycopg2
+from flask import Response, request, stream_with_context, url_for
+from postgis import Point
+from werkzeug.http import http_date, is_resource_modified, quote_etag
 
+from ban import db
 from ban.auth import models as amodels
 from ban.commands.bal import bal
-from ban.core import context, models, versioning, config
+from ban.core import context, models, versioning
 from ban.core.encoder import dumps
 from ban.core.exceptions import (IsDeletedError, MultipleRedirectsError,
                                  RedirectError, ResourceLinkedError)
+from ban.core.resource import freeze_mask
 from ban.http.auth import auth
 from ban.http.wsgi import app
 from ban.utils import parse_mask
 
-from .utils import abort, get_bbox, link, get_search_params
+from . import autocomplete, cache, tiles
+from .utils import abort, get_as_of, get_bbox, link, get_search_params
 
 
 class CollectionEndpoint:
@@ -23,6 +30,9 @@ class CollectionEndpoint:
     filters = []
     DEFAULT_LIMIT = 20
     MAX_LIMIT = 1000
+    TOTAL_MODES = ['exact', 'estimate', 'none']
+    # Under this planner estimate, an exact count is cheap enough.
+    ESTIMATE_THRESHOLD = 10000
 
     def get_limit(self):
         return min(int(request.args.get('limit', self.DEFAULT_LIMIT)),
@@ -34,18 +44,114 @@ class CollectionEndpoint:
         except (ValueError, TypeError):
             return 0
 
-    def collection(self, queryset):
+    def get_total_mode(self, default='exact'):
+        mode = request.args.get('total', default)
+        if mode not in self.TOTAL_MODES:
+            abort(400, error='Invalid value for total: {}. Value must be {}'
+                  .format(mode, str(self.TOTAL_MODES)))
+        return mode
+
+    def count(self, queryset, mode):
+        """Return the total for `mode`, or None if it should be skipped."""
+        if isinstance(queryset, list):
+            return len(queryset)  # Free.
+        if mode == 'estimate':
+            count = queryset.estimate_count()
+            if count >= self.ESTIMATE_THRESHOLD:
+                return count
+            mode = 'exact'
+        if mode == 'exact':
+            return len(queryset)
+        return None
+
+    def get_cursor(self):
+        """Return the decoded keyset cursor, [] to start a keyset pagination
+        from the first row, or None to use offset pagination."""
+        if 'cursor' not in request.args:
+            return None
+        cursor = request.args.get('cursor')
+        if not cursor:
+            return []
+        try:
+            cursor = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        except (ValueError, TypeError):
+            abort(400, error='Invalid value for cursor')
+        scalars = (str, int, float, type(None))
+        if (not isinstance(cursor, list)
+                or not all(isinstance(value, scalars) for value in cursor)):
+            abort(400, error='Invalid value for cursor')
+        return cursor
+
+    def keyset_collection(self, queryset, keys, cursor):
+        limit = self.get_limit()
+        if cursor and len(cursor) != len(keys):
+            abort(400, error='Invalid value for cursor')
+        # Counting would defeat the purpose of a keyset pagination, so only
+        # do it on demand.
+        count = self.count(queryset, self.get_total_mode(default='none'))
+        try:
+            rows, last = queryset.keyset(keys, after=cursor, limit=limit)
+        except peewee.DataError:
+            # Values not matching the keys types.
+            db.database.rollback()
+            abort(400, error='Invalid value for cursor')
+        data = {'collection': rows}
+        if count is not None:
+            data['total'] = count
+        headers = {}
+        if last is not None:
+            query_string = request.args.copy()
+            query_string.pop('offset', None)
+            query_string['cursor'] = urlsafe_b64encode(
+                json.dumps(last).encode()).decode()
+            uri = '{}?{}'.format(request.base_url,
+                                 urlencode(sorted(query_string.items())))
+            data['next'] = uri
+            link(headers, uri, 'next')
+        return data, 200, headers
+
+    def wants_stream(self):
+        if request.args.get('format') == 'ndjson':
+            return True
+        mimetypes = request.accept_mimetypes
+        best = mimetypes.best_match(['application/json',
+                                     'application/x-ndjson'])
+        return best == 'application/x-ndjson'
+
+    def stream(self, queryset):
+        """Stream the whole collection, one JSON document per line, without
+        pagination."""
+        rows = queryset
+        if isinstance(queryset, db.SelectQuery):
+            rows = queryset.stream()
+        lines = (dumps(row, sort_keys=True) + '\n' for row in rows)
+        return Response(stream_with_context(lines),
+                        mimetype='application/x-ndjson')
+
+    def collection(self, queryset, keys=None):
+        cursor = self.get_cursor()
+        if (cursor is not None and keys
+                and isinstance(queryset, db.SelectQuery)):
+            return self.keyset_collection(queryset, keys, cursor)
         limit = self.get_limit()
         offset = self.get_offset()
         end = offset + limit
-        count = len(queryset)
-        data = {
-            'collection': list(queryset[offset:end]),
-            'total': count,
-        }
+        mode = self.get_total_mode()
+        count = self.count(queryset, mode)
+        data = {}
+        if count is not None:
+            data['total'] = count
+        if mode == 'exact' or isinstance(queryset, list):
+            data['collection'] = list(queryset[offset:end])
+            has_next = count > end
+        else:
+            # Fetch one more row to know if there is a next page.
+            rows = list(queryset[offset:end + 1])
+            data['collection'] = rows[:limit]
+            has_next = len(rows) > limit
         headers = {}
         url = request.base_url
-        if count > end:
+        if has_next:
             query_string = request.args.copy()
             query_string['offset'] = end
             uri = '{}?{}'.format(url, urlencode(sorted(query_string.items())))
@@ -63,15 +169,20 @@ class CollectionEndpoint:
 class ModelEndpoint(CollectionEndpoint):
     endpoints = {}
     order_by = None
+    # Keyset pagination keys, must be unique together and follow order_by.
+    cursor_keys = None
+    # Only changes recorded as Diff can invalidate the response cache.
+    cacheable = False
 
     def prepare_data(self, request):
         return request.json
 
 
-    def get_object(self, identifier):
+    def get_object(self, identifier, selection=None):
         endpoint = '{}-get-resource'.format(self.__class__.__name__.lower())
         try:
-            instance = self.model.coerce(identifier, None, 1)
+            instance = self.model.coerce(identifier, None, 1,
+                                         selection=selection)
         except self.model.DoesNotExist:
             abort(404, error='Resource with identifier `{}` does not exist.'
                   .format(identifier))
@@ -141,6 +252,12 @@ class ModelEndpoint(CollectionEndpoint):
                     qs = qs.where(field.is_null())
                 else:
                     qs = qs.where(field << values)
+                    if key == 'municipality' and cache.is_collecting():
+                        # Other municipalities changes can't alter it.
+                        model = field.rel_model
+                        insees = (model.select(model.insee)
+                                       .where(model.pk << values).tuples())
+                        cache.tag(*(insee for insee, in insees))
         return qs
 
     def get_mask(self):
@@ -153,6 +270,43 @@ class ModelEndpoint(CollectionEndpoint):
             fields = ','.join(self.model.collection_fields)
         return parse_mask(fields)
 
+    def get_order_by(self):
+        return (self.order_by if self.order_by is not None
+                else [self.model.pk])
+
+    def get_cursor_keys(self):
+        return (self.cursor_keys if self.cursor_keys is not None
+                else [self.model.pk])
+
+    def get_cache_tags(self, instance):
+        """Insee whose changes may alter `instance` representation."""
+        return []
+
+    def serialize_collection(self, queryset):
+        """Return the serialized collection query and its keyset pagination
+        keys."""
+        if get_as_of(request.args):
+            abort(400, error='as_of is only supported by versioned resources')
+        queryset = queryset.where(queryset.model_class.deleted_at.is_null())
+        return (queryset.order_by(*self.get_order_by())
+                        .serialize(self.get_collection_mask()),
+                self.get_cursor_keys())
+
+    def get_validators_selection(self):
+        """Fields needed to compute the conditional GET validators (None if
+        not supported)."""
+        return None
+
+    def get_validators(self, instance, mask):
+        """Conditional GET response headers (ETag, Last-Modified…)."""
+        return {}
+
+    def is_modified(self, headers):
+        return is_resource_modified(request.environ,
+                                    etag=headers.get('ETag'),
+                                    last_modified=headers.get('Last-Modified'))
+
+    @cache.cached
     @app.jsonify
     @app.endpoint(methods=['GET'])
     def get_collection(self):
@@ -175,20 +329,34 @@ class ModelEndpoint(CollectionEndpoint):
                         description: total resources available
             401:
                 $ref: '#/responses/401'
+
+        The whole collection can also be streamed, one resource per line
+        and without pagination, with `format=ndjson` or an
+        `Accept: application/x-ndjson` header.
+
+        Versioned resources can be listed as they were at a given datetime
+        with `as_of`: filters still apply to the current resources. It is
+        rejected (400) by the other resources and the filters that can't
+        honour it.
         """
         qs = self.get_queryset()
+        keys = self.get_cursor_keys()
         if qs is None:
-            return self.collection([])
-        if not isinstance(qs, list):
-            qs = qs.where(qs.model_class.deleted_at.is_null())
-            order_by = (self.order_by if self.order_by is not None
-                        else [self.model.pk])
-            qs = qs.order_by(*order_by).serialize(self.get_collection_mask())
+            qs = []
+        elif isinstance(qs, list):
+            # Already serialized: not the versions as of a date.
+            if get_as_of(request.args):
+                abort(400, error='as_of is not supported with these filters')
+        else:
+            qs, keys = self.serialize_collection(qs)
+        if self.wants_stream():
+            return self.stream(qs)
         try:
-            return self.collection(qs)
+            return self.collection(qs, keys=keys)
         except ValueError as e:
             abort(400, error=str(e))
 
+    @cache.cached
     @app.jsonify
     @app.endpoint('/<identifier>', methods=['GET'])
     def get_resource(self, identifier):
@@ -208,12 +376,23 @@ class ModelEndpoint(CollectionEndpoint):
             410:
                 $ref: '#/responses/410'
         """
+        mask = self.get_mask()
+        selection = self.get_validators_selection()
+        if selection and (request.if_none_match or request.if_modified_since):
+            # Only load what is needed to know if the client copy is fresh.
+            instance = self.get_object(identifier, selection=selection)
+            headers = self.get_validators(instance, mask)
+            if not self.is_modified(headers):
+                return Response(status=304, headers=headers)
         instance = self.get_object(identifier)
+        if cache.is_collecting():
+            cache.tag(*self.get_cache_tags(instance))
         status = 410 if instance.deleted_at else 200
         try:
-            return instance.serialize(self.get_mask()), status
+            data = instance.serialize(mask)
         except ValueError as e:
             abort(400, error=str(e))
+        return data, status, self.get_validators(instance, mask)
 
     @app.jsonify
     @app.endpoint('/<identifier>', methods=['POST'])
@@ -414,6 +593,44 @@ class ModelEndpoint(CollectionEndpoint):
 
 
 class VersionedModelEndpoint(ModelEndpoint):
+    cacheable = True
+
+    def get_cache_tags(self, instance):
+        return [instance.get_insee()]
+
+    def serialize_collection(self, queryset):
+        as_of = get_as_of(request.args)
+        if not as_of:
+            return super().serialize_collection(queryset)
+        # Filters apply to the current resources, deleted ones included as
+        # they may have been alive at that time.
+        pks = queryset.select(self.model.pk).order_by()
+        history = versioning.Version.at(self.model.__name__.lower(), as_of,
+                                        pks)
+        # Documents only: flags are not served for historical versions.
+        prefetch = lambda versions, mask: versioning.Version.rebuild(versions)
+        return (history.serialize(self.get_collection_mask(),
+                                  method='as_document', prefetch=prefetch),
+                [versioning.Version.model_pk])
+
+    def get_validators_selection(self):
+        return [self.model.pk, self.model.id, self.model.version,
+                self.model.modified_at, self.model.deleted_at]
+
+    def get_validators(self, instance, mask):
+        # The ETag is made of the versions of the resource and of the
+        # relations it embeds. Computed fields may change without a new
+        # version: no validator can tell they are fresh.
+        versions = self.model.mask_versions(instance, mask)
+        if versions is None:
+            return {}
+        key = '{}:{}'.format(versions, freeze_mask(mask))
+        headers = {'ETag': quote_etag(sha1(key.encode()).hexdigest())}
+        # Embedded relations change without touching modified_at.
+        if instance.modified_at and len(versions) == 1:
+            headers['Last-Modified'] = http_date(instance.modified_at)
+        return headers
+
     @app.jsonify
     @app.endpoint('/<identifier>/versions', methods=['GET'])
     def get_versions(self, identifier):
@@ -441,7 +658,8 @@ class VersionedModelEndpoint(ModelEndpoint):
                 $ref: '#/responses/404'
         """
         instance = self.get_object(identifier)
-        return self.collection(instance.versions.serialize())
+        return self.collection(instance.versions.serialize(),
+                               keys=[versioning.Version.sequential])
 
     @app.jsonify
     @app.endpoint('/<identifier>/versions/<datetime:ref>',
@@ -605,46 +823,119 @@ class VersionedModelEndpoint(ModelEndpoint):
         return self.collection(qs.serialize())
 
 
-@app.resource
-class Municipality(VersionedModelEndpoint):
-    endpoint = '/municipality'
-    model = models.Municipality
-    order_by = [model.insee]
+class NamedModelEndpoint(VersionedModelEndpoint):
+    """Collections can be searched by name (searchName and searchType).
+    `approx` results are ranked by a `score`, best first."""
+
+    def is_ranked(self):
+        search_params = get_search_params(request.args)
+        return (search_params['search'] is not None
+                and search_params['type'] == 'approx')
 
     def get_queryset(self):
         qs = super().get_queryset()
         search_params = get_search_params(request.args)
-        if search_params['search'] is not None:
-            qs = (qs.where(models.Municipality.name.search(**search_params)))
+        if qs is not None and search_params['search'] is not None:
+            qs = qs.where(self.model.name.search(**search_params))
+            if self.is_ranked():
+                score, _ = self.model.name.ranking(search_params['search'])
+                qs = qs.select(*(list(qs._select) + [score.alias('score')]))
         return qs
 
+    def get_order_by(self):
+        if self.is_ranked():
+            search = get_search_params(request.args)['search']
+            _, order_by = self.model.name.ranking(search)
+            return order_by + [self.model.pk]
+        return super().get_order_by()
+
+    def get_cursor_keys(self):
+        # A score can't be sought: ranked results use offset pagination.
+        return None if self.is_ranked() else super().get_cursor_keys()
+
+    def get_collection_mask(self):
+        mask = super().get_collection_mask()
+        if self.is_ranked():
+            mask['score'] = {}
+        return mask
+
+
+@app.resource
+class Municipality(NamedModelEndpoint):
+    endpoint = '/municipality'
+    model = models.Municipality
+    order_by = [model.insee]
+    cursor_keys = [model.insee]
+
+    @app.jsonify
+    @app.endpoint('/<identifier>/autocomplete', methods=['GET'])
+    def get_autocomplete(self, identifier):
+        """Get the groups of {resource} with 'identifier' whose name or alias
+        starts with `q`, for type-ahead. Served from memory, so it may lag
+        behind the last changes by a second.
+
+        parameters:
+            - name: q
+              in: query
+              type: string
+              required: true
+            - name: limit
+              in: query
+              type: integer
+              required: false
+        responses:
+            200:
+                description: Matching groups, as id, name and matched label.
+                schema:
+                    type: object
+                    properties:
+                      collection:
+                        name: collection
+                        type: array
+                        items:
+                          type: object
+                      total:
+                        name: total
+                        type: integer
+            400:
+                $ref: '#/responses/400'
+            401:
+                $ref: '#/responses/401'
+            404:
+                $ref: '#/responses/404'
+        """
+        query = request.args.get('q', '')
+        if not query.strip():
+            abort(400, error='Missing value for q')
+        insee = autocomplete.INDEXES.resolve(identifier)
+        if insee is None:
+            insee = self.get_object(identifier).insee
+            autocomplete.INDEXES.remember(identifier, insee)
+        collection = autocomplete.INDEXES.search(insee, query,
+                                                 self.get_limit())
+        return {'collection': collection, 'total': len(collection)}
+
 
 @app.resource
-class PostCode(VersionedModelEndpoint):
+class PostCode(NamedModelEndpoint):
     endpoint = '/postcode'
     model = models.PostCode
     order_by = [model.code, model.municipality]
+    cursor_keys = [model.code, model.municipality, model.pk]
     filters = ['code', 'municipality']
 
-    def get_queryset(self):
-        qs = super().get_queryset()
-        search_params = get_search_params(request.args)
-        if search_params['search'] is not None:
-            qs = (qs.where(models.PostCode.name.search(**search_params)))
-        return qs
-
 
 @app.resource
-class Group(VersionedModelEndpoint):
+class Group(NamedModelEndpoint):
     endpoint = '/group'
     model = models.Group
     filters = ['municipality']
 
     def get_queryset(self):
         qs = super().get_queryset()
-        search_params = get_search_params(request.args)
-        if search_params['search'] is not None:
-            qs = (qs.where(models.Group.name.search(**search_params)))
+        bbox = get_bbox(request.args)
+        if qs is not None and bbox:
+            qs = qs.where(models.Group.extent.overlaps(**bbox))
         return qs
 
 
@@ -655,6 +946,9 @@ class HouseNumber(VersionedModelEndpoint):
     filters = ['number','ordinal', 'parent', 'postcode', 'ancestors', 'group']
     order_by = [peewee.SQL('number ASC NULLS FIRST'),
                 peewee.SQL('ordinal ASC NULLS FIRST')]
+    # NULLS FIRST equivalent that can be compared as a row.
+    cursor_keys = [peewee.fn.COALESCE(model.number, ''),
+                   peewee.fn.COALESCE(model.ordinal, ''), model.pk]
 
 
     def filter_group(self, qs):
@@ -684,9 +978,11 @@ class HouseNumber(VersionedModelEndpoint):
             # `serialize`), and CompoundSelect is hardcoded in peewee
             # SelectQuery, and we'd need to copy-paste code to be able to use
             # a custom CompoundQuery class instead.
+        if get_as_of(request.args):
+            # Only its pks are used, to list the versions as of the date.
+            return qs
         mask = self.get_collection_mask()
-        qs = [h.serialize(mask) for h in qs.order_by(*self.order_by)]
-        return qs
+        return db.serialize(list(qs.order_by(*self.order_by)), mask)
 
     def get_queryset(self):
         qs = super().get_queryset()
@@ -712,6 +1008,80 @@ class Position(VersionedModelEndpoint):
             qs = qs.where(models.Position.center.in_bbox(**bbox))
         return qs
 
+    def get_nearest_mask(self):
+        if request.args.get('fields'):
+            return self.get_collection_mask()
+        mask = {f: {} for f in self.model.collection_fields}
+        mask['housenumber'] = {f: {} for f in
+                               models.HouseNumber.collection_fields}
+        mask['housenumber']['parent'] = {f: {} for f in
+                                         models.Group.collection_fields}
+        return mask
+
+    @app.jsonify
+    @app.endpoint('/nearest', methods=['GET'])
+    def get_nearest(self):
+        """Get the {resource} nearest to a point, with their housenumber and
+        group.
+
+        parameters:
+            - name: lon
+              in: query
+              type: number
+              required: true
+            - name: lat
+              in: query
+              type: number
+              required: true
+            - name: k
+              in: query
+              type: integer
+              required: false
+              description: number of {resource} to return (default 10)
+            - name: kind
+              in: query
+              type: string
+              required: false
+              description: only return {resource} of this kind
+        responses:
+            200:
+                description: {resource} collection, nearest first.
+                schema:
+                    type: object
+                    properties:
+                      collection:
+                        name: collection
+                        type: array
+                        items:
+                          $ref: '#/definitions/{resource}'
+                      total:
+                        name: total
+                        type: integer
+            400:
+                $ref: '#/responses/400'
+            401:
+                $ref: '#/responses/401'
+        """
+        try:
+            lon = float(request.args['lon'])
+            lat = float(request.args['lat'])
+            k = int(request.args.get('k', 10))
+        except (KeyError, ValueError):
+            abort(400, error='lon and lat must be numbers, k an integer')
+        if get_as_of(request.args):
+            abort(400, error='as_of is not supported by nearest')
+        k = max(1, min(k, self.MAX_LIMIT))
+        point = Point(lon, lat, srid=self.model.center.srid)
+        qs = self.model.where(self.model.deleted_at.is_null(),
+                              self.model.center.is_null(False))
+        kinds = request.args.getlist('kind')
+        if kinds:
+            qs = qs.where(self.model.kind << kinds)
+        # Let the GiST index walk the positions by distance.
+        qs = qs.order_by(self.model.center.distance(point)).limit(k)
+        collection = db.serialize(list(qs), self.get_nearest_mask())
+        return {'collection': collection, 'total': len(collection)}
+
 
 @app.route('/import/bal', methods=['POST'])
 @auth.require_oauth('bal')
@@ -826,7 +1196,9 @@ class Diff(CollectionEndpoint):
             pass
         else:
             qs = qs.where(versioning.Diff.pk > increment)
-        return self.collection(qs.serialize())
+        if self.wants_stream():
+            return self.stream(qs.serialize())
+        return self.collection(qs.serialize(), keys=[versioning.Diff.pk])
 
 
 @app.resource
@@ -864,8 +1236,7 @@ class Anomaly(ModelEndpoint):
             qs = qs.where(version.model_name == model_name)
 
         mask = self.get_collection_mask()
-        qs = [h.serialize(mask) for h in qs.order_by(*self.order_by)]
-        return qs
+        return db.serialize(list(qs.order_by(*self.order_by)), mask)
 
     def delete_join(self, instance):
         m2m = self.model.versions.get_through_model()
@@ -921,133 +1292,222 @@ class Anomaly(ModelEndpoint):
         return json
 
 
+BBOX_FROM = """FROM position AS p
+    LEFT JOIN housenumber AS h ON (h.pk = p.housenumber_id)
+    LEFT JOIN "group" AS g ON (h.parent_id = g.pk)
+    LEFT JOIN postcode AS po ON (h.postcode_id = po.pk)
+    WHERE p.center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s,
+                                      %(north)s, 4326)
+    AND p.deleted_at IS NULL AND h.deleted_at IS NULL AND g.deleted_at IS NULL
+    {unique}"""
+# The total is counted on the rows once deduplicated.
+BBOX_SQL = """SELECT *{total} FROM (SELECT {distinct}
+    p.id, p.name, st_x(p.center), st_y(p.center), p.kind, p.positioning,
+    p.source, p.source_kind, p.version,
+    h.id, h.number, h.ordinal, h.version,
+    po.id, po.name, po.code,
+    g.id, g.addressing, g.alias, g.fantoir, g.ign, g.kind, g.laposte, g.name
+    """ + BBOX_FROM + """) AS rows
+    LIMIT %(limit)s"""
+# Exact total, computed by the same statement as the page rows.
+BBOX_TOTAL_SQL = ', count(*) OVER () AS total'
+BBOX_CAPPED_SQL = """SELECT count(*) FROM (SELECT {select}
+    """ + BBOX_FROM + """
+    LIMIT %(cap)s) AS capped"""
+BBOX_TOTAL_MODES = ['exact', 'capped', 'estimate', 'none']
+# Stop counting past this number of rows in capped mode.
+BBOX_TOTAL_CAP = 10000
+
+# Only keep the last modified position of each housenumber (and one of them
+# when several were modified at the same time).
+BBOX_UNIQUE_SQL = """AND p.modified_at = (SELECT max(modified_at) FROM position
+                      WHERE housenumber_id = h.pk AND deleted_at IS NULL)"""
+BBOX_UNIQUE_DISTINCT = 'DISTINCT ON (h.pk)'
+
+
+def bbox_row(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "center": {
+            "type": "Point",
+            "coordinates": [row[2], row[3]]
+        },
+        "kind": row[4],
+        "positioning": row[5],
+        "source": row[6],
+        "source_kind": row[7],
+        "version": row[8],
+        "housenumber": {
+            "id": row[9],
+            "number": row[10],
+            "ordinal": row[11],
+            "version": row[12],
+            "postcode": {
+                "id": row[13],
+                "name": row[14],
+                "code": row[15]
+            },
+            "group": {
+                "id": row[16],
+                "addressing": row[17],
+                "alias": row[18],
+                "fantoir": row[19],
+                "ign": row[20],
+                "kind": row[21],
+                "laposte": row[22],
+                "name": row[23]
+            }
+        }
+    }
+
+
+# Same filters as BBOX_FROM.
+CLUSTER_FROM = """FROM position AS p
+    JOIN housenumber AS h ON (h.pk = p.housenumber_id)
+    JOIN "group" AS g ON (h.parent_id = g.pk)
+    WHERE p.center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s,
+                                      %(north)s, 4326)
+    AND p.deleted_at IS NULL AND h.deleted_at IS NULL AND g.deleted_at IS NULL
+    """
+CLUSTER_SQL = """SELECT {count}, ST_X(ST_Centroid(ST_Collect(p.center))),
+    ST_Y(ST_Centroid(ST_Collect(p.center))), {cell}
+    """ + CLUSTER_FROM + """GROUP BY {group_by}"""
+# The positions of a housenumber may fall in several cells.
+CLUSTER_UNIQUE_TOTAL_SQL = ('SELECT count(DISTINCT p.housenumber_id) '
+                            + CLUSTER_FROM)
+CLUSTER_MODES = ['grid', 'geohash']
+# Aim at roughly CLUSTER_CELLS x CLUSTER_CELLS cells in the bbox.
+CLUSTER_CELLS = 32
+
+
+def geohash_precision(span):
+    """Shortest geohash whose cells are not wider than `span` degrees."""
+    for precision in range(1, 13):
+        lon_bits = (5 * precision + 1) // 2
+        if 360 / 2 ** lon_bits <= span:
+            return precision
+    return 12
+
+
+def bbox_clusters(bbox, mode, unique=False):
+    """Count and centroid of the positions per cell, in one aggregate
+    query. With `unique`, housenumbers are counted once per cell, and once
+    in the total."""
+    span = max(bbox['east'] - bbox['west'],
+               bbox['north'] - bbox['south']) / CLUSTER_CELLS
+    count = 'count(DISTINCT p.housenumber_id)' if unique else 'count(*)'
+    params = dict(bbox)
+    if mode == 'geohash':
+        params['precision'] = geohash_precision(span)
+        cell = 'ST_GeoHash(p.center, %(precision)s)'
+        group_by = cell
+    else:
+        params['size'] = span or 1e-6
+        cell = 'NULL'
+        group_by = 'ST_SnapToGrid(p.center, %(size)s)'
+    sql = CLUSTER_SQL.format(count=count, cell=cell, group_by=group_by)
+    collection = []
+    total = 0
+    for count, x, y, cell in db.database.execute_sql(sql, params):
+        total += count
+        collection.append({
+            'count': count,
+            'center': {'type': 'Point', 'coordinates': [x, y]},
+            'cell': cell,
+        })
+    if unique:
+        cursor = db.database.execute_sql(CLUSTER_UNIQUE_TOTAL_SQL, params)
+        total = cursor.fetchone()[0]
+    return {'collection': collection, 'total': total}
+
+
+def bbox_total(mode, unique, params):
+    """Total for the non exact `mode`s, or None if it should be skipped."""
+    unique_sql = BBOX_UNIQUE_SQL if unique else ''
+    select = 'DISTINCT h.pk' if unique else '1'
+    if mode == 'estimate':
+        sql = 'SELECT {} {}'.format(select,
+                                    BBOX_FROM.format(unique=unique_sql))
+        count = db.database.estimate_count(sql, params)
+        if count >= CollectionEndpoint.ESTIMATE_THRESHOLD:
+            return count
+        mode = 'capped'  # Cheap enough.
+    if mode == 'capped':
+        cap = BBOX_TOTAL_CAP
+        sql = BBOX_CAPPED_SQL.format(select=select, unique=unique_sql)
+        count = db.database.execute_sql(sql, dict(params, cap=cap + 1))
+        count = count.fetchone()[0]
+        return '>{}'.format(cap) if count > cap else count
+    return None
+
+
+def stream_bbox(sql, params, mode='exact', total=None):
+    """Run `sql` and fetch its first rows, then return the generator writing
+    the response: a database error is raised before the response starts."""
+    batches = db.database.iter_batches(sql, params)
+    first = next(batches, [])
+    if mode == 'exact':
+        # The total comes with every row (window function).
+        total = first[0][-1] if first else 0
+
+    def stream():
+        # Keys in sorted order, as jsonify would do.
+        yield '{"collection": ['
+        yield ','.join(dumps(bbox_row(row), sort_keys=True) for row in first)
+        for batch in batches:
+            yield ',' + ','.join(dumps(bbox_row(row), sort_keys=True)
+                                 for row in batch)
+        if total is None:
+            yield ']}'
+        else:
+            yield '], "total": {}}}'.format(dumps(total))
+    return stream()
+
+
 @app.route('/bbox', methods=['GET'])
 @auth.require_oauth()
 @app.jsonify
 def bbox():
-    limit = min(int(request.args.get('limit', CollectionEndpoint.DEFAULT_LIMIT)), CollectionEndpoint.MAX_LIMIT)
+    limit = min(int(request.args.get('limit',
+                                     CollectionEndpoint.DEFAULT_LIMIT)),
+                CollectionEndpoint.MAX_LIMIT)
     bbox = get_bbox(request.args)
-    unique = request.args.get('unique')
-
-    dbname = config.DB_NAME
-    user = config.get('DB_USER')
-    password = config.get('DB_PASSWORD')
-    host = config.get('DB_HOST')
-    if (host is None):
-        host = "localhost"
-    port = config.get('DB_PORT')
-
-    connectString = "dbname='{}' user='{}' password='{}' host='{}' port='{}'".format(dbname,user,password,host,port)
-    conn = psycopg2.connect(connectString)
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    if unique == 'true':
-        cur.execute(
-            """SELECT count(distinct housenumber_id) FROM position WHERE center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s)""",
-            {
-                "west": bbox["west"],
-                "south": bbox["south"],
-                "east": bbox["east"],
-                "north": bbox["north"]
-            }
-        )
-        response = {"collection": [], "total": cur.fetchone()["count"]}
-        cur.execute(
-            """SELECT
-                p.id as pos_id, p.name as pos_name, st_x(center) as pos_x, st_y(center) as pos_y, p.kind as pos_kind, p.positioning as pos_positioning, p.source as pos_source, p.source_kind as pos_source_kind, p.version as pos_version,
-                h.id as hn_id, h.number as hn_number, h.ordinal as hn_ordinal, h.version as hn_version, 
-                po.id as post_id, po.name as post_name, po.code as post_code,
-                g.id as group_id, g.addressing as group_addressing, g.alias as group_alias, g.fantoir as group_fantoir, g.ign as group_ign, g.kind as group_kind, g.laposte as group_laposte, g.name as group_name
-                FROM position as p 
-                LEFT JOIN housenumber as h 
-                on (h.pk = p.housenumber_id) 
-                LEFT JOIN "group" as g 
-                on (h.parent_id = g.pk) 
-                LEFT JOIN postcode as po 
-                on (h.postcode_id = po.pk) 
-                WHERE center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s)
-                AND p.deleted_at is null AND h.deleted_at is null and g.deleted_at is null
-                AND p.modified_at = (select max(modified_at) from position where housenumber_id=h.pk and deleted_at is null)
-                limit %(limit)s""",
-            {
-                "limit": limit,
-                "west": bbox["west"],
-                "south": bbox["south"],
-                "east": bbox["east"],
-                "north": bbox["north"]
-            })
-    else:
-        cur.execute(
-            """SELECT count(*) FROM position WHERE center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s)""",
-            {
-                "west": bbox["west"],
-                "south": bbox["south"],
-                "east": bbox["east"],
-                "north": bbox["north"]
-            }
-        )
-        response = {"collection": [], "total": cur.fetchone()["count"]}
-        cur.execute(
-            """SELECT
-                p.id as pos_id, p.name as pos_name, st_x(center) as pos_x, st_y(center) as pos_y, p.kind as pos_kind, p.positioning as pos_positioning, p.source as pos_source, p.source_kind as pos_source_kind, p.version as pos_version,
-                h.id as hn_id, h.number as hn_number, h.ordinal as hn_ordinal, h.version as hn_version, 
-                po.id as post_id, po.name as post_name, po.code as post_code,
-                g.id as group_id, g.addressing as group_addressing, g.alias as group_alias, g.fantoir as group_fantoir, g.ign as group_ign, g.kind as group_kind, g.laposte as group_laposte, g.name as group_name
-                FROM position as p 
-                LEFT JOIN housenumber as h 
-                on (h.pk = p.housenumber_id) 
-                LEFT JOIN "group" as g 
-                on (h.parent_id = g.pk) 
-                LEFT JOIN postcode as po 
-                on (h.postcode_id = po.pk) 
-                WHERE center && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s)
-                AND p.deleted_at is null AND h.deleted_at is null and g.deleted_at is null
-                limit %(limit)s""",
-            {
-                "limit": limit,
-                "west": bbox["west"],
-                "south": bbox["south"],
-                "east": bbox["east"],
-                "north": bbox["north"]
-            })
-
-    for row in cur:
-        occ = {
-            "id": row["pos_id"],
-            "name": row["pos_name"],
-            "center": {
-                "type": "Point",
-                "coordinates": [row["pos_x"], row["pos_y"]]
-            },
-            "kind": row["pos_kind"],
-            "positioning": row["pos_positioning"],
-            "source": row["pos_source"],
-            "source_kind": row["pos_source_kind"],
-            "version": row["pos_version"],
-            "housenumber": {
-                "id": row["hn_id"],
-                "number": row["hn_number"],
-                "ordinal": row["hn_ordinal"],
-                "postcode": {
-                    "id": row["post_id"],
-                    "name": row["post_name"],
-                    "code": row["post_code"]
-                },
-                "group": {
-                    "id": row["group_id"],
-                    "addressing": row["group_addressing"],
-                    "alias": row["group_alias"],
-                    "fantoir": row["group_fantoir"],
-                    "ign": row["group_ign"],
-                    "kind": row["group_kind"],
-                    "laposte": row["group_laposte"],
-                    "name": row["group_name"]
-                },
-                "version":row["hn_version"]
-            }
-        }
-        response["collection"].append(occ)
-
-    return response, 200
+    if not bbox:
+        abort(400, error='Missing bbox')
+    unique = request.args.get('unique') == 'true'
+    cluster = request.args.get('cluster')
+    if cluster:
+        if cluster not in CLUSTER_MODES:
+            abort(400, error='Invalid value for cluster: {}. Value must be '
+                             '{}'.format(cluster, CLUSTER_MODES))
+        return bbox_clusters(bbox, cluster, unique), 200
+    mode = request.args.get('total', 'exact')
+    if mode not in BBOX_TOTAL_MODES:
+        abort(400, error='Invalid value for total: {}. Value must be {}'
+              .format(mode, BBOX_TOTAL_MODES))
+    sql = BBOX_SQL.format(unique=BBOX_UNIQUE_SQL if unique else '',
+                          distinct=BBOX_UNIQUE_DISTINCT if unique else '',
+                          total=BBOX_TOTAL_SQL if mode == 'exact' else '')
+    params = dict(bbox, limit=limit)
+    total = None if mode == 'exact' else bbox_total(mode, unique, params)
+    return Response(stream_with_context(stream_bbox(sql, params, mode, total)),
+                    mimetype='application/json')
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt', methods=['GET'])
+@auth.require_oauth()
+def tile(z, x, y):
+    """Mapbox Vector Tile of the positions, with more attributes as the zoom
+    grows. Empty (204) below the TILE_MIN_ZOOM setting (12 by default)."""
+    if not tiles.is_valid(z, x, y):
+        abort(404, error='Invalid tile {}/{}/{}'.format(z, x, y))
+    data = b''
+    if z >= tiles.min_zoom():
+        data = tiles.TILES.get(db.database, z, x, y)
+    if not data:
+        return Response(status=204)
+    return Response(data, mimetype='application/vnd.mapbox-vector-tile')
 
 
 @app.route('/openapi', methods=['GET'])
@@ -0,0 +1,138 @@
+"""
+Type-ahead on the group names of a municipality, answered from memory.
+Each municipality gets a sorted array of the folded forms of its groups names
+and aliases, searched by bisection. It is built at first use, and dropped when
+a Diff touches its insee. To keep PostgreSQL out of the way, the Diff feed is
+synced at most every AUTOCOMPLETE_SYNC_INTERVAL seconds, which is how much an
+index may lag behind. The sync is the response cache one, so Diffs committed
+out of pk order are caught too.
+"""
+from bisect import bisect_left
+import threading
+import time
+
+from ban.core import config
+from ban.core.models import Group, Municipality
+from ban.db import names
+from ban.db.cache import Store, UNSET
+
+from .cache import Increments
+
+
+class Index:
+    """Prefix index of the group names and aliases of one municipality."""
+
+    def __init__(self, rows):
+        entries = set()
+        for id, name, alias in rows:
+            for label in [name] + list(alias or []):
+                # Allow to omit the way type ("boul" for "Rue des Boulets").
+                for key in (names.fold(label), names.simplify(label)):
+                    if key:
+                        entries.add((key, label, id, name))
+        self.entries = sorted(entries)
+        self.keys = [entry[0] for entry in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def prefixed(self, prefix):
+        """Entries whose key starts with `prefix`, in key order."""
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            yield self.entries[i]
+            i += 1
+
+    def search(self, query, limit):
+        results = []
+        seen = set()
+        # Literal matches first.
+        prefixes = [names.fold(query)]
+        if names.simplify(query) != prefixes[0]:
+            prefixes.append(names.simplify(query))
+        for prefix in prefixes:
+            if not prefix:
+                continue
+            for key, label, id, name in self.prefixed(prefix):
+                if id in seen:
+                    continue
+                seen.add(id)
+                results.append({'id': id, 'name': name, 'label': label})
+                if len(results) >= limit:
+                    return results
+        return results
+
+
+class IndexIncrements(Increments):
+    """Drop the index of the insee touched by a Diff."""
+
+    def __init__(self, indexes):
+        super().__init__()
+        self.indexes = indexes
+
+    def process(self, pk, insee, *extra):
+        super().process(pk, insee)
+        self.indexes.forget(insee)
+
+
+class Indexes:
+
+    def __init__(self):
+        self.store = Store(size_key='AUTOCOMPLETE_SIZE', default_size=1000)
+        self.increments = IndexIncrements(self)
+        self.synced_at = 0
+        # Municipality identifier to insee, and back.
+        self.insees = {}
+        self.identifiers = {}
+        self.lock = threading.Lock()
+
+    def sync(self):
+        interval = float(config.get('AUTOCOMPLETE_SYNC_INTERVAL', 1))
+        now = time.monotonic()
+        if now - self.synced_at >= interval:
+            self.increments.sync()
+            self.synced_at = now
+
+    def resolve(self, identifier):
+        """Insee of a municipality identifier already seen, if any."""
+        self.sync()
+        return self.insees.get(identifier)
+
+    def remember(self, identifier, insee):
+        with self.lock:
+            self.insees[identifier] = insee
+            self.identifiers.setdefault(insee, set()).add(identifier)
+
+    def forget(self, insee):
+        self.store.discard(insee)
+        with self.lock:
+            for identifier in self.identifiers.pop(insee, ()):
+                self.insees.pop(identifier, None)
+
+    def get(self, insee):
+        self.sync()
+        index = self.store.get(insee)
+        if index is UNSET:
+            rows = (Group.select(Group.id, Group.name, Group.alias)
+                         .join(Municipality)
+                         .where(Municipality.insee == insee,
+                                Group.deleted_at.is_null())
+                         .order_by()
+                         .tuples())
+            index = Index(rows)
+            self.store[insee] = index
+        return index
+
+    def search(self, insee, query, limit):
+        return self.get(insee).search(query, limit)
+
+    def clear(self):
+        self.store.clear()
+        self.increments.clear()
+        self.synced_at = 0
+        with self.lock:
+            self.insees.clear()
+            self.identifiers.clear()
+
+
+INDEXES = Indexes()
@@ -0,0 +1,223 @@
+"""
+Response cache for read endpoints.
+The Diff table is a global change feed: a response is cached with the number
+of Diffs seen when it was computed, and tagged with the insee it depends on.
+It stays valid until a Diff is seen for one of its tags after it. Each lookup
+first syncs the Diffs added since the previous one, which is a range scan on
+the Diff primary key.
+
+Diff pks are handed out at insert time, not at commit time, so a Diff may
+show up below the last pk seen. The pks skipped by a sync are looked for
+again at each sync, for at most DIFF_GAP_TIMEOUT seconds. Past DIFF_GAP_MAX
+gaps, they are forgotten and every cached response is invalidated instead,
+not to grow the sync query without bound.
+
+Writes not recorded as Diffs (Diff.ACTIVE set to False, raw SQL…) are only
+caught up by the entries TTL, so the cache is only enabled when
+RESPONSE_CACHE is set.
+"""
+from functools import wraps
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import current_app, g, request
+from peewee import fn
+
+from ban.core import config
+from ban.core.versioning import Diff
+from ban.db.cache import Store, UNSET
+
+ALL = '*'  # Tag for responses depending on the whole database.
+
+
+class Increments:
+    """Count of the Diffs seen, globally and per insee."""
+
+    def __init__(self):
+        self.last = None  # Greatest Diff pk seen.
+        self.counter = 0
+        self.by_insee = {}
+        self.floor = 0  # Responses computed before are all stale.
+        # [first, last, since] ranges of pks skipped, and the pks seen since
+        # in those ranges.
+        self.gaps = []
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def sync(self):
+        with self.lock:
+            if self.last is None:
+                query = Diff.select(fn.MAX(Diff.pk)).order_by()
+                # The last pks may belong to transactions still running:
+                # start a bit before, to know their gaps.
+                window = int(config.get('DIFF_GAP_WINDOW', 1000))
+                self.last = max((query.scalar() or 0) - window, 0)
+            rows = [row for row in self.get_diffs()
+                    if row[0] not in self.seen]
+            for row in rows:
+                self.process(*row)
+            self.track([row[0] for row in rows])
+            return self.counter
+
+    def unseen(self):
+        """Condition on the Diffs not seen yet."""
+        condition = Diff.pk > self.last
+        for first, last, since in self.gaps:
+            condition |= Diff.pk.between(first, last)
+        return condition
+
+    def get_diffs(self):
+        return (Diff.select(Diff.pk, Diff.insee)
+                    .where(self.unseen())
+                    .order_by(Diff.pk)
+                    .tuples())
+
+    def track(self, pks):
+        """Update the last pk and the gaps from the `pks` just seen."""
+        now = time.monotonic()
+        timeout = float(config.get('DIFF_GAP_TIMEOUT', 600))
+        previous = self.last
+        for pk in sorted(pks):
+            if pk <= self.last:
+                self.seen.add(pk)
+                continue
+            if pk > previous + 1:
+                self.gaps.append([previous + 1, pk - 1, now])
+            previous = pk
+        self.last = previous
+        # Filled by a commit, or left by a rollback.
+        self.gaps = [
+            [first, last, since] for first, last, since in self.gaps
+            if now - since < timeout and
+            sum(first <= pk <= last for pk in self.seen) <= last - first]
+        if len(self.gaps) > int(config.get('DIFF_GAP_MAX', 100)):
+            self.counter += 1
+            self.floor = self.counter
+            self.gaps = []
+        self.seen = {pk for pk in self.seen
+                     if any(gap[0] <= pk <= gap[1] for gap in self.gaps)}
+
+    def process(self, pk, insee, *extra):
+        self.counter += 1
+        self.by_insee[insee] = self.counter
+
+    def is_fresh(self, increment, tags):
+        if increment < self.floor:
+            return False
+        for tag in tags:
+            latest = self.counter if tag == ALL else self.by_insee.get(tag, 0)
+            if latest > increment:
+                return False
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.last = None
+            self.counter = 0
+            self.floor = 0
+            self.by_insee.clear()
+            self.gaps = []
+            self.seen = set()
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self.store = Store(size_key='RESPONSE_CACHE_SIZE', default_size=1000)
+        self.increments = Increments()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'ratio': self.hits / lookups if lookups else 0,
+                'size': len(self.store)}
+
+    def get(self, key):
+        """Return the fresh entry for `key`, or None."""
+        entry = self.store.get(key)
+        if entry is not UNSET:
+            if self.increments.is_fresh(entry['increment'], entry['tags']):
+                self.hits += 1
+                return entry
+            del self.store[key]
+        self.misses += 1
+
+    def set(self, key, resp, increment, tags):
+        self.store[key] = {
+            'increment': increment,
+            'tags': tags or {ALL},
+            'data': resp.get_data(),
+            'status': resp.status_code,
+            'headers': list(resp.headers),
+        }
+
+    def clear(self):
+        self.store.clear()
+        self.increments.clear()
+        self.reset_stats()
+
+
+RESPONSES = ResponseCache()
+
+
+def is_enabled():
+    return bool(config.get('RESPONSE_CACHE'))
+
+
+def make_key():
+    # Normalized path, query string and token scope.
+    args = urlencode(sorted(request.args.items(multi=True)))
+    scopes = ' '.join(sorted(request.oauth.access_token.scopes))
+    return '{}?{}|{}'.format(request.path, args, scopes)
+
+
+def is_collecting():
+    """Is the current response going to be cached?"""
+    return hasattr(g, 'cache_tags')
+
+
+def tag(*insees):
+    """Declare the insee the current response depends on."""
+    if is_collecting():
+        g.cache_tags.update(insees)
+
+
+def cached(func):
+    """Cache the response of an endpoint method, when the endpoint is
+    `cacheable`."""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not is_enabled() or not self.cacheable or self.wants_stream():
+            return func(self, *args, **kwargs)
+        # Must be read before computing the response, so any write
+        # happening meanwhile will invalidate it.
+        increment = RESPONSES.increments.sync()
+        key = make_key()
+        entry = RESPONSES.get(key)
+        if entry is not None:
+            resp = current_app.response_class(entry['data'],
+                                              status=entry['status'],
+                                              headers=entry['headers'])
+            resp.headers['X-Cache'] = 'HIT'
+            return resp.make_conditional(request.environ)
+        g.cache_tags = set()
+        resp = func(self, *args, **kwargs)
+        if resp.status_code in (200, 410) and not resp.is_streamed:
+            RESPONSES.set(key, resp, increment, g.cache_tags)
+        resp.headers['X-Cache'] = 'MISS'
+        return resp
+    return wrapper
+
+
+def stats():
+    return RESPONSES.stats
+
+
+def clear():
+    RESPONSES.clear()
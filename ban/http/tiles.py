@@ -0,0 +1,170 @@
+"""
+Mapbox Vector Tiles of the positions.
+Tiles are computed by PostGIS (ST_AsMVT), with more attributes as the zoom
+grows, from TILE_MIN_ZOOM, and non empty ones may be cached in process
+(TILE_CACHE). A cached
+tile is dropped when a Diff moves, creates or deletes a position inside it,
+or when a Diff touches one of the municipalities it shows.
+"""
+from math import asinh, floor, pi, radians, tan
+
+from peewee import JOIN
+
+from ban.core import config
+from ban.core.versioning import Diff, Version
+from ban.db.cache import Store, UNSET
+
+from .cache import Increments
+
+EXTENT = 4096
+BUFFER = 64
+# Default TILE_MIN_ZOOM: below, a tile would hold too many positions.
+MIN_ZOOM = 12
+MAX_ZOOM = 22
+# Web Mercator half width, in meters.
+ORIGIN = 20037508.342789244
+# Attributes added from the given zoom.
+ATTRIBUTES = (
+    (0, ['p.id AS id', 'm.insee AS insee']),
+    (15, ['h.number AS number', 'h.ordinal AS ordinal', 'p.kind AS kind']),
+    (17, ['h.id AS housenumber', 'g.id AS "group"', 'g.name AS group_name',
+          'p.positioning AS positioning', 'p.source_kind AS source_kind']),
+)
+SQL = """WITH rows AS (
+    SELECT ST_AsMVTGeom(ST_Transform(p.center, 3857),
+                        ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s,
+                                        %(ymax)s, 3857),
+                        %(extent)s, %(buffer)s, true) AS geom,
+           {attributes}
+    FROM position AS p
+    JOIN housenumber AS h ON (h.pk = p.housenumber_id)
+    JOIN "group" AS g ON (h.parent_id = g.pk)
+    JOIN municipality AS m ON (g.municipality_id = m.pk)
+    WHERE p.center && ST_Transform(ST_MakeEnvelope(%(bxmin)s, %(bymin)s,
+                                                   %(bxmax)s, %(bymax)s,
+                                                   3857), 4326)
+    AND p.deleted_at IS NULL AND h.deleted_at IS NULL
+    AND g.deleted_at IS NULL
+)
+SELECT ST_AsMVT(rows, 'positions', %(extent)s, 'geom'),
+       array_agg(DISTINCT insee)
+FROM rows"""
+
+
+def min_zoom():
+    """Tiles below this zoom are empty."""
+    return int(config.get('TILE_MIN_ZOOM', MIN_ZOOM))
+
+
+def is_valid(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def envelope(z, x, y, margin=0):
+    """Web Mercator bounds of tile (z, x, y), grown by `margin` (in tile
+    extent unit)."""
+    size = 2 * ORIGIN / 2 ** z
+    margin = size * margin / EXTENT
+    xmin = -ORIGIN + x * size
+    ymax = ORIGIN - y * size
+    return (xmin - margin, ymax - size - margin, xmin + size + margin,
+            ymax + margin)
+
+
+def around(lon, lat):
+    """Keys of the cached tiles (buffer included) containing (lon, lat)."""
+    keys = set()
+    margin = BUFFER / EXTENT
+    for z in range(min_zoom(), MAX_ZOOM + 1):
+        n = 2 ** z
+        fx = (lon + 180) / 360 * n
+        fy = (1 - asinh(tan(radians(lat))) / pi) / 2 * n
+        for dx in (-margin, 0, margin):
+            for dy in (-margin, 0, margin):
+                x, y = floor(fx + dx), floor(fy + dy)
+                if is_valid(z, x, y):
+                    keys.add(key(z, x, y))
+    return keys
+
+
+def key(z, x, y):
+    return '{}/{}/{}'.format(z, x, y)
+
+
+def make_sql(z):
+    attributes = []
+    for zoom, names in ATTRIBUTES:
+        if z >= zoom:
+            attributes.extend(names)
+    return SQL.format(attributes=', '.join(attributes))
+
+
+def compute(database, z, x, y):
+    """Return the tile content and the insee it shows."""
+    xmin, ymin, xmax, ymax = envelope(z, x, y)
+    bxmin, bymin, bxmax, bymax = envelope(z, x, y, BUFFER)
+    params = dict(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, bxmin=bxmin,
+                  bymin=bymin, bxmax=bxmax, bymax=bymax, extent=EXTENT,
+                  buffer=BUFFER)
+    data, insees = database.execute_sql(make_sql(z), params).fetchone()
+    return bytes(data or b''), [i for i in insees or [] if i]
+
+
+class TileIncrements(Increments):
+    """Also evict the tiles around the old and new centers of the positions
+    changed by a Diff."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def get_diffs(self):
+        old, new = Version.alias(), Version.alias()
+        # A delta version only holds the center when it moved, otherwise the
+        # tiles showing the position are already evicted by their insee tag.
+        return (Diff.select(Diff.pk, Diff.insee, old.stored['center'],
+                            new.stored['center'])
+                    .join(old, JOIN.LEFT_OUTER, on=(Diff.old == old.pk))
+                    .switch(Diff)
+                    .join(new, JOIN.LEFT_OUTER, on=(Diff.new == new.pk))
+                    .where(self.unseen())
+                    .order_by(Diff.pk)
+                    .tuples())
+
+    def process(self, pk, insee, *centers):
+        super().process(pk, insee)
+        for center in centers:
+            if center and center.get('coordinates'):
+                for k in around(*center['coordinates'][:2]):
+                    self.store.discard(k)
+
+
+class TileCache:
+
+    def __init__(self):
+        self.store = Store(size_key='TILE_CACHE_SIZE')
+        self.increments = TileIncrements(self.store)
+
+    def get(self, database, z, x, y):
+        if not config.get('TILE_CACHE'):
+            return compute(database, z, x, y)[0]
+        increment = self.increments.sync()
+        k = key(z, x, y)
+        entry = self.store.get(k)
+        if (entry is not UNSET and
+                self.increments.is_fresh(entry['increment'], entry['tags'])):
+            return entry['data']
+        data, insees = compute(database, z, x, y)
+        # An empty tile has no insee to be invalidated by, and is cheap to
+        # compute again.
+        if insees:
+            self.store[k] = {'increment': increment, 'tags': insees,
+                             'data': data}
+        return data
+
+    def clear(self):
+        self.store.clear()
+        self.increments.clear()
+
+
+TILES = TileCache()
@@ -1,5 +1,7 @@
+from datetime import timezone
 from urllib.parse import quote
 
+from dateutil.parser import parse as parse_date
 from werkzeug.exceptions import HTTPException
 from flask import Response
 
@@ -30,6 +32,20 @@ def get_bbox(args):
     return bbox
 
 
+def get_as_of(args):
+    value = args.get('as_of')
+    if not value:
+        return None
+    try:
+        as_of = parse_date(value)
+    except (ValueError, OverflowError):
+        abort(400, error='Invalid value for as_of: {}'.format(value))
+    # Naive datetimes are in UTC, as for the versions endpoints.
+    if not as_of.tzinfo:
+        as_of = as_of.replace(tzinfo=timezone.utc)
+    return as_of
+
+
 def get_search_params(args):
     enum_types = ['strict', 'case', 'abbrev', 'libelle', 'ponctuation', 'direct', 'approx']
     type = args.get('searchType') if args.get('searchType') is not None else 'strict'
@@ -9,7 +9,7 @@ from werkzeug.routing import BaseConverter, ValidationError
 
 from ban.core import context
 from ban.core.encoder import dumps
-from ban.db import database
+from ban.db import database, notifications
 
 from .schema import Schema
 
@@ -21,6 +21,9 @@ class App(Flask):
         @wraps(func)
         def wrapper(*args, **kwargs):
             rv = func(*args, **kwargs)
+            if isinstance(rv, self.response_class):
+                # Already encoded (eg. streamed) response.
+                return rv
             if not isinstance(rv, tuple):
                 rv = [rv]
             else:
@@ -111,6 +114,14 @@ def log_headers(resp):
     return resp
 
 
+@app.before_first_request
+def listen_cache_invalidations():
+    # Off in tests: the cache clearing on connect would make them depend on
+    # their order.
+    if app.config.get('CACHE_LISTENER', True):
+        notifications.listen(database)
+
+
 @app.before_request
 def connect_db():
     database.connect()
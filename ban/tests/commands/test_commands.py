@@ -1,15 +1,18 @@
 import pytest
 
 import json
+from datetime import datetime, timedelta, timezone
 from unittest.mock import Mock
 from pathlib import Path
 
 from ban.auth import models as amodels
 from ban.commands.auth import (createclient, createuser, dummytoken,
                                listclients, listusers, invalidatetoken)
-from ban.commands.db import truncate
+from ban.commands.db import (compact_versions, encode_versions, migrate,
+                             normalize, truncate)
 from ban.commands.export import resources
 from ban.core import models
+from ban.core.versioning import Diff, Version
 from ban.core.encoder import dumps
 from ban.tests import factories
 from ban.utils import utcnow
@@ -142,6 +145,134 @@ def test_truncate_should_not_ask_for_confirm_in_force_mode(monkeypatch):
     assert not models.Municipality.select().count()
 
 
+def test_normalize_should_backfill_normalized_names():
+    group = factories.GroupFactory(name="Rue de l'Église",
+                                   alias=['Chemin du Moulin'])
+    models.Group.update(name_normalized=None, alias_normalized=None).execute()
+    normalize('group')
+    group = models.Group.get(models.Group.pk == group.pk)
+    assert group.name_normalized == 'EGLISE'
+    assert group.alias_normalized == 'MOULIN'
+    assert group.version == 1
+
+
+def test_normalize_should_create_missing_trigram_indexes():
+    database = models.Group._meta.database
+    database.execute_sql('DROP INDEX "group_name_normalized_trgm"')
+    normalize('group')
+    cursor = database.execute_sql(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'group'")
+    indexes = [row[0] for row in cursor.fetchall()]
+    assert 'group_name_normalized_trgm' in indexes
+    assert 'group_alias_normalized_trgm' in indexes
+
+
+def test_migrate_should_add_the_missing_columns():
+    factories.GroupFactory(name='Rue des Pommes')
+    database = models.Group._meta.database
+    database.execute_sql('ALTER TABLE "group" DROP COLUMN centroid')
+    database.execute_sql('ALTER TABLE version DROP COLUMN snapshot')
+    migrate()
+    columns = [c.name for c in database.get_columns('group')]
+    assert 'centroid' in columns
+    assert [i.name for i in database.get_indexes('group')
+            if i.columns == ['centroid']]
+    version = Version.get()
+    assert version.snapshot is True
+    assert version.data['name'] == 'Rue des Pommes'
+    migrate()  # Nothing left to do.
+
+
+def test_encode_versions_should_convert_history(config):
+    # Restored after the test, while the command sets it.
+    config.VERSION_SNAPSHOT_INTERVAL = 1
+    group = factories.GroupFactory(name='Rue des Pommes')
+    for name in ['Rue des Poires', 'Rue des Prunes']:
+        group.name = name
+        group.increment_version()
+        group.save()
+    documents = [v.data for v in group.versions]
+    encode_versions('group', interval=2)
+    assert [v.snapshot for v in group.versions] == [True, False, True]
+    assert [v.data for v in group.versions] == documents
+    encode_versions('group', interval=1)
+    assert all(v.snapshot for v in group.versions)
+    assert [v.stored for v in group.versions] == documents
+
+
+def make_history(names):
+    group = factories.GroupFactory(name=names[0])
+    for name in names[1:]:
+        group.name = name
+        group.increment_version()
+        group.save()
+    # Versions closed a few seconds apart, long ago.
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    for version in group.versions:
+        lower = start + timedelta(seconds=version.sequential)
+        upper = None
+        if version.sequential < len(names):
+            upper = lower + timedelta(seconds=1)
+        if version.sequential == len(names):
+            lower = datetime.now(timezone.utc)
+        Version.update(period=[lower, upper]).where(
+            Version.pk == version.pk).execute()
+    return group
+
+
+def test_compact_versions_should_merge_old_versions(monkeypatch, config):
+    config.VERSION_SNAPSHOT_INTERVAL = 1
+    monkeypatch.setattr(Diff, 'ACTIVE', False)
+    names = ['Rue des Pommes', 'Rue des Poires', 'Rue des Prunes',
+             'Rue des Fraises']
+    group = make_history(names)
+    compact_versions('group')
+    versions = list(group.versions)
+    assert [v.sequential for v in versions] == [3, 4]
+    assert [v.data['name'] for v in versions] == names[2:]
+    assert versions[0].period.lower == datetime(2015, 1, 1, 0, 0, 1,
+                                                tzinfo=timezone.utc)
+    assert group.load_version(datetime(2015, 1, 1, 0, 0, 2, 500000,
+                                       tzinfo=timezone.utc)).sequential == 3
+
+
+def test_compact_versions_should_rebuild_deltas(monkeypatch, config):
+    config.VERSION_SNAPSHOT_INTERVAL = 4
+    monkeypatch.setattr(Diff, 'ACTIVE', False)
+    names = ['Rue des Pommes', 'Rue des Poires', 'Rue des Prunes',
+             'Rue des Fraises']
+    group = make_history(names)
+    municipality = group.versions[0].data['municipality']
+    compact_versions('group')
+    versions = list(group.versions)
+    assert [v.snapshot for v in versions] == [True, False]
+    assert [v.data['name'] for v in versions] == names[2:]
+    assert versions[1].data['municipality'] == municipality
+
+
+def test_compact_versions_should_keep_versions_with_diff():
+    names = ['Rue des Pommes', 'Rue des Poires', 'Rue des Prunes']
+    group = make_history(names)
+    compact_versions('group')
+    assert len(group.versions) == 3
+
+
+def test_compact_versions_should_merge_versions_of_deleted_diffs():
+    names = ['Rue des Pommes', 'Rue des Poires', 'Rue des Prunes']
+    group = make_history(names)
+    compact_versions('group', diffs_days=0)
+    assert not Diff.select().count()
+    assert [v.sequential for v in group.versions] == [2, 3]
+
+
+def test_compact_versions_should_coerce_its_numbers(monkeypatch):
+    monkeypatch.setattr(Diff, 'ACTIVE', False)
+    names = ['Rue des Pommes', 'Rue des Poires', 'Rue des Prunes']
+    group = make_history(names)
+    compact_versions('group', days='30', size='10', diffs_days='0')
+    assert [v.sequential for v in group.versions] == [2, 3]
+
+
 def test_export_municipality():
     mun = factories.MunicipalityFactory()
     path = Path(__file__).parent / 'data'
@@ -1,7 +1,9 @@
 import json
 
+from ban.commands.helpers import BulkSaver
 from ban.commands.init import process_row, init
 from ban.core import models
+from ban.core.versioning import ForcedVersionError
 from ban.tests import factories
 
 
@@ -28,6 +30,52 @@ def test_init_should_accept_limit_argument(tmpdir):
     assert models.Municipality.select().count() == 1
 
 
+def test_init_should_see_the_previous_rows_of_a_batch(tmpdir):
+    factories.MunicipalityFactory(insee="90008")
+    f = tmpdir.join("groups.sjson")
+    rows = [{"type": "group", "source": source, "group": "way",
+             "municipality:insee": "90008", "fantoir": "900080203",
+             "name": name}
+            for source, name in [('DGFIP/FANTOIR (2015-07)', 'GRANDE RUE'),
+                                 ('IGN (2015)', 'GRANDE RUE F. MITTERRAND')]]
+    rows.append({"type": "group", "source": "IGN (2015)", "group": "way",
+                 "municipality:insee": "90008", "fantoir": "900080204",
+                 "name": "RUE BASSE"})
+    f.write('\n'.join(json.dumps(row) for row in rows))
+    factories.ClientFactory(name='client')
+    init('client', 'dev', str(f))
+    assert models.Group.select().count() == 2
+    group = models.Group.get(models.Group.fantoir == '900080203')
+    assert group.name == 'GRANDE RUE F. MITTERRAND'
+    assert group.version == 2
+
+
+def test_bulk_saver_should_retry_from_the_state_before_the_bulk_save(session):
+    street = factories.GroupFactory(name="Rue des Lilas")
+    other = factories.GroupFactory(name="Rue des Roses")
+    good = models.Group.validator(instance=street, update=True,
+                                  name="Rue des Lys", version=2)
+    wrong = models.Group.validator(instance=other, update=True,
+                                   name="Rue des Iris", version=3)
+    reports = []
+    saver = BulkSaver()
+    for validator in (good, wrong):
+        def save(validator=validator):
+            try:
+                validator.save()
+            except ForcedVersionError:
+                reports.append('error')
+            else:
+                reports.append('saved')
+        saver.add(validator, save, lambda: reports.append('bulk'))
+    saver.flush()
+    assert reports == ['saved', 'error']
+    street = models.Group.get(models.Group.pk == street.pk)
+    assert street.name == "Rue des Lys"
+    assert street.version == 2
+    assert models.Group.get(models.Group.pk == other.pk).version == 1
+
+
 def test_does_not_file_for_unknown_type(session):
     data = {"type": "unknown", "source": "INSEE/COG (2015)",
             "insee": "22059", "name": "Le Fœil"}
@@ -20,6 +20,13 @@ def test_get_anomaly(get):
     assert resp.json["total"] == 1
 
 
+@authorize
+def test_get_anomaly_collection_rejects_as_of(get):
+    AnomalyFactory(kind="hn vide")
+    resp = get('/anomaly?as_of=2015-01-01')
+    assert resp.status_code == 400
+
+
 @authorize
 def test_get_anomaly_by_id(get):
     anomaly = AnomalyFactory(kind="hn vide")
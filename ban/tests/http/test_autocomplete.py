@@ -0,0 +1,110 @@
+import pytest
+
+from ban.core.versioning import Diff
+from ban.http import autocomplete
+
+from ..factories import GroupFactory, MunicipalityFactory
+from .utils import authorize
+
+
+@pytest.fixture(autouse=True)
+def indexes(config):
+    config.AUTOCOMPLETE_SYNC_INTERVAL = 0
+    autocomplete.INDEXES.clear()
+    yield autocomplete.INDEXES
+    autocomplete.INDEXES.clear()
+
+
+def test_index_should_match_name_prefix():
+    index = autocomplete.Index([('abc', 'Rue des Boulets', []),
+                                ('def', 'Rue de la Paix', [])])
+    results = index.search('rue des bou', 10)
+    assert results == [{'id': 'abc', 'name': 'Rue des Boulets',
+                        'label': 'Rue des Boulets'}]
+
+
+def test_index_should_match_without_way_type_nor_accent():
+    index = autocomplete.Index([('abc', 'Rue de la Boulangère', []),
+                                ('def', 'Rue des Boulets', [])])
+    results = index.search('boula', 10)
+    assert [r['id'] for r in results] == ['abc']
+
+
+def test_index_should_match_alias():
+    index = autocomplete.Index([('abc', 'Rue des Boulets',
+                                 ['Chemin du Moulin'])])
+    results = index.search('chemin du m', 10)
+    assert results == [{'id': 'abc', 'name': 'Rue des Boulets',
+                        'label': 'Chemin du Moulin'}]
+
+
+def test_index_should_respect_limit():
+    index = autocomplete.Index([(str(i), 'Rue {}'.format(i), [])
+                                for i in range(10)])
+    assert len(index.search('rue', 3)) == 3
+
+
+@authorize
+def test_get_autocomplete(get):
+    municipality = MunicipalityFactory()
+    group = GroupFactory(municipality=municipality, name="Rue des Boulets")
+    GroupFactory(municipality=municipality, name="Rue de la Paix")
+    GroupFactory(name="Rue des Boulets")  # Other municipality.
+    resp = get('/municipality/{}/autocomplete?q=boul'.format(municipality.id))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    assert resp.json['collection'][0]['id'] == group.id
+
+
+@authorize
+def test_get_autocomplete_without_query(get):
+    municipality = MunicipalityFactory()
+    resp = get('/municipality/{}/autocomplete'.format(municipality.id))
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_autocomplete_of_unknown_municipality(get):
+    resp = get('/municipality/unknown/autocomplete?q=rue')
+    assert resp.status_code == 404
+
+
+@authorize
+def test_autocomplete_does_not_query_database_once_built(get, sql_spy,
+                                                         config):
+    config.AUTOCOMPLETE_SYNC_INTERVAL = 60
+    municipality = MunicipalityFactory()
+    GroupFactory(municipality=municipality, name="Rue des Boulets")
+    url = '/municipality/{}/autocomplete?q=boul'.format(municipality.id)
+    assert get(url).json['total'] == 1
+    sql_spy.reset_mock()
+    assert get(url).json['total'] == 1
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert not [sql for sql in sqls if '"group"' in sql or '"diff"' in sql]
+
+
+@authorize
+def test_autocomplete_is_updated_by_diff(get):
+    municipality = MunicipalityFactory()
+    url = '/municipality/{}/autocomplete?q=boul'.format(municipality.id)
+    assert get(url).json['total'] == 0
+    GroupFactory(municipality=municipality, name="Rue des Boulets")
+    assert get(url).json['total'] == 1
+
+
+@authorize
+def test_autocomplete_sees_diff_committed_out_of_order(get):
+    municipality = MunicipalityFactory()
+    group = GroupFactory(municipality=municipality, name="Rue des Boulets")
+    url = '/municipality/{}/autocomplete?q={}'
+    assert get(url.format(municipality.id, 'boul')).json['total'] == 1
+    group.name = "Rue des Lilas"
+    group.increment_version()
+    group.save()
+    # The rename Diff is committed after a later one has been synced.
+    diff = Diff.select().order_by(Diff.pk.desc()).get()
+    diff.delete_instance()
+    MunicipalityFactory()
+    assert get(url.format(municipality.id, 'lila')).json['total'] == 0
+    diff.save(force_insert=True)
+    assert get(url.format(municipality.id, 'lila')).json['total'] == 1
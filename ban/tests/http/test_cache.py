@@ -0,0 +1,140 @@
+import pytest
+
+from ban.core.versioning import Diff
+from ban.http import cache
+from ban.utils import utcnow
+
+from ..factories import GroupFactory, HouseNumberFactory, MunicipalityFactory
+from .utils import authorize
+
+
+@pytest.fixture
+def response_cache(config):
+    config.RESPONSE_CACHE = True
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@authorize
+def test_resource_response_is_cached(get, response_cache):
+    municipality = MunicipalityFactory(name="Cabour")
+    url = '/municipality/{}'.format(municipality.id)
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'MISS'
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'HIT'
+    assert resp.json['name'] == 'Cabour'
+    assert cache.stats()['ratio'] == 0.5
+
+
+@authorize
+def test_resource_response_is_invalidated_by_diff_on_same_insee(
+        get, response_cache):
+    municipality = MunicipalityFactory(name="Cabour")
+    url = '/municipality/{}'.format(municipality.id)
+    get(url)
+    municipality.name = "Cabour-sur-Mer"
+    municipality.increment_version()
+    municipality.save()
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'MISS'
+    assert resp.json['name'] == 'Cabour-sur-Mer'
+
+
+@authorize
+def test_resource_response_is_not_invalidated_by_other_insee(
+        get, response_cache):
+    housenumber = HouseNumberFactory(parent__municipality__insee='12345')
+    url = '/housenumber/{}'.format(housenumber.id)
+    get(url)
+    MunicipalityFactory(insee='54321')
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'HIT'
+
+
+@authorize
+def test_collection_response_is_invalidated_by_any_diff(get, response_cache):
+    MunicipalityFactory(insee='12345')
+    resp = get('/municipality')
+    assert resp.json['total'] == 1
+    MunicipalityFactory(insee='54321')
+    resp = get('/municipality')
+    assert resp.headers['X-Cache'] == 'MISS'
+    assert resp.json['total'] == 2
+
+
+@authorize
+def test_filtered_collection_response_is_not_invalidated_by_other_insee(
+        get, response_cache):
+    municipality = MunicipalityFactory(insee='12345')
+    GroupFactory(municipality=municipality)
+    url = '/group?municipality={}'.format(municipality.id)
+    get(url)
+    GroupFactory(municipality__insee='54321')
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'HIT'
+    GroupFactory(municipality=municipality)
+    resp = get(url)
+    assert resp.headers['X-Cache'] == 'MISS'
+    assert resp.json['total'] == 2
+
+
+@authorize
+def test_cached_response_key_includes_query_string(get, response_cache):
+    municipality = MunicipalityFactory(name="Cabour")
+    url = '/municipality/{}'.format(municipality.id)
+    get(url)
+    resp = get(url + '?fields=name')
+    assert resp.headers['X-Cache'] == 'MISS'
+    assert resp.json == {'name': 'Cabour'}
+
+
+@authorize
+def test_cached_response_honours_conditional_get(get, response_cache):
+    municipality = MunicipalityFactory(name="Cabour")
+    url = '/municipality/{}'.format(municipality.id)
+    etag = get(url).headers['ETag']
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+
+def make_late_diff(insee):
+    """Simulate a Diff given a pk before the last one, but committed after
+    it was synced."""
+    first = MunicipalityFactory()
+    MunicipalityFactory()
+    pk = Diff.get(Diff.insee == first.insee).pk
+    Diff.delete().where(Diff.pk == pk).execute()
+    return lambda: Diff.insert(pk=pk, insee=insee, diff={},
+                               created_at=utcnow()).execute()
+
+
+@authorize
+def test_resource_response_is_invalidated_by_diff_committed_late(
+        get, response_cache):
+    municipality = MunicipalityFactory(name="Cabour")
+    url = '/municipality/{}'.format(municipality.id)
+    commit = make_late_diff(municipality.insee)
+    get(url)
+    assert get(url).headers['X-Cache'] == 'HIT'
+    commit()
+    assert get(url).headers['X-Cache'] == 'MISS'
+
+
+def test_increments_forget_gaps_after_timeout(config):
+    config.DIFF_GAP_TIMEOUT = 0
+    increments = cache.Increments()
+    make_late_diff('12345')
+    increments.sync()
+    assert increments.gaps == []
+
+
+def test_increments_invalidate_everything_past_max_gaps(config):
+    config.DIFF_GAP_MAX = 0
+    increments = cache.Increments()
+    increment = increments.sync()
+    make_late_diff('12345')
+    increments.sync()
+    assert increments.gaps == []
+    assert not increments.is_fresh(increment, ['54321'])
@@ -1,9 +1,13 @@
 import json
+from collections import OrderedDict
+from urllib.parse import urlencode
 
 from ban.core import models
 from ban.core.encoder import dumps
+from ban.utils import utcnow
 
-from ..factories import HouseNumberFactory, MunicipalityFactory, GroupFactory
+from ..factories import (HouseNumberFactory, MunicipalityFactory, GroupFactory,
+                         PositionFactory)
 from .utils import authorize
 
 
@@ -347,3 +351,135 @@ def test_group_select_use_default_orderby(get):
     assert resp.json['total'] == 2
     assert resp.json['collection'][0]['fantoir'] == '900010002'
     assert resp.json['collection'][1]['fantoir'] == '900010001'
+
+
+@authorize
+def test_get_group_name_search_abbrev(get):
+    GroupFactory(name="Rue des Boulets")
+    resp = get('/group?searchName=R+des+Boulets&searchType=abbrev')
+    assert resp.status_code == 200
+    assert resp.json['collection'][0]['name'] == "Rue des Boulets"
+
+
+@authorize
+def test_get_group_name_search_direct(get):
+    GroupFactory(name="Rue de la Boulangère")
+    resp = get('/group?searchName=boulangere&searchType=direct')
+    assert resp.status_code == 200
+    assert resp.json['collection'][0]['name'] == "Rue de la Boulangère"
+
+
+@authorize
+def test_get_group_name_search_approx_is_ranked(get):
+    GroupFactory(name="Rue des Boulets")
+    GroupFactory(name="Rue de la Boulette")
+    GroupFactory(name="Rue des Moulins")
+    resp = get('/group?searchName=rue+des+boulet&searchType=approx')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    names = [g['name'] for g in resp.json['collection']]
+    assert names == ["Rue des Boulets", "Rue de la Boulette"]
+    scores = [g['score'] for g in resp.json['collection']]
+    assert scores[0] > scores[1]
+
+
+@authorize
+def test_get_group_name_search_approx_can_be_limited_to_municipality(get):
+    group = GroupFactory(name="Rue des Boulets")
+    GroupFactory(name="Rue des Boulets")
+    resp = get('/group?searchName=boulets&searchType=approx&municipality={}'
+               .format(group.municipality.id))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    assert resp.json['collection'][0]['id'] == group.id
+
+
+@authorize
+def test_get_group_collection_filtered_by_bbox(get):
+    street = GroupFactory(name="Rue des Boulets")
+    PositionFactory(housenumber__parent=street, center=(1, 1))
+    other = GroupFactory(name="Rue des Fleurs")
+    PositionFactory(housenumber__parent=other, center=(10, 10))
+    resp = get('/group?north=2&south=0&west=0&east=2')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    assert resp.json['collection'][0]['id'] == street.id
+    assert resp.json['collection'][0]['centroid'] == {
+        'type': 'Point', 'coordinates': [1, 1]}
+
+
+@authorize
+def test_get_group_response_keys_are_sorted(get):
+    street = GroupFactory(name="Rue des Boulets")
+    resp = get('/group/{}?fields=name,kind,id,municipality.name'.format(
+        street.id))
+    data = json.loads(resp.data.decode(), object_pairs_hook=OrderedDict)
+    assert list(data) == ['id', 'kind', 'municipality', 'name']
+    resp = get('/group?fields=name,kind,id')
+    data = json.loads(resp.data.decode(), object_pairs_hook=OrderedDict)
+    assert list(data['collection'][0]) == ['id', 'kind', 'name']
+
+
+@authorize
+def test_get_group_collection_as_of(get):
+    street = GroupFactory(name="Rue des Boulets")
+    other = GroupFactory(name="Rue des Fleurs")
+    as_of = utcnow()
+    street.name = "Rue des Bleuets"
+    street.increment_version()
+    street.save()
+    other.mark_deleted()
+    GroupFactory(name="Rue des Lilas")  # Created after as_of.
+    resp = get('/group?{}'.format(urlencode({'as_of': as_of.isoformat()})))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    assert [g['name'] for g in resp.json['collection']] == [
+        "Rue des Boulets", "Rue des Fleurs"]
+    assert resp.json['collection'][0]['version'] == 1
+    resp = get('/group?{}'.format(urlencode({'as_of': utcnow().isoformat()})))
+    assert [g['name'] for g in resp.json['collection']] == [
+        "Rue des Bleuets", "Rue des Lilas"]
+
+
+@authorize
+def test_get_group_collection_as_of_does_not_query_flags(get, sql_spy):
+    GroupFactory(name="Rue des Boulets")
+    as_of = utcnow()
+    resp = get('/group?{}'.format(urlencode({'as_of': as_of.isoformat()})))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert not any('"flag"' in sql for sql in sqls)
+
+
+@authorize
+def test_get_group_collection_as_of_with_fields(get):
+    street = GroupFactory(name="Rue des Boulets")
+    resp = get('/group?{}'.format(urlencode({'as_of': utcnow().isoformat(),
+                                             'fields': 'id,name'})))
+    assert resp.status_code == 200
+    assert resp.json['collection'] == [{'id': street.id,
+                                        'name': "Rue des Boulets"}]
+
+
+@authorize
+def test_get_group_collection_as_of_rebuilds_deltas(get, config):
+    config.VERSION_SNAPSHOT_INTERVAL = 10
+    street = GroupFactory(name="Rue des Boulets")
+    street.name = "Rue des Bleuets"
+    street.increment_version()
+    street.save()
+    as_of = utcnow()
+    street.name = "Rue des Lilas"
+    street.increment_version()
+    street.save()
+    resp = get('/group?{}'.format(urlencode({'as_of': as_of.isoformat()})))
+    assert resp.status_code == 200
+    assert resp.json['collection'][0]['name'] == "Rue des Bleuets"
+    assert resp.json['collection'][0]['id'] == street.id
+
+
+@authorize
+def test_get_group_collection_with_invalid_as_of(get):
+    resp = get('/group?as_of=notadate')
+    assert resp.status_code == 400
@@ -1,7 +1,10 @@
 import json
+from base64 import urlsafe_b64encode
+from urllib.parse import quote
 
 from ban.core import models
 from ban.core.encoder import dumps
+from ban.utils import utcnow
 
 from ..factories import (GroupFactory, HouseNumberFactory,
                          MunicipalityFactory, PositionFactory, PostCodeFactory)
@@ -39,6 +42,91 @@ def test_get_housenumber(get):
     }
 
 
+@authorize
+def test_get_housenumber_with_if_none_match(get, sql_spy):
+    housenumber = HouseNumberFactory(number="22")
+    url = '/housenumber/{}?fields=number,parent'.format(housenumber.id)
+    resp = get(url)
+    etag = resp.headers['ETag']
+    assert resp.headers['Last-Modified']
+    sql_spy.reset_mock()
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not resp.data
+    assert resp.headers['ETag'] == etag
+    # Only the validators are loaded, not the resource.
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert not any('"number"' in sql for sql in sqls)
+    # Another mask means another representation.
+    resp = get('/housenumber/{}?fields=number'.format(housenumber.id),
+               headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+
+
+@authorize
+def test_get_housenumber_with_outdated_etag(get):
+    housenumber = HouseNumberFactory(number="22")
+    url = '/housenumber/{}?fields=number'.format(housenumber.id)
+    resp = get(url)
+    etag = resp.headers['ETag']
+    housenumber.number = '23'
+    housenumber.increment_version()
+    housenumber.save()
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json['number'] == '23'
+    assert resp.headers['ETag'] != etag
+
+
+@authorize
+def test_get_housenumber_with_if_modified_since(get):
+    housenumber = HouseNumberFactory(number="22")
+    url = '/housenumber/{}?fields=number'.format(housenumber.id)
+    resp = get(url)
+    resp = get(url,
+               headers={'If-Modified-Since': resp.headers['Last-Modified']})
+    assert resp.status_code == 304
+    resp = get(url,
+               headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    assert resp.status_code == 200
+
+
+@authorize
+def test_get_housenumber_etag_follows_embedded_relations(get):
+    housenumber = HouseNumberFactory(number="22")
+    url = '/housenumber/{}'.format(housenumber.id)
+    resp = get(url)
+    etag = resp.headers['ETag']
+    # Positions change without a new housenumber version.
+    assert 'Last-Modified' not in resp.headers
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    position = PositionFactory(housenumber=housenumber)
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json['positions'] == [position.id]
+    url = '/housenumber/{}?fields=number,parent.name'.format(housenumber.id)
+    etag = get(url).headers['ETag']
+    parent = housenumber.parent
+    parent.name = 'Rue des Lilas'
+    parent.increment_version()
+    parent.save()
+    resp = get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json['parent']['name'] == 'Rue des Lilas'
+
+
+@authorize
+def test_get_housenumber_without_validators_for_computed_fields(get):
+    housenumber = HouseNumberFactory(number="22")
+    # The group extent changes without a new version.
+    resp = get('/housenumber/{}?fields=number,parent.extent'.format(
+        housenumber.id))
+    assert resp.status_code == 200
+    assert 'ETag' not in resp.headers
+    assert 'Last-Modified' not in resp.headers
+
+
 @authorize
 def test_get_housenumber_with_filtered_fields(get):
     housenumber = HouseNumberFactory(number="22")
@@ -176,6 +264,22 @@ def test_get_housenumber_with_ancestors(get):
     assert resp.status_code == 200
     assert resp.json['total'] == 1
 
+
+@authorize
+def test_get_housenumber_with_ancestors_as_of(get):
+    municipality = MunicipalityFactory()
+    ancestor = GroupFactory(municipality=municipality, kind=models.Group.AREA)
+    housenumber = HouseNumberFactory(number='22', ancestors=[ancestor],
+                                     parent__municipality=municipality)
+    as_of = utcnow()
+    housenumber.number = '23'
+    housenumber.increment_version()
+    housenumber.save()
+    resp = get('/housenumber?ancestors={}&as_of={}'.format(
+        ancestor.id, quote(as_of.isoformat())))
+    assert resp.status_code == 200
+    assert [h['number'] for h in resp.json['collection']] == ['22']
+
 @authorize
 def test_get_housenumber_with_ancestors(get):
     municipality = MunicipalityFactory()
@@ -569,6 +673,31 @@ def test_housenumber_select_use_default_orderby(get):
     assert resp.json['collection'][4]['ordinal'] == 'ter'
 
 
+@authorize
+def test_housenumber_cursor_pagination_use_default_orderby(get):
+    HouseNumberFactory(number="1", ordinal="a")
+    HouseNumberFactory(number="1", ordinal="")
+    HouseNumberFactory(number="2", ordinal="ter")
+    HouseNumberFactory(number="2", ordinal="")
+    HouseNumberFactory(number="2", ordinal="bis")
+    resp = get('/housenumber?cursor=&limit=2')
+    collection = resp.json['collection']
+    while 'next' in resp.json:
+        resp = get(resp.json['next'])
+        collection.extend(resp.json['collection'])
+    assert [(h['number'], h['ordinal']) for h in collection] == [
+        ('1', None), ('1', 'a'), ('2', None), ('2', 'bis'), ('2', 'ter')]
+
+
+@authorize
+def test_get_housenumber_collection_with_cursor_of_wrong_type(get):
+    HouseNumberFactory()
+    # ["", "", "not a pk"]: pk is an integer.
+    cursor = urlsafe_b64encode(b'["", "", "not a pk"]').decode()
+    resp = get('/housenumber?cursor={}'.format(cursor))
+    assert resp.status_code == 400
+
+
 @authorize('housenumber_write')
 def test_cannot_duplicate_number_and_ordinal_for_same_parent(client):
     assert not models.HouseNumber.select().count()
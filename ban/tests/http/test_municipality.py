@@ -1,6 +1,8 @@
 import json
 from datetime import datetime
 
+import pytest
+
 from ban.core import models, context
 from ban.core.encoder import dumps
 from ban.core.versioning import Version, Redirect
@@ -59,6 +61,97 @@ def test_get_municipality_groups_collection_is_paginated(get):
     assert resp.json == page1
 
 
+@authorize
+def test_get_municipality_collection_can_be_paginated_with_cursor(get):
+    MunicipalityFactory(insee='12345')
+    MunicipalityFactory(insee='12343')
+    MunicipalityFactory(insee='12344')
+    resp = get('/municipality?cursor=&limit=2')
+    page1 = resp.json
+    assert [m['insee'] for m in page1['collection']] == ['12343', '12344']
+    assert 'total' not in page1
+    assert 'previous' not in page1
+    assert 'cursor=' in page1['next']
+    assert page1['next'] in resp.headers['Link']
+    resp = get(page1['next'])
+    page2 = resp.json
+    assert [m['insee'] for m in page2['collection']] == ['12345']
+    assert 'next' not in page2
+
+
+@authorize
+def test_get_municipality_collection_with_invalid_cursor(get):
+    resp = get('/municipality?cursor=invalid')
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('cursor', [
+    'eyJpbnNlZSI6IDF9',  # Not a list: {"insee": 1}
+    'WyIxMjM0NSIsIDFd',  # Wrong arity: ["12345", 1]
+    'W3siYSI6IDF9XQ==',  # Not a scalar: [{"a": 1}]
+    'WyIxMjM0',  # Truncated.
+])
+@authorize
+def test_get_municipality_collection_with_tampered_cursor(get, cursor):
+    MunicipalityFactory(insee='12345')
+    resp = get('/municipality?cursor={}'.format(cursor))
+    assert resp.status_code == 400
+    assert resp.json['error'] == 'Invalid value for cursor'
+
+
+@authorize
+def test_get_municipality_collection_without_total(get):
+    MunicipalityFactory.create_batch(3)
+    resp = get('/municipality?total=none&limit=2')
+    page1 = resp.json
+    assert len(page1['collection']) == 2
+    assert 'total' not in page1
+    assert 'next' in page1
+    resp = get(page1['next'])
+    page2 = resp.json
+    assert len(page2['collection']) == 1
+    assert 'next' not in page2
+    assert 'previous' in page2
+
+
+@authorize
+def test_get_municipality_collection_with_estimated_total(get):
+    MunicipalityFactory.create_batch(3)
+    resp = get('/municipality?total=estimate&limit=2')
+    # Small estimates are replaced by an exact count.
+    assert resp.json['total'] == 3
+    assert 'next' in resp.json
+
+
+@authorize
+def test_get_municipality_collection_with_invalid_total(get):
+    resp = get('/municipality?total=invalid')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_municipality_collection_can_be_streamed(get, monkeypatch):
+    monkeypatch.setattr('ban.http.api.CollectionEndpoint.MAX_LIMIT', 2)
+    MunicipalityFactory(insee='12345')
+    MunicipalityFactory(insee='12343')
+    MunicipalityFactory(insee='12344')
+    resp = get('/municipality?format=ndjson')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    lines = resp.data.decode().splitlines()
+    assert [json.loads(l)['insee'] for l in lines] == ['12343', '12344',
+                                                       '12345']
+
+
+@authorize
+def test_get_municipality_collection_can_be_streamed_from_accept(get):
+    MunicipalityFactory.create_batch(3)
+    resp = get('/municipality',
+               headers={'Accept': 'application/x-ndjson'})
+    assert resp.mimetype == 'application/x-ndjson'
+    assert len(resp.data.decode().splitlines()) == 3
+
+
 @authorize
 def test_get_municipality_collection_is_ceiled(get, monkeypatch):
     monkeypatch.setattr('ban.http.api.CollectionEndpoint.MAX_LIMIT', 4)
@@ -83,6 +176,24 @@ def test_get_municipality_versions(get):
     assert resp.json['collection'][1]['data']['name'] == 'Cabour2'
 
 
+@authorize
+def test_get_municipality_versions_stored_as_deltas(get, config):
+    config.VERSION_SNAPSHOT_INTERVAL = 2
+    municipality = MunicipalityFactory(name="Cabour", insee="12345")
+    for name in ["Cabour2", "Cabour3"]:
+        municipality.increment_version()
+        municipality.name = name
+        municipality.save()
+    resp = get('/municipality/{}/versions'.format(municipality.id))
+    assert resp.status_code == 200
+    assert [v['data']['name'] for v in resp.json['collection']] == [
+        'Cabour', 'Cabour2', 'Cabour3']
+    assert resp.json['collection'][1]['data']['insee'] == '12345'
+    resp = get('/municipality/{}/versions/2'.format(municipality.id))
+    assert resp.json['data']['name'] == 'Cabour2'
+    assert resp.json['data']['version'] == 2
+
+
 @authorize
 def test_get_municipality_versions_by_datetime(get):
     municipality = MunicipalityFactory(name="Cabour")
@@ -1,7 +1,12 @@
 import json
 
+import peewee
+import pytest
+
 from ban.core import models
 from ban.core.encoder import dumps
+from ban.http.api import stream_bbox
+from ban.utils import utcnow
 
 from ..factories import HouseNumberFactory, PositionFactory
 from .utils import authorize
@@ -432,3 +437,197 @@ def test_check_position_center(post):
     }
     resp = post('/position', data)
     assert resp.status_code == 422
+
+
+@authorize
+def test_bbox_endpoint(get):
+    position = PositionFactory(center=(1, 1))
+    PositionFactory(center=(-1, -1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 1
+    result = resp.json['collection'][0]
+    assert result['id'] == position.id
+    assert result['center'] == {'type': 'Point', 'coordinates': [1, 1]}
+    assert result['housenumber']['id'] == position.housenumber.id
+    assert (result['housenumber']['group']['id'] ==
+            position.housenumber.parent.id)
+
+
+@authorize
+def test_bbox_endpoint_total_ignores_limit(get):
+    PositionFactory.create_batch(3, center=(1, 1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&limit=2')
+    assert len(resp.json['collection']) == 2
+    assert resp.json['total'] == 3
+
+
+@authorize
+def test_bbox_endpoint_counts_in_the_page_statement(get, sql_spy):
+    PositionFactory.create_batch(2, center=(1, 1))
+    sql_spy.reset_mock()
+    resp = get('/bbox?north=2&south=0&west=0&east=2&limit=1')
+    assert resp.json['total'] == 2
+    assert len(resp.json['collection']) == 1
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert not any(sql.startswith('SELECT count(*)') for sql in sqls)
+
+
+@authorize
+def test_bbox_endpoint_unique_total_counts_housenumbers_once(get):
+    housenumber = HouseNumberFactory()
+    PositionFactory.create_batch(2, center=(1, 1), housenumber=housenumber)
+    # Modified at the same time: both are the last one.
+    models.Position.update(modified_at=utcnow()).execute()
+    PositionFactory(center=(1, 1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&unique=true')
+    assert len(resp.json['collection']) == 2
+    assert resp.json['total'] == 2
+    resp = get('/bbox?north=2&south=0&west=0&east=2&unique=true'
+               '&total=capped')
+    assert resp.json['total'] == 2
+
+
+def test_stream_bbox_runs_the_query_before_the_response():
+    with pytest.raises(peewee.ProgrammingError):
+        stream_bbox('SELECT missing FROM position', {})
+
+
+@authorize
+def test_bbox_endpoint_with_empty_result(get):
+    PositionFactory(center=(-1, -1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2')
+    assert resp.json == {'collection': [], 'total': 0}
+
+
+@authorize
+def test_bbox_endpoint_without_bbox(get):
+    resp = get('/bbox?north=2&south=0')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_bbox_endpoint_with_capped_total(get, monkeypatch):
+    monkeypatch.setattr('ban.http.api.BBOX_TOTAL_CAP', 2)
+    PositionFactory.create_batch(3, center=(1, 1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&limit=1&total=capped')
+    assert resp.status_code == 200
+    assert len(resp.json['collection']) == 1
+    assert resp.json['total'] == '>2'
+    resp = get('/bbox?north=2&south=0&west=0&east=0.5&total=capped')
+    assert resp.json['total'] == 0
+
+
+@authorize
+def test_bbox_endpoint_with_estimated_total(get):
+    PositionFactory.create_batch(3, center=(1, 1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&limit=1&total=estimate')
+    assert resp.status_code == 200
+    # Small estimates are replaced by a (capped) count.
+    assert resp.json['total'] == 3
+
+
+@authorize
+def test_bbox_endpoint_without_total(get):
+    PositionFactory(center=(1, 1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&total=none')
+    assert resp.status_code == 200
+    assert len(resp.json['collection']) == 1
+    assert 'total' not in resp.json
+
+
+@authorize
+def test_bbox_endpoint_with_invalid_total(get):
+    resp = get('/bbox?north=2&south=0&west=0&east=2&total=invalid')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_bbox_endpoint_with_grid_cluster(get):
+    PositionFactory.create_batch(3, center=(1, 1))
+    PositionFactory(center=(1.9, 1.9))
+    PositionFactory(center=(-1, -1))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&cluster=grid')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 4
+    counts = sorted(c['count'] for c in resp.json['collection'])
+    assert counts == [1, 3]
+
+
+@authorize
+def test_bbox_endpoint_with_geohash_cluster(get):
+    PositionFactory.create_batch(3, center=(1, 1))
+    PositionFactory(center=(1.9, 1.9))
+    resp = get('/bbox?north=2&south=0&west=0&east=2&cluster=geohash')
+    assert resp.json['total'] == 4
+    cells = resp.json['collection']
+    assert sorted(c['count'] for c in cells) == [1, 3]
+    assert all(c['cell'] for c in cells)
+
+
+@authorize
+def test_bbox_cluster_skips_deleted_housenumbers_and_groups(get):
+    PositionFactory(center=(1, 1))
+    position = PositionFactory(center=(1, 1))
+    models.HouseNumber.update(deleted_at=utcnow()).where(
+        models.HouseNumber.pk == position.housenumber.pk).execute()
+    other = PositionFactory(center=(1, 1))
+    models.Group.update(deleted_at=utcnow()).where(
+        models.Group.pk == other.housenumber.parent.pk).execute()
+    resp = get('/bbox?north=2&south=0&west=0&east=2&cluster=grid')
+    assert resp.json['total'] == 1
+    assert [c['count'] for c in resp.json['collection']] == [1]
+
+
+@authorize
+def test_bbox_unique_cluster_total_counts_housenumbers_once(get):
+    position = PositionFactory(center=(1, 1))
+    PositionFactory(center=(1.9, 1.9), housenumber=position.housenumber)
+    resp = get('/bbox?north=2&south=0&west=0&east=2&cluster=grid'
+               '&unique=true')
+    assert sorted(c['count'] for c in resp.json['collection']) == [1, 1]
+    assert resp.json['total'] == 1
+
+
+@authorize
+def test_bbox_endpoint_with_invalid_cluster(get):
+    resp = get('/bbox?north=2&south=0&west=0&east=2&cluster=invalid')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_nearest_positions(get):
+    far = PositionFactory(center=(2, 2))
+    near = PositionFactory(center=(1.1, 1.1))
+    PositionFactory(center=(10, 10))
+    resp = get('/position/nearest?lon=1&lat=1&k=2')
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    collection = resp.json['collection']
+    assert [p['id'] for p in collection] == [near.id, far.id]
+    housenumber = collection[0]['housenumber']
+    assert housenumber['id'] == near.housenumber.id
+    assert housenumber['parent']['id'] == near.housenumber.parent.id
+
+
+@authorize
+def test_get_nearest_positions_rejects_as_of(get):
+    PositionFactory(center=(1, 1))
+    resp = get('/position/nearest?lon=1&lat=1&as_of=2015-01-01')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_nearest_positions_filtered_by_kind(get):
+    PositionFactory(center=(1.1, 1.1), kind='entrance')
+    building = PositionFactory(center=(2, 2), kind='building')
+    resp = get('/position/nearest?lon=1&lat=1&kind=building')
+    assert [p['id'] for p in resp.json['collection']] == [building.id]
+
+
+@authorize
+def test_get_nearest_positions_needs_a_point(get):
+    resp = get('/position/nearest?lon=1')
+    assert resp.status_code == 400
+    resp = get('/position/nearest?lon=1&lat=invalid')
+    assert resp.status_code == 400
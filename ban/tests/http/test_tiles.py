@@ -0,0 +1,93 @@
+import pytest
+
+from ban.http import tiles
+
+from ..factories import PositionFactory
+from .utils import authorize
+
+
+@pytest.fixture
+def tile_cache(config):
+    config.TILE_CACHE = True
+    tiles.TILES.clear()
+    yield tiles.TILES
+    tiles.TILES.clear()
+
+
+def test_tile_envelope():
+    assert tiles.envelope(0, 0, 0) == (-tiles.ORIGIN, -tiles.ORIGIN,
+                                       tiles.ORIGIN, tiles.ORIGIN)
+    xmin, ymin, xmax, ymax = tiles.envelope(1, 1, 0)
+    assert (xmin, ymin, xmax, ymax) == (0, 0, tiles.ORIGIN, tiles.ORIGIN)
+
+
+def test_tiles_around_a_point():
+    keys = tiles.around(2.35, 48.85)
+    assert '12/2074/1409' in keys
+    assert len([k for k in keys if k.startswith('12/')]) == 1
+
+
+def test_tile_attributes_depend_on_zoom():
+    assert 'h.number' not in tiles.make_sql(12)
+    assert 'h.number' in tiles.make_sql(15)
+    assert 'g.name' not in tiles.make_sql(15)
+    assert 'g.name' in tiles.make_sql(17)
+
+
+@authorize
+def test_get_tile(get):
+    PositionFactory(center=(2.35, 48.85))
+    resp = get('/tiles/12/2074/1409.mvt')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/vnd.mapbox-vector-tile'
+    assert resp.data
+
+
+@authorize
+def test_get_empty_tile(get):
+    PositionFactory(center=(2.35, 48.85))
+    resp = get('/tiles/12/0/0.mvt')
+    assert resp.status_code == 204
+
+
+@authorize
+def test_get_tile_below_min_zoom_is_empty(get):
+    PositionFactory(center=(2.35, 48.85))
+    resp = get('/tiles/5/16/11.mvt')
+    assert resp.status_code == 204
+
+
+@authorize
+def test_get_tile_min_zoom_is_configurable(get, config):
+    config.TILE_MIN_ZOOM = 5
+    PositionFactory(center=(2.35, 48.85))
+    resp = get('/tiles/5/16/11.mvt')
+    assert resp.status_code == 200
+    assert resp.data
+    assert '5/16/11' in tiles.around(2.35, 48.85)
+
+
+@authorize
+def test_get_invalid_tile(get):
+    resp = get('/tiles/12/5000/0.mvt')
+    assert resp.status_code == 404
+
+
+@authorize
+def test_tile_cache_is_invalidated_by_new_position(get, tile_cache):
+    PositionFactory(center=(2.35, 48.85))
+    first = get('/tiles/12/2074/1409.mvt').data
+    assert get('/tiles/12/2074/1409.mvt').data == first
+    assert '12/2074/1409' in tile_cache.store
+    PositionFactory(center=(2.351, 48.851))
+    tile_cache.increments.sync()
+    assert '12/2074/1409' not in tile_cache.store
+    assert get('/tiles/12/2074/1409.mvt').data != first
+
+
+@authorize
+def test_tile_cache_does_not_keep_empty_tiles(get, tile_cache):
+    assert get('/tiles/12/2074/1409.mvt').status_code == 204
+    assert '12/2074/1409' not in tile_cache.store
+    PositionFactory(center=(2.35, 48.85))
+    assert get('/tiles/12/2074/1409.mvt').status_code == 200
@@ -1,4 +1,7 @@
-from ban.db import cache
+import time
+
+from ban import db
+from ban.db import cache, notifications
 from ban.core import models
 
 from . import factories
@@ -62,3 +65,137 @@ def test_saving_should_clear_cache(sql_spy):
     assert sql_spy.call_count == 0
     assert group2.municipality.version == 2
     assert sql_spy.call_count == 1
+
+
+def test_saving_should_not_clear_other_models_cache():
+    cache.set(['Municipality', 1], 'value')
+    position = factories.PositionFactory()
+    position.save()
+    assert cache.get(['Municipality', 1]) == 'value'
+
+
+def test_invalidate_should_only_drop_the_given_key():
+    cache.set(['Municipality', 1], 'one')
+    cache.set(['Municipality', 2], 'two')
+    cache.set(['Session', 1], 'session')
+    cache.invalidate('Municipality', 1)
+    assert cache.get(['Municipality', 1]) == cache.UNSET
+    assert cache.get(['Municipality', 2]) == 'two'
+    cache.invalidate('Municipality')
+    assert cache.get(['Municipality', 2]) == cache.UNSET
+    assert cache.get(['Session', 1]) == 'session'
+
+
+def test_cache_should_evict_least_recently_used(monkeypatch):
+    monkeypatch.setattr(cache.STORE, '_maxsize', 2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') == cache.UNSET
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache.STORE) == 2
+
+
+def test_store_should_read_its_size_setting_at_use(config):
+    store = cache.Store(size_key='OTHER_CACHE_SIZE')
+    config.OTHER_CACHE_SIZE = 1
+    store['a'] = 1
+    store['b'] = 2
+    assert len(store) == 1
+
+
+def test_cache_should_expire_entries(monkeypatch):
+    monkeypatch.setattr(cache.STORE, '_ttl', 10)
+    cache.set('key', 'value')
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now + 11)
+    assert cache.get('key') == cache.UNSET
+
+
+def test_cache_should_count_hits_misses_and_evictions(monkeypatch):
+    monkeypatch.setattr(cache.STORE, '_maxsize', 1)
+    cache.STORE.reset_stats()
+    cache.get('key')
+    cache.set('key', 'value')
+    cache.get('key')
+    cache.set('other', 'value')
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+    assert stats['size'] == 1
+
+
+def test_saving_cached_model_should_notify_other_processes(sql_spy):
+    mun = factories.MunicipalityFactory()
+    sql_spy.reset_mock()
+    mun.version = 2
+    mun.save()
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert 'SELECT pg_notify(%s, %s)' in sqls
+
+
+def test_saving_not_cached_model_should_not_notify(sql_spy):
+    position = factories.PositionFactory()
+    sql_spy.reset_mock()
+    position.version = 2
+    position.save()
+    sqls = [call[0][1] for call in sql_spy.call_args_list]
+    assert 'SELECT pg_notify(%s, %s)' not in sqls
+
+
+def wait_for_eviction(key, publish=False):
+    deadline = time.time() + 5
+    while cache.get(key) != cache.UNSET:
+        assert time.time() < deadline
+        if publish:
+            notifications.publish(db.database, *key)
+        time.sleep(.05)
+
+
+def test_listener_should_evict_notified_keys():
+    listener = notifications.listen(db.database)
+    # Make sure the listener is connected.
+    cache.set(['Probe', 1], 'value')
+    wait_for_eviction(['Probe', 1], publish=True)
+    assert listener.is_alive()
+    cache.set(['Municipality', 1], 'value')
+    cache.set(['Municipality', 2], 'value')
+    notifications.publish(db.database, 'Municipality', 1)
+    wait_for_eviction(['Municipality', 1])
+    assert cache.get(['Municipality', 2]) == 'value'
+
+
+def test_listener_should_evict_keys_notified_at_once():
+    notifications.listen(db.database)
+    cache.set(['Probe', 1], 'value')
+    wait_for_eviction(['Probe', 1], publish=True)
+    cache.set(['Municipality', 1], 'value')
+    cache.set(['Municipality', 2], 'value')
+    notifications.publish_many(db.database, 'Municipality', [1, 2])
+    wait_for_eviction(['Municipality', 1])
+    wait_for_eviction(['Municipality', 2])
+
+
+def test_listener_should_survive_errors(monkeypatch):
+    listener = notifications.listen(db.database)
+    monkeypatch.setattr(listener, 'retry_delay', 0)
+    failures = []
+    invalidate = cache.invalidate
+
+    def fail_once(*keys):
+        if not failures:
+            failures.append(keys)
+            raise KeyError(keys)
+        invalidate(*keys)
+
+    monkeypatch.setattr(cache, 'invalidate', fail_once)
+    cache.set(['Probe', 2], 'value')
+    wait_for_eviction(['Probe', 2], publish=True)
+    assert failures
+    # Reconnected and still listening.
+    cache.set(['Probe', 3], 'value')
+    wait_for_eviction(['Probe', 3], publish=True)
+    assert listener.is_alive()
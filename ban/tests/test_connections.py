@@ -0,0 +1,77 @@
+from ban.db import database
+
+
+def test_closing_should_give_back_the_connection_to_the_pool():
+    database.connect()
+    conn = database.get_conn()
+    database.close()
+    database.reset_stats()
+    database.connect()
+    assert database.get_conn() is conn
+    assert database.stats['reused'] == 1
+    assert database.stats['created'] == 0
+
+
+def test_pool_should_recycle_old_connections(monkeypatch):
+    database.connect()
+    conn = database.get_conn()
+    database.close()
+    monkeypatch.setattr(database, 'stale_timeout', -1)
+    database.reset_stats()
+    database.connect()
+    assert database.get_conn() is not conn
+    assert database.stats['recycled'] >= 1
+
+
+def test_pool_should_discard_broken_connections(config):
+    config.POOL_CHECK_INTERVAL = 0
+    database.connect()
+    conn = database.get_conn()
+    database.close()
+    conn.close()
+    database.reset_stats()
+    database.connect()
+    assert database.get_conn() is not conn
+    assert database.execute_sql('SELECT 1').fetchone() == (1, )
+
+
+def test_pool_should_ping_idle_connections(config):
+    config.POOL_CHECK_INTERVAL = 0
+    database.connect()
+    conn = database.get_conn()
+    database.close()
+    database.connect()
+    assert database.get_conn() is conn
+    assert database.stats['broken'] == 0
+
+
+def test_after_fork_should_forget_inherited_connections():
+    database.connect()
+    conn = database.get_conn()
+    database.after_fork()
+    assert database.is_closed()
+    assert not database.stats['idle']
+    assert not database.stats['in_use']
+    assert database.get_conn() is not conn
+    assert not conn.closed
+    conn.close()
+
+
+def test_connect_should_keep_the_open_connection_and_its_transaction():
+    database.connect()
+    conn = database.get_conn()
+    with database.atomic():
+        database.execute_sql('CREATE TEMPORARY TABLE kept (id int) '
+                             'ON COMMIT DROP')
+        database.connect()
+        assert database.get_conn() is conn
+        database.execute_sql('SELECT * FROM kept')
+
+
+def test_connect_should_replace_a_broken_open_connection():
+    database.connect()
+    conn = database.get_conn()
+    conn.close()
+    database.connect()
+    assert database.get_conn() is not conn
+    assert database.execute_sql('SELECT 1').fetchone() == (1, )
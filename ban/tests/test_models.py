@@ -49,6 +49,101 @@ def test_municipality_str():
     assert str(municipality) == 'Salsein'
 
 
+def test_named_model_save_should_normalize_name_and_alias():
+    group = GroupFactory(name="Rue de la Boulangère",
+                         alias=["Allée des Lilas", "Chemin du Moulin"])
+    assert group.name_normalized == 'BOULANGERE'
+    assert group.alias_normalized == 'LILAS\nMOULIN'
+    group.name = "Place de l'Église"
+    group.increment_version()
+    group.save()
+    assert models.Group.get(models.Group.pk == group.pk).name_normalized == (
+        'EGLISE')
+
+
+def test_normalized_names_are_not_exposed():
+    group = GroupFactory(name="Rue de la Boulangère")
+    assert 'name_normalized' not in group.as_resource
+    assert 'name_normalized' not in group.as_version
+
+
+def test_name_search_should_narrow_down_with_normalized_name():
+    GroupFactory(name="Rue de la Boulangère")
+    GroupFactory(name="Rue des Boulets")
+    search = models.Group.name.search(type='direct', search='boulangere')
+    sql, params = models.Group.select().where(search).sql()
+    assert '"name_normalized" LIKE' in sql
+    assert params[0] == 'BOULANGERE'
+    assert [g.name for g in models.Group.select().where(search)] == [
+        "Rue de la Boulangère"]
+
+
+@pytest.mark.parametrize('type', ['direct', 'case', 'approx'])
+def test_name_search_should_find_names_not_normalized_yet(type):
+    group = GroupFactory(name="Rue de la Boulangère")
+    GroupFactory(name="Rue des Boulets")
+    (models.Group.update(name_normalized=None)
+                 .where(models.Group.pk == group.pk).execute())
+    search = models.Group.name.search(type=type,
+                                      search='rue de la boulangere')
+    assert [g.name for g in models.Group.select().where(search)] == [
+        "Rue de la Boulangère"]
+
+
+def test_name_search_should_not_use_normalized_name_with_pattern():
+    search = models.Group.name.search(type='case', search='rue%')
+    sql, _ = models.Group.select().where(search).sql()
+    assert 'name_normalized' not in sql
+
+
+def test_group_extent_follows_positions():
+    group = GroupFactory()
+    PositionFactory(housenumber__parent=group, center=(1, 1))
+    PositionFactory(housenumber__parent=group, center=(3, 2))
+    group = models.Group.get(models.Group.pk == group.pk)
+    assert group.centroid.coords == (2, 1.5)
+    assert group.extent.geojson['type'] == 'Polygon'
+    assert 'extent' not in group.as_version
+
+
+def test_group_extent_is_refreshed_when_position_moves_to_other_group():
+    group = GroupFactory()
+    other = GroupFactory()
+    position = PositionFactory(housenumber__parent=group, center=(1, 1))
+    position.housenumber = HouseNumberFactory(parent=other)
+    position.increment_version()
+    position.save()
+    group = models.Group.get(models.Group.pk == group.pk)
+    other = models.Group.get(models.Group.pk == other.pk)
+    assert group.extent is None
+    assert group.centroid is None
+    assert other.centroid.coords == (1, 1)
+
+
+def test_group_extent_is_refreshed_when_position_is_deleted():
+    group = GroupFactory()
+    PositionFactory(housenumber__parent=group, center=(1, 1))
+    position = PositionFactory(housenumber__parent=group, center=(3, 3))
+    position.delete_instance()
+    group = models.Group.get(models.Group.pk == group.pk)
+    assert group.centroid.coords == (1, 1)
+
+
+def test_group_extent_is_not_refreshed_when_center_does_not_change(sql_spy):
+    position = PositionFactory(center=(1, 1))
+    position = models.Position.get(models.Position.pk == position.pk)
+    position.comment = 'Près du portail'
+    position.increment_version()
+    sql_spy.reset_mock()
+    position.save()
+    assert not any('extent' in call[0][1]
+                   for call in sql_spy.call_args_list)
+    position.center = (2, 2)
+    position.increment_version()
+    position.save()
+    assert any('extent' in call[0][1] for call in sql_spy.call_args_list)
+
+
 @pytest.mark.parametrize('factory,kwargs', [
     (MunicipalityFactory, {'insee': '12345'}),
     (MunicipalityFactory, {'siren': '123456789'}),
@@ -0,0 +1,26 @@
+from ban.db import names
+
+
+def test_abbreviations_are_loaded_from_package():
+    assert ('R', 'RUE') in names.ABBREVIATIONS
+    assert ('nom_court', 'nom_long') not in names.ABBREVIATIONS
+
+
+def test_find_abbreviation_from_long_name():
+    assert names.find_abbreviation('Rue des Boulets') == ('R', 'RUE')
+
+
+def test_find_abbreviation_from_short_name():
+    assert names.find_abbreviation('r. des Boulets') == ('R', 'RUE')
+
+
+def test_find_abbreviation_returns_first_row_of_table():
+    assert names.find_abbreviation('ACH du Moulin') == ('ACH', 'ANCIEN CHEMIN')
+
+
+def test_find_abbreviation_without_way_type():
+    assert names.find_abbreviation('Boulets') is None
+
+
+def test_abbreviations_pattern_has_no_empty_alternative():
+    assert names.ABBREVIATIONS_PATTERN.startswith('^(ACH|')
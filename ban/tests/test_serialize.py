@@ -1,4 +1,10 @@
-from .factories import GroupFactory, HouseNumberFactory
+from itertools import chain, combinations, islice
+
+import pytest
+
+from ban.core import models, resource
+
+from .factories import GroupFactory, HouseNumberFactory, PositionFactory
 
 
 def test_simple_serialize():
@@ -43,6 +49,8 @@ def test_serialize_with_wildcard():
         'attributes': None,
         'laposte': None,
         'addressing': None,
+        'extent': None,
+        'centroid': None,
         'version': 1,
         'status': 'active',
         'modified_at': group.modified_at.isoformat(),
@@ -78,6 +86,8 @@ def test_serialize_with_wildcard_in_relation():
             'attributes': None,
             'laposte': None,
             'addressing': None,
+            'extent': None,
+            'centroid': None,
             'version': 1,
             'status': 'active',
             'modified_at': group.modified_at.isoformat(),
@@ -141,6 +151,8 @@ def test_serialize_with_double_wildcard():
             'attributes': None,
             'laposte': None,
             'addressing': None,
+            'extent': None,
+            'centroid': None,
             'version': 1,
             'status': 'active',
             'modified_at': group.modified_at.isoformat(),
@@ -170,3 +182,43 @@ def test_serialize_manytomany():
             'id': group.id,
         }]
     }
+
+
+def test_serialize_queryset_prefetches_relations_by_batch(sql_spy):
+    group = GroupFactory(name='Rue de la Banatouille')
+    district = GroupFactory(name='Quartier des Pyrénées')
+    for number in ['1', '2', '3']:
+        housenumber = HouseNumberFactory(parent=group, number=number,
+                                         ancestors=[district])
+        PositionFactory(housenumber=housenumber)
+    mask = {'number': {}, 'parent': {'municipality': {'name': {}}},
+            'ancestors': {'name': {}}, 'positions': {}}
+    expected = [h.serialize(mask) for h in models.HouseNumber.select()]
+    sql_spy.reset_mock()
+    assert list(models.HouseNumber.select().serialize(mask)) == expected
+    # housenumbers, parents, municipalities, ancestors and positions.
+    assert sql_spy.call_count == 5
+
+
+def test_serializer_is_compiled_once_per_mask():
+    mask = {'name': {}, 'municipality': {'name': {}}}
+    serializer = models.Group.serializer(mask)
+    assert models.Group.serializer({'municipality': {'name': {}},
+                                    'name': {}}) is serializer
+    assert models.Group.serializer({'name': {}}) is not serializer
+
+
+def test_serialize_unknown_field():
+    group = GroupFactory()
+    with pytest.raises(ValueError):
+        group.serialize({'unknown': {}})
+
+
+def test_serializers_cache_is_bounded():
+    fields = ['name', 'alias', 'fantoir', 'kind', 'laposte', 'ign',
+              'addressing', 'id', 'version', 'status']
+    masks = chain(combinations(fields, 3), combinations(fields, 4))
+    for names in islice(masks, resource.SERIALIZERS_SIZE + 10):
+        models.Group.serializer({name: {} for name in names})
+    info = resource.compiled_serializer.cache_info()
+    assert info.currsize == resource.SERIALIZERS_SIZE
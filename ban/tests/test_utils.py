@@ -1,4 +1,4 @@
-from ban.utils import parse_mask
+from ban.utils import apply_delta, make_delta, parse_mask
 
 
 def test_parse_mask():
@@ -18,3 +18,13 @@ def test_parse_mask():
             }
         }
     }
+
+
+def test_delta_should_record_removed_keys():
+    old = {'name': 'Rue des Pommes', 'alias': ['Rue des Poires'],
+           'laposte': None}
+    new = {'name': 'Rue des Prunes', 'laposte': None}
+    delta = make_delta(old, new)
+    assert delta == {'name': 'Rue des Prunes', '-': ['alias']}
+    assert apply_delta(old, delta) == new
+    assert apply_delta(new, make_delta(new, old)) == old
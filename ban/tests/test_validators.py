@@ -1,6 +1,7 @@
 import pytest
 
 from ban.core import models
+from ban.core.validators import ResourceValidator
 from ban.auth.models import User
 
 from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
@@ -524,6 +525,54 @@ def test_giving_wrong_version_should_patch_if_possible_with_update(session):
     assert housenumber.ordinal == "bis"
 
 
+def test_bulk_save_creates_and_updates(session):
+    street = GroupFactory(name='Rue des Pommes')
+    district = GroupFactory(kind=models.Group.AREA)
+    validators = [
+        models.Group.validator(instance=street, update=True, version=2,
+                               name='Rue des Poires'),
+        models.HouseNumber.validator(number='1', parent=street,
+                                     ancestors=[district]),
+        models.HouseNumber.validator(number='2', parent=street),
+    ]
+    assert not any(v.errors for v in validators)
+    street, first, second = ResourceValidator.bulk_save(validators)
+    assert street.version == 2
+    assert models.Group.get(models.Group.pk == street.pk).name == (
+        'Rue des Poires')
+    assert first.pk and first.id and second.pk
+    assert first.version == 1
+    assert district in first.ancestors
+    assert models.HouseNumber.select().count() == 2
+
+
+def test_bulk_save_rolls_back_m2m_on_version_error(session):
+    district = GroupFactory(kind=models.Group.AREA)
+    first = HouseNumberFactory(number='1')
+    second = HouseNumberFactory(number='2')
+    validators = [
+        models.HouseNumber.validator(instance=first, update=True,
+                                     version=2, ancestors=[district]),
+        models.HouseNumber.validator(instance=second, update=True,
+                                     version=3, ordinal='ter'),
+    ]
+    assert not any(v.errors for v in validators)
+    with pytest.raises(models.HouseNumber.ForcedVersionError):
+        ResourceValidator.bulk_save(validators)
+    first = models.HouseNumber.get(models.HouseNumber.pk == first.pk)
+    assert district not in first.ancestors
+    assert first.version == 1
+
+
+def test_bulk_save_refuses_invalid_documents(session):
+    validators = [models.Municipality.validator(name='Eu', insee='12345',
+                                                siren='123456789'),
+                  models.Municipality.validator(name='Eu', insee='123')]
+    with pytest.raises(ValueError):
+        ResourceValidator.bulk_save(validators)
+    assert not models.Municipality.select().count()
+
+
 def test_can_create_user():
     validator = User.validator(username='Banner', email='ban@er',
                                is_staff=False)
@@ -1,8 +1,9 @@
 import peewee
 import pytest
 
+from ban import db
 from ban.core import models
-from ban.core.versioning import Version
+from ban.core.versioning import MissingSnapshotError, Version
 
 from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
                         PositionFactory, PostCodeFactory)
@@ -68,6 +69,267 @@ def test_save_should_be_rollbacked_if_version_save_fails():
     models.Municipality.select().count() == 1
 
 
+def test_versions_are_stored_as_deltas_between_snapshots(config):
+    config.VERSION_SNAPSHOT_INTERVAL = 3
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    documents = [municipality.as_version]
+    for name in ['Orvanne', 'Moret-Loing-et-Orvanne', 'Moret']:
+        municipality.name = name
+        municipality.increment_version()
+        municipality.save()
+        documents.append(municipality.as_version)
+    versions = list(Version.raw_select().where(
+        Version.model_pk == municipality.pk).order_by(Version.sequential))
+    assert [v.snapshot for v in versions] == [True, False, False, True]
+    assert versions[1].stored['name'] == 'Orvanne'
+    assert 'insee' not in versions[1].stored
+    assert [v.data for v in versions] == documents
+    assert municipality.load_version(3).load().name == 'Moret-Loing-et-Orvanne'
+
+
+def test_rebuild_delta_versions_in_one_query_per_model(config, sql_spy):
+    config.VERSION_SNAPSHOT_INTERVAL = 10
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    other = MunicipalityFactory(name='Montereau')
+    for name in ['Orvanne', 'Moret-Loing-et-Orvanne']:
+        municipality.name = name
+        municipality.increment_version()
+        municipality.save()
+    other.name = 'Montereau-Fault-Yonne'
+    other.increment_version()
+    other.save()
+    versions = list(municipality.versions) + list(other.versions)
+    sql_spy.reset_mock()
+    Version.rebuild(versions)
+    assert sql_spy.call_count == 1
+    assert [v.data['name'] for v in versions] == [
+        'Moret-sur-Loing', 'Orvanne', 'Moret-Loing-et-Orvanne', 'Montereau',
+        'Montereau-Fault-Yonne']
+
+
+def test_rebuild_should_start_from_the_first_snapshot_available(config):
+    config.VERSION_SNAPSHOT_INTERVAL = 2
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    for name in ['Orvanne', 'Moret-Loing-et-Orvanne', 'Moret']:
+        municipality.name = name
+        municipality.increment_version()
+        municipality.save()
+    Version.delete().where(Version.model_pk == municipality.pk,
+                           Version.sequential == 1).execute()
+    versions = list(Version.raw_select().where(
+        Version.model_pk == municipality.pk).order_by(Version.sequential))
+    assert [v.snapshot for v in versions] == [False, True, False]
+    with pytest.raises(MissingSnapshotError):
+        Version.rebuild(versions)
+    versions = versions[1:]
+    Version.rebuild(versions)
+    assert [v.data['name'] for v in versions] == [
+        'Moret-Loing-et-Orvanne', 'Moret']
+
+
+def statements(sql_spy):
+    return [call[0][1] for call in sql_spy.call_args_list
+            if 'SAVEPOINT' not in call[0][1]]
+
+
+def test_group_save_runs_a_constant_number_of_queries(sql_spy):
+    street = GroupFactory(name='Rue des Pommes')
+    for name in ['Rue des Poires', 'Rue des Prunes']:
+        sql_spy.reset_mock()
+        street.name = name
+        street.increment_version()
+        street.save()
+        sql = statements(sql_spy)
+        assert len(sql) == 4
+        assert sql[0].startswith('UPDATE "group"')
+        # Closing the previous version also returns it.
+        assert sql[1].startswith('UPDATE "version"')
+        assert 'RETURNING' in sql[1]
+        assert sql[2].startswith('INSERT INTO "version"')
+        assert sql[3].startswith('INSERT INTO "diff"')
+    versions = list(street.versions)
+    assert versions[1].period.upper == versions[2].period.lower
+    assert versions[2].diff.diff == {
+        'name': {'old': 'Rue des Poires', 'new': 'Rue des Prunes'}}
+
+
+def test_shared_model_save_also_notifies_other_processes(sql_spy):
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    sql_spy.reset_mock()
+    municipality.name = 'Orvanne'
+    municipality.increment_version()
+    municipality.save()
+    sql = statements(sql_spy)
+    assert len(sql) == 5
+    assert sql[0].startswith('UPDATE "municipality"')
+    assert sql.count('SELECT pg_notify(%s, %s)') == 1
+
+
+def test_shared_model_bulk_save_notifies_in_one_statement(sql_spy):
+
+    def count(size):
+        municipalities = [MunicipalityFactory() for i in range(size)]
+        for municipality in municipalities:
+            municipality.increment_version()
+        sql_spy.reset_mock()
+        models.Municipality.bulk_save(municipalities)
+        sql = statements(sql_spy)
+        assert len([s for s in sql if 'pg_notify' in s]) == 1
+        return len(sql)
+
+    assert count(2) == count(10)
+
+
+def test_housenumber_save_runs_a_constant_number_of_queries(sql_spy):
+    housenumber = HouseNumberFactory(number='1')
+    other = GroupFactory()
+    sql_spy.reset_mock()
+    housenumber.number = '2'
+    housenumber.increment_version()
+    housenumber.save()
+    assert len(statements(sql_spy)) == 4
+    sql_spy.reset_mock()
+    housenumber.parent = other
+    housenumber.increment_version()
+    housenumber.save()
+    sql = statements(sql_spy)
+    # Plus the former parent, and the extents of both groups.
+    assert len(sql) == 6
+    assert sql[0].startswith('SELECT')
+    assert sql[-1].startswith('UPDATE "group" SET extent')
+
+
+def test_position_save_runs_a_constant_number_of_queries(sql_spy):
+    position = PositionFactory(center=(1, 1))
+    other = HouseNumberFactory()
+    sql_spy.reset_mock()
+    position.comment = 'Près du portail'
+    position.increment_version()
+    position.save()
+    assert len(statements(sql_spy)) == 4
+    sql_spy.reset_mock()
+    position.center = (2, 2)
+    position.increment_version()
+    position.save()
+    sql = statements(sql_spy)
+    # Plus the extent of its group.
+    assert len(sql) == 5
+    assert sql[-1].startswith('UPDATE "group" SET extent')
+    sql_spy.reset_mock()
+    position.housenumber = other
+    position.increment_version()
+    position.save()
+    sql = statements(sql_spy)
+    # Plus the former housenumber, and the extents of both groups.
+    assert len(sql) == 6
+    assert sql[0].startswith('SELECT')
+    assert sql[-1].startswith('UPDATE "group" SET extent')
+
+
+def test_housenumber_save_does_not_query_municipality(sql_spy):
+    housenumber = HouseNumberFactory(number='1')
+    sql_spy.reset_mock()
+    housenumber.number = '2'
+    housenumber.increment_version()
+    housenumber.save()
+    sql = statements(sql_spy)
+    # The insee of the Diff comes from the cached group municipality.
+    assert not [s for s in sql if 'FROM "municipality"' in s]
+    assert housenumber.versions[1].diff.insee == (
+        housenumber.parent.municipality.insee)
+
+
+def test_bulk_save_is_versioned_like_save():
+    municipality = MunicipalityFactory()
+    streets = [models.Group(name='Rue {}'.format(i), kind=models.Group.WAY,
+                            municipality=municipality) for i in range(3)]
+    models.Group.bulk_save(streets)
+    for street in streets:
+        street = models.Group.get(models.Group.pk == street.pk)
+        assert street.id.startswith('ban-group-')
+        assert street.version == 1
+        assert street.name_normalized
+        assert len(street.versions) == 1
+        assert street.versions[0].diff.insee == municipality.insee
+    for street in streets:
+        street.name = street.name.replace('Rue', 'Avenue')
+        street.increment_version()
+    models.Group.bulk_save(streets)
+    for street in streets:
+        versions = list(street.versions)
+        assert [v.data['name'] for v in versions] == [
+            street.name.replace('Avenue', 'Rue'), street.name]
+        assert versions[0].period.upper == versions[1].period.lower
+        assert versions[1].diff.diff['name']['new'] == street.name
+
+
+def test_bulk_save_checks_versions():
+    street = GroupFactory()
+    street.name = 'Rue des Poires'
+    with pytest.raises(models.Group.ForcedVersionError):
+        models.Group.bulk_save([street])
+
+
+def test_bulk_save_keeps_the_columns_not_loaded():
+    street = GroupFactory(name='Rue des Pommes', alias=['Rue des Pommiers'])
+    street = (models.Group.select(models.Group.pk, models.Group.name,
+                                  models.Group.version)
+                          .where(models.Group.pk == street.pk).get())
+    street.name = 'Rue des Poires'
+    street.increment_version()
+    models.Group.bulk_save([street])
+    street = models.Group.get(models.Group.pk == street.pk)
+    assert street.name == 'Rue des Poires'
+    assert street.alias == ['Rue des Pommiers']
+    assert street.kind == models.Group.WAY
+    assert street.municipality
+    assert street.versions[1].data['alias'] == ['Rue des Pommiers']
+
+
+def test_bulk_save_query_count_does_not_depend_on_size(sql_spy):
+    municipality = MunicipalityFactory()
+
+    def count(size):
+        streets = [models.Group(name='Rue {}'.format(i),
+                                kind=models.Group.WAY,
+                                municipality=municipality)
+                   for i in range(size)]
+        sql_spy.reset_mock()
+        models.Group.bulk_save(streets)
+        created = len(statements(sql_spy))
+        for street in streets:
+            street.increment_version()
+        sql_spy.reset_mock()
+        models.Group.bulk_save(streets)
+        return created, len(statements(sql_spy))
+
+    assert count(2) == count(10)
+
+
+@pytest.mark.parametrize('factory,field,value', [
+    (HouseNumberFactory, 'ordinal', 'bis'),
+    (PositionFactory, 'comment', 'Près du portail'),
+])
+def test_bulk_save_of_loaded_rows_does_not_depend_on_size(sql_spy, factory,
+                                                          field, value):
+    model = factory._meta.model
+
+    def count(size):
+        # Each with its own group and municipality.
+        pks = [factory().pk for i in range(size)]
+        instances = list(model.select().where(model.pk << pks))
+        for instance in instances:
+            setattr(instance, field, value)
+            instance.increment_version()
+        # Relations must not come from the cache either.
+        db.cache.clear()
+        sql_spy.reset_mock()
+        model.bulk_save(instances)
+        return len(statements(sql_spy))
+
+    assert count(2) == count(5)
+
+
 def test_group_is_versioned():
     initial_name = "Rue des Pommes"
     street = GroupFactory(name=initial_name)
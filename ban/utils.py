@@ -45,6 +45,31 @@ def make_diff(old, new, update=False):
     return diff
 
 
+# Delta key listing the keys of the previous document removed.
+REMOVED = '-'
+
+
+def make_delta(old, new):
+    """Keys of `new` whose value is not the one in `old`, meta included,
+    and the keys of `old` not in `new`, so that
+    `apply_delta(old, delta) == new`."""
+    delta = {key: value for key, value in new.items()
+             if key not in old or old[key] != value}
+    removed = sorted(key for key in old if key not in new)
+    if removed:
+        delta[REMOVED] = removed
+    return delta
+
+
+def apply_delta(old, delta):
+    document = dict(old)
+    document.update(delta)
+    document.pop(REMOVED, None)
+    for key in delta.get(REMOVED, []):
+        document.pop(key, None)
+    return document
+
+
 def utcnow():
     return datetime.now(timezone.utc)
 
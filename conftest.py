@@ -16,6 +16,8 @@ from ban.tests.factories import SessionFactory, TokenFactory, UserFactory
 
 def pytest_configure(config):
     db.database.prefix = 'test_'
+    # Tests needing it start it themselves.
+    application.config['CACHE_LISTENER'] = False
     db.database.connect()
     createdb(fail_silently=True)
     verbose = config.getoption('verbose')
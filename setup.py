@@ -42,6 +42,7 @@ setup(
     install_requires=install_requires,
     extras_require={'test': ['pytest'], 'docs': 'mkdocs'},
     include_package_data=True,
+    package_data={'ban.db': ['abbrev_type_voie.csv']},
     entry_points={
         'console_scripts': ['ban=ban.bin:main'],
     },